@@ -0,0 +1,172 @@
+"""
+Provides a client for the Salesforce Bulk API 2.0 ingest jobs.
+
+The client submits upsert jobs: the rows of a job are written to a temporary CSV file
+which is streamed to Salesforce, the job is polled until Salesforce has processed it,
+and the per-row results are read back and keyed by the external ID of each row.
+
+See https://developer.salesforce.com/docs/atlas.en-us.api_bulk_v2.meta/api_bulk_v2/
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import tempfile
+import time
+from collections import namedtuple
+from datetime import date, datetime
+
+import pytz
+import unicodecsv as csv
+
+from django.conf import settings
+
+from edx_salesforce.rest import RestApiClient, RestApiError
+
+# Number of seconds between polls of the state of a job.
+DEFAULT_BULK_POLL_INTERVAL = 5
+
+# Number of seconds to wait for Salesforce to process a job.
+DEFAULT_BULK_JOB_TIMEOUT = 2 * 60 * 60
+
+# Maximum number of rows uploaded in a single job, which keeps uploads well below the
+# 100 MB limit on the CSV data of a job.
+BULK_MAX_ROWS_PER_JOB = 50000
+
+# Value which sets a field to null. An empty value leaves the field unchanged.
+BULK_NULL = '#N/A'
+
+JOB_STATES_FINISHED = ('JobComplete', 'Failed', 'Aborted')
+
+# The result of upserting a row. `id` is the Salesforce ID of the upserted object and
+# `error` the reason the row failed, if it did.
+BulkResult = namedtuple('BulkResult', ['success', 'id', 'created', 'error'])
+
+
+class BulkApiError(RestApiError):
+    """
+    Raised when a Bulk API job can't be submitted or doesn't finish.
+    """
+    pass
+
+
+class BulkApiClient(RestApiClient):
+    """
+    Client for Bulk API 2.0 ingest jobs.
+    """
+    error_class = BulkApiError
+
+    def upsert(self, sobject, external_id_field, rows):
+        """
+        Upsert the given rows and return the result of each row.
+
+        The rows are submitted in jobs of at most BULK_MAX_ROWS_PER_JOB rows.
+
+        Arguments:
+            sobject (string): The API name of the Salesforce object, e.g. 'Lead'.
+            external_id_field (string): The API name of the field used to match the rows
+                                        to existing objects, e.g. 'Username__c' or 'Id'.
+            rows (list of dicts): The field values of each row, keyed by field API name.
+                                  Every row must have a value for the external ID field.
+
+        Returns:
+            dict, mapping the external ID of each row to its BulkResult.
+
+        Raises:
+            BulkApiError: if a job can't be submitted or doesn't finish in time.
+        """
+        results = {}
+        for index in range(0, len(rows), BULK_MAX_ROWS_PER_JOB):
+            results.update(self._run_upsert_job(sobject, external_id_field, rows[index:index + BULK_MAX_ROWS_PER_JOB]))
+        return results
+
+    def _run_upsert_job(self, sobject, external_id_field, rows):
+        """
+        Run a single upsert job and return the result of each row.
+        """
+        fields = [external_id_field] + sorted({field for row in rows for field in row} - {external_id_field})
+
+        job = self._request('post', 'jobs/ingest/', json={
+            'object': sobject,
+            'externalIdFieldName': external_id_field,
+            'contentType': 'CSV',
+            'operation': 'upsert',
+            'lineEnding': 'LF',
+        })
+        job_id = job['id']
+
+        try:
+            with tempfile.TemporaryFile() as csv_file:
+                writer = csv.writer(csv_file, delimiter=str(','), lineterminator=str('\n'))
+                writer.writerow(fields)
+                for row in rows:
+                    writer.writerow([_format_value(row[field]) if field in row else '' for field in fields])
+                csv_file.seek(0)
+                self._request(
+                    'put', 'jobs/ingest/{job_id}/batches/'.format(job_id=job_id),
+                    data=csv_file, headers={'Content-Type': 'text/csv'},
+                )
+            self._request('patch', 'jobs/ingest/{job_id}/'.format(job_id=job_id), json={'state': 'UploadComplete'})
+        except Exception:
+            self._request('patch', 'jobs/ingest/{job_id}/'.format(job_id=job_id), json={'state': 'Aborted'})
+            raise
+
+        job = self._wait_for_job(job_id)
+
+        results = {}
+        for row in self._results(job_id, 'successfulResults'):
+            results[row[external_id_field]] = BulkResult(True, row['sf__Id'], row['sf__Created'] == 'true', None)
+        for row in self._results(job_id, 'failedResults'):
+            results[row[external_id_field]] = BulkResult(False, row['sf__Id'] or None, False, row['sf__Error'])
+
+        # Rows of a failed or aborted job may be left unprocessed.
+        error = job.get('errorMessage') or 'Row not processed, job {state}.'.format(state=job['state'])
+        for row in rows:
+            key = _format_value(row[external_id_field])
+            if key not in results:
+                results[key] = BulkResult(False, None, False, error)
+
+        return results
+
+    def _results(self, job_id, result_type):
+        """
+        Return the rows of the given type of job results as dicts.
+        """
+        response = self._request('get', 'jobs/ingest/{job_id}/{result_type}/'.format(
+            job_id=job_id, result_type=result_type
+        ), stream=True)
+        return csv.DictReader(response.iter_lines(), encoding='utf-8')
+
+    def _wait_for_job(self, job_id):
+        """
+        Poll the state of a job until Salesforce finished processing it and return the job.
+        """
+        poll_interval = getattr(settings, 'EDX_SALESFORCE_BULK_POLL_INTERVAL', DEFAULT_BULK_POLL_INTERVAL)
+        timeout = getattr(settings, 'EDX_SALESFORCE_BULK_JOB_TIMEOUT', DEFAULT_BULK_JOB_TIMEOUT)
+        deadline = time.time() + timeout
+
+        while True:
+            job = self._request('get', 'jobs/ingest/{job_id}/'.format(job_id=job_id))
+            if job['state'] in JOB_STATES_FINISHED:
+                return job
+            if time.time() > deadline:
+                raise BulkApiError('Job {job_id} did not finish within {timeout} seconds.'.format(
+                    job_id=job_id, timeout=timeout
+                ))
+            time.sleep(poll_interval)
+
+
+def _format_value(value):
+    """
+    Return the CSV representation of a field value used by the Bulk API.
+    """
+    if value is None:
+        return BULK_NULL
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(pytz.utc)
+        return value.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+    if isinstance(value, date):
+        return value.strftime('%Y-%m-%d')
+    return '{}'.format(value)
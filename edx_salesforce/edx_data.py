@@ -3,8 +3,55 @@
 from __future__ import absolute_import, unicode_literals
 
 from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
+
+import pytz
 
 from django.db import connections
+from django.utils import six
+from django.utils.dateparse import parse_datetime
+
+from edx_salesforce.records import record_class
+from edx_salesforce.snapshot import Snapshot, load_snapshot, snapshot_path, write_snapshot
+
+# Databases queried while extracting user data.
+EXTRACTION_DATABASES = ('default', 'ecommerce')
+
+# Number of threads used to run independent extraction queries concurrently.
+EXTRACTION_THREADS = 3
+
+# Escape character used in LIKE patterns built from organization names.
+LIKE_ESCAPE = '!'
+
+# Number of rows read from a server-side cursor per round trip.
+STREAM_FETCH_SIZE = 1000
+
+# Number of users munged at a time when user data is streamed.
+DEFAULT_STREAM_BATCH_SIZE = 1000
+
+# Maximum number of order IDs sent in a single coupon code query.
+COUPON_BATCH_SIZE = 1000
+
+# Database vendors which support GROUP_CONCAT, used to fetch coupon codes along with the orders.
+GROUP_CONCAT_VENDORS = ('mysql', 'sqlite')
+
+# Separator of the coupon codes aggregated by GROUP_CONCAT. Unlike the default comma, it
+# can't occur in a coupon code.
+COUPON_CODE_SEPARATOR = '\n'
+
+# Expression aggregating the coupon codes of an order line, by database vendor.
+COUPON_CODES_AGGREGATES = {
+    'mysql': "GROUP_CONCAT(DISTINCT v.code SEPARATOR '\\n')",
+    'sqlite': 'GROUP_CONCAT(v.code, CHAR(10))',
+}
+
+# Maximum length in bytes of the coupon codes aggregated for an order line. MySQL silently
+# truncates the result of GROUP_CONCAT at its group_concat_max_len, 1024 bytes by default,
+# so it is raised to this length for the session of the order query. Orders whose aggregated
+# codes reach it anyway have their codes fetched with separate queries.
+GROUP_CONCAT_MAX_LEN = 1024 * 1024
 
 
 QUERIES = {
@@ -26,7 +73,35 @@ QUERIES = {
         JOIN ecommerce_user AS u
         ON o.user_id = u.id
         WHERE
-        p.course_id REGEXP "^course-v1:({orgs}).*$"
+        {org_filter}
+        {changed_filter}
+    ''',
+    'ORDERS_WITH_COUPONS_FOR_ORGS': '''
+        SELECT
+        u.username AS username,
+        o.id AS order_id,
+        o.date_placed AS purchase_date,
+        l.quantity AS quantity,
+        l.line_price_before_discounts_incl_tax AS list_price,
+        l.line_price_incl_tax AS unit_price,
+        p.course_id AS course_id,
+        {coupon_codes} AS coupon_codes
+
+        FROM order_line AS l
+        JOIN order_order AS o
+        ON l.order_id = o.id
+        JOIN catalogue_product AS p
+        ON l.product_id = p.id
+        JOIN ecommerce_user AS u
+        ON o.user_id = u.id
+        LEFT JOIN voucher_voucherapplication AS va
+        ON va.order_id = o.id
+        LEFT JOIN voucher_voucher AS v
+        ON v.id = va.voucher_id
+        WHERE
+        {org_filter}
+        {changed_filter}
+        GROUP BY l.id
     ''',
     'COUPON_CODES_FOR_ORDERS': '''
         SELECT
@@ -41,20 +116,28 @@ QUERIES = {
         WHERE
         o.id in ({orders})
     ''',
-    'LANGUAGE_PREFS_FOR_USERNAMES': '''
+    'LANGUAGE_PREFS_FOR_USER_IDS': '''
         SELECT
-        u.username AS username,
+        up.user_id AS user_id,
         up.value AS language_preference
 
-        FROM auth_user AS u
-        JOIN user_api_userpreference AS up
-        ON up.user_id = u.id
+        FROM user_api_userpreference AS up
         WHERE
         up.key = "pref-lang" AND
+        up.user_id in ({user_ids})
+    ''',
+    'USER_IDS_FOR_USERNAMES': '''
+        SELECT
+        u.id AS user_id,
+        u.username AS username
+
+        FROM auth_user AS u
+        WHERE
         u.username in ({usernames})
     ''',
     'USERS_FOR_SITE': '''
         SELECT
+        u.id AS user_id,
         u.username AS username
 
         FROM auth_user AS u
@@ -63,9 +146,11 @@ QUERIES = {
         WHERE
         ua.name = "created_on_site" AND
         ua.value = "{site_domain}"
+        {changed_filter}
     ''',
-    'USERS_FOR_USERNAMES': '''
+    'USERS_FOR_USER_IDS': '''
         SELECT
+        u.id AS user_id,
         u.username AS username,
         LOWER(u.email) AS email,
         p.name AS full_name,
@@ -80,17 +165,15 @@ QUERIES = {
         JOIN auth_userprofile AS p
         ON p.user_id = u.id
         WHERE
-        u.username in ({usernames})
+        u.id in ({user_ids})
     ''',
-    'TRACKING_DATA_FOR_USERNAMES': '''
+    'TRACKING_DATA_FOR_USER_IDS': '''
         SELECT
-        u.username AS username,
+        ua.user_id AS user_id,
         ua.name AS utm_param_name,
         ua.value AS utm_param_value
 
-        FROM auth_user AS u
-        JOIN student_userattribute AS ua
-        ON ua.user_id = u.id
+        FROM student_userattribute AS ua
         WHERE
         ua.name in (
             "registration_utm_campaign",
@@ -99,12 +182,111 @@ QUERIES = {
             "registration_utm_source",
             "registration_utm_term"
         ) AND
-        u.username in ({usernames})
+        ua.user_id in ({user_ids})
     ''',
+    'USER_PROFILES_FOR_USER_IDS': '''
+        SELECT
+        u.id AS user_id,
+        u.username AS username,
+        LOWER(u.email) AS email,
+        p.name AS full_name,
+        p.country AS country,
+        p.year_of_birth AS year_of_birth,
+        p.level_of_education AS level_of_education,
+        p.goals AS goals,
+        p.gender AS gender,
+        u.date_joined AS registration_date,
+        MAX(up.value) AS language_preference,
+        MAX(CASE WHEN ua.name = "registration_utm_campaign" THEN ua.value END) AS utm_campaign,
+        MAX(CASE WHEN ua.name = "registration_utm_content" THEN ua.value END) AS utm_content,
+        MAX(CASE WHEN ua.name = "registration_utm_medium" THEN ua.value END) AS utm_medium,
+        MAX(CASE WHEN ua.name = "registration_utm_source" THEN ua.value END) AS utm_source,
+        MAX(CASE WHEN ua.name = "registration_utm_term" THEN ua.value END) AS utm_term
+
+        FROM auth_user AS u
+        JOIN auth_userprofile AS p
+        ON p.user_id = u.id
+        LEFT JOIN user_api_userpreference AS up
+        ON up.user_id = u.id AND up.key = "pref-lang"
+        LEFT JOIN student_userattribute AS ua
+        ON ua.user_id = u.id AND ua.name in (
+            "registration_utm_campaign",
+            "registration_utm_content",
+            "registration_utm_medium",
+            "registration_utm_source",
+            "registration_utm_term"
+        )
+        WHERE
+        u.id in ({user_ids})
+        GROUP BY u.id, p.id
+    ''',
+    'WATERMARKS_FOR_ECOMMERCE': '''
+        SELECT
+        MAX(o.date_placed) AS date_placed
+
+        FROM order_order AS o
+    ''',
+    'WATERMARKS_FOR_EDXAPP': '''
+        SELECT
+        (SELECT MAX(u.date_joined) FROM auth_user AS u) AS date_joined,
+        (SELECT MAX(ua.id) FROM student_userattribute AS ua) AS user_attribute_id,
+        (SELECT MAX(up.id) FROM user_api_userpreference AS up) AS user_preference_id
+    ''',
+}
+
+# Conditions added to queries to select only the rows changed since the given watermarks.
+CHANGED_SINCE_FILTERS = {
+    'ORDERS_FOR_ORGS': '''
+        AND o.date_placed > "{date_placed}"
+    ''',
+    'USERS_FOR_SITE': '''
+        AND (
+            u.date_joined > "{date_joined}" OR
+            u.id in (SELECT ua.user_id FROM student_userattribute AS ua WHERE ua.id > {user_attribute_id}) OR
+            u.id in (SELECT up.user_id FROM user_api_userpreference AS up WHERE up.id > {user_preference_id})
+        )
+    ''',
+}
+
+# Watermarks which hold datetimes rather than row IDs.
+DATETIME_WATERMARKS = ('date_joined', 'date_placed')
+
+# Used in place of a datetime watermark of an empty table. Python 2 can't format datetimes
+# before 1900, so datetime.min can't be used.
+EMPTY_DATETIME_WATERMARK = datetime(1900, 1, 1)
+
+# Campaign tracking parameters stored as user attributes at registration.
+UTM_PARAMS = ('utm_campaign', 'utm_content', 'utm_medium', 'utm_source', 'utm_term')
+
+# Campaign tracking parameters by the name of the user attribute they are stored in.
+UTM_PARAMS_BY_ATTRIBUTE = {'registration_{}'.format(utm_param): utm_param for utm_param in UTM_PARAMS}
+
+# Fields added to the user records by munging.
+USER_FIELDS = ('language', 'courses', 'tracking')
+
+# The record type built from the rows of each query, as the name of the record class, the
+# fields added to the rows by munging and the columns whose repeated values are interned.
+QUERY_RECORDS = {
+    'ORDERS_FOR_ORGS': ('Order', ('coupon_codes',), ('username', 'course_id')),
+    'ORDERS_WITH_COUPONS_FOR_ORGS': ('Order', (), ('username', 'course_id')),
+    'COUPON_CODES_FOR_ORDERS': ('Coupon', (), ('coupon_code',)),
+    'LANGUAGE_PREFS_FOR_USER_IDS': ('LanguagePreference', (), ('language_preference',)),
+    'USER_IDS_FOR_USERNAMES': ('UserId', (), ()),
+    'USERS_FOR_SITE': ('SiteUser', (), ()),
+    'USERS_FOR_USER_IDS': ('User', USER_FIELDS, ('country', 'level_of_education', 'gender')),
+    'TRACKING_DATA_FOR_USER_IDS': ('TrackingParameter', (), ('utm_param_name', 'utm_param_value')),
+    'USER_PROFILES_FOR_USER_IDS': (
+        'UserProfile', (), ('country', 'level_of_education', 'gender', 'language_preference') + UTM_PARAMS
+    ),
 }
 
+# Functions called with the name of each query in QUERIES which is run and the number of rows it
+# returned, registered with observe_query_rows.
+_row_observers = []
 
-def fetch_user_data(site_domain, orgs):
+
+def fetch_user_data(site_domain, orgs, batch_size=None, stream=False, parallel=False, single_pass=False,
+                    since=None, snapshot=False):
     """
     Return user data associated with the given site and organizations.
 
@@ -112,9 +294,25 @@ def fetch_user_data(site_domain, orgs):
         site_domain (string): The domain of the site which user data will be fetched for.
         orgs (list of strings): The list of organization names which will be used to find
                                 course purchases and the associated user data.
+        batch_size (int): The maximum number of usernames or user IDs sent in a single query.
+                          If not provided, all of them are sent in one query.
+        stream (bool): If True, return a UserDataStream which fetches and yields the user
+                       data one batch of users at a time instead of a list.
+        parallel (bool): If True, run the independent queries against the edxapp and ecommerce
+                         databases concurrently, each on its own thread and database connection.
+        single_pass (bool): If True, fetch the profile, language preference and campaign tracking
+                            data of the users with a single query returning one row per user.
+        since (dict): Watermarks returned by fetch_watermarks. If provided, only orders placed
+                      after the watermarks and site users who registered or whose attributes or
+                      preferences changed after the watermarks are fetched.
+        snapshot (bool): If True, return the user data stored in the on-disk snapshot of an
+                         earlier extraction for the same site, orgs, since and current watermarks,
+                         if it is younger than the snapshot TTL. Otherwise the fetched user data
+                         is stored in a new snapshot.
 
     Returns:
-        list of dicts, containing the user data.
+        list of records, containing the user data. Records support the same item access
+        as dicts.
 
         Example:
             [{
@@ -122,6 +320,7 @@ def fetch_user_data(site_domain, orgs):
                 'email': 'test@example.com',
                 'country': 'US',
                 'year_of_birth': '1977',
+                'user_id': 10000000L,
                 'username': 'TestUser',
                 'language': 'en',
                 'level_of_education': 'b',
@@ -147,16 +346,218 @@ def fetch_user_data(site_domain, orgs):
                 }]
             }]
     """
-    order_data = _fetch_order_data(orgs)
-    site_users = _fetch_users_for_site(site_domain)
+    if snapshot:
+        path = snapshot_path(site_domain, orgs, since, fetch_watermarks())
+        users = load_snapshot(path)
+        if users is None:
+            users = fetch_user_data(
+                site_domain, orgs, batch_size=batch_size, stream=stream, parallel=parallel,
+                single_pass=single_pass, since=since,
+            )
+            write_snapshot(path, users)
+            # A stream is consumed while it is written, so its users are read back from the snapshot.
+            if stream:
+                users = Snapshot(path)
+        return users
+
+    if stream:
+        return UserDataStream(
+            site_domain,
+            orgs,
+            batch_size=batch_size or DEFAULT_STREAM_BATCH_SIZE,
+            parallel=parallel,
+            single_pass=single_pass,
+            since=since,
+        )
 
-    usernames = {item['username'] for item in order_data + site_users}
+    with _extraction_pool(parallel) as pool:
+        order_data, site_users = _call_all([
+            (_fetch_order_data, (orgs,), {'since': since}),
+            (_fetch_users_for_site, (site_domain,), {'since': since}),
+        ], pool=pool)
 
-    user_data = _fetch_user_data(usernames)
-    language_pref_data = _fetch_language_preference_data(usernames)
-    tracking_data = _fetch_tracking_data(usernames)
+        user_ids = _resolve_user_ids(
+            {user['username']: user['user_id'] for user in site_users}, order_data, batch_size=batch_size
+        )
 
-    return _munge_user_data(user_data, language_pref_data, tracking_data, order_data)
+        return _fetch_munged_user_data(
+            user_ids.values(), order_data, batch_size=batch_size, single_pass=single_pass, pool=pool
+        )
+
+
+def fetch_watermarks():
+    """
+    Return the high-water marks of the data used to select users and orders.
+
+    The watermarks can be passed to fetch_user_data to only fetch the data which
+    changed after they were taken.
+
+    Returns:
+        dict, containing the watermarks.
+
+        Example:
+            {
+                'date_joined': datetime.datetime(2017, 2, 14, 0, 0, 0),
+                'date_placed': datetime.datetime(2017, 2, 14, 0, 0, 0),
+                'user_attribute_id': 20000000L,
+                'user_preference_id': 10000000L
+            }
+    """
+    watermarks = {}
+    for alias, query_name in (('default', 'WATERMARKS_FOR_EDXAPP'), ('ecommerce', 'WATERMARKS_FOR_ECOMMERCE')):
+        with connections[alias].cursor() as cursor:
+            cursor.execute(QUERIES[query_name])
+            rows = _dictfetchall(cursor)
+            _count_rows(query_name, len(rows))
+            watermarks.update(rows[0])
+
+    # Aggregates of datetime columns are returned as strings by some database backends.
+    for key in DATETIME_WATERMARKS:
+        if isinstance(watermarks[key], six.string_types):
+            watermarks[key] = parse_datetime(watermarks[key])
+
+    return watermarks
+
+
+@contextmanager
+def observe_query_rows(observer):
+    """
+    Return a context manager within which the given function is called with the name of each query
+    in QUERIES which is run and the number of rows it returned, from any thread.
+    """
+    _row_observers.append(observer)
+    try:
+        yield
+    finally:
+        _row_observers.remove(observer)
+
+
+class UserDataStream(object):
+    """
+    Iterable over the user data associated with the given site and organizations.
+
+    The usernames, user IDs and course purchases are fetched when the stream is created. The
+    remaining user data is fetched, munged and yielded one batch of users at a time,
+    so only a single batch of user data is held in memory while the stream is consumed.
+    Each yielded user has the same shape as the items returned by fetch_user_data.
+    """
+
+    def __init__(self, site_domain, orgs, batch_size=DEFAULT_STREAM_BATCH_SIZE, parallel=False, single_pass=False,
+                 since=None):
+        self.batch_size = batch_size
+        self.parallel = parallel
+        self.single_pass = single_pass
+
+        with _extraction_pool(parallel) as pool:
+            order_data, site_user_ids = _call_all([
+                (_fetch_order_data, (orgs,), {'since': since}),
+                (_fetch_user_ids_for_site, (site_domain,), {'since': since}),
+            ], pool=pool)
+
+        self._orders_by_username = _group_orders_by_username(order_data)
+        self._user_ids = _resolve_user_ids(site_user_ids, order_data, batch_size=batch_size)
+        self.usernames = sorted(self._user_ids)
+
+    def __len__(self):
+        return len(self.usernames)
+
+    def orders(self):
+        """
+        Return an iterator over the course purchases of the users of the stream. The purchases are
+        fetched when the stream is created, so no user data is extracted to iterate over them.
+        """
+        return (order for username in self.usernames for order in self._orders_by_username.get(username, []))
+
+    def __iter__(self):
+        with _extraction_pool(self.parallel) as pool:
+            for usernames in _chunked(self.usernames, self.batch_size):
+                user_ids = [self._user_ids[username] for username in usernames]
+                order_data = [
+                    order for username in usernames for order in self._orders_by_username.get(username, [])
+                ]
+                for user in _fetch_munged_user_data(user_ids, order_data, single_pass=self.single_pass, pool=pool):
+                    yield user
+
+
+def _call_all(calls, pool=None):
+    """
+    Return the results of the given calls in order.
+
+    Arguments:
+        calls (list of tuples): The (function, args, kwargs) calls to make.
+        pool (ThreadPool): If provided, the calls run concurrently on the threads of
+                           this pool. Otherwise they run one after another.
+    """
+    if pool is None:
+        return [func(*args, **kwargs) for func, args, kwargs in calls]
+
+    results = [pool.apply_async(_call_with_own_connections, call) for call in calls]
+    return [result.get() for result in results]
+
+
+def _call_with_own_connections(func, args, kwargs):
+    """
+    Return the result of the given call, closing the database connections it opened.
+
+    Django database connections are local to each thread, so a call running on a pool
+    thread opens its own connections. They are closed once the call is complete.
+    """
+    try:
+        return func(*args, **kwargs)
+    finally:
+        for alias in EXTRACTION_DATABASES:
+            connections[alias].close()
+
+
+def _changed_filter(query_name, since):
+    """
+    Return the condition which restricts the given query to the rows changed after the
+    given watermarks. No condition is returned if no watermarks are provided.
+    """
+    if since is None:
+        return ''
+
+    values = {}
+    for key in ('date_joined', 'date_placed', 'user_attribute_id', 'user_preference_id'):
+        value = since.get(key)
+        if key in DATETIME_WATERMARKS:
+            value = value or EMPTY_DATETIME_WATERMARK
+            if value.tzinfo is not None:
+                value = value.astimezone(pytz.utc).replace(tzinfo=None)
+            value = value.strftime('%Y-%m-%d %H:%M:%S.%f')
+        values[key] = value or 0
+
+    return CHANGED_SINCE_FILTERS[query_name].format(**values)
+
+
+def _chunked(items, size):
+    """
+    Yield successive lists of at most `size` items. All items are yielded
+    as a single list if no size is provided.
+    """
+    items = list(items)
+    size = size or len(items) or 1
+    for index in range(0, len(items), size):
+        yield items[index:index + size]
+
+
+def _count_rows(query_name, count):
+    """
+    Notify the observers registered with observe_query_rows of the rows returned by the given query.
+    """
+    for observer in list(_row_observers):
+        observer(query_name, count)
+
+
+@contextmanager
+def _closing_cursor(cursor):
+    """
+    Close the given DB-API cursor when the context exits.
+    """
+    try:
+        yield cursor
+    finally:
+        cursor.close()
 
 
 def _dictfetchall(cursor):
@@ -170,12 +571,34 @@ def _dictfetchall(cursor):
     ]
 
 
-def _fetch_coupon_data(order_ids):
+@contextmanager
+def _extraction_pool(parallel):
+    """
+    Return a context manager for the thread pool used to run extraction queries concurrently.
+    No pool is provided if the queries should run one after another.
+    """
+    if not parallel:
+        yield None
+        return
+
+    pool = ThreadPool(EXTRACTION_THREADS)
+    try:
+        yield pool
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _fetch_coupon_data(order_ids, batch_size=None):
     """
     Return any coupon codes associated with the given order IDs.
 
+    The order IDs are sent in slices of at most `batch_size` IDs.
+
     Arguments:
         order_ids (list of strings): The order IDs for which to find coupon codes.
+        batch_size (int): The maximum number of order IDs sent in a single query.
+                          Defaults to COUPON_BATCH_SIZE.
 
     Returns:
         list of dicts, containing the coupon data.
@@ -188,48 +611,125 @@ def _fetch_coupon_data(order_ids):
     """
     coupon_data = []
     with connections['ecommerce'].cursor() as cursor:
-        cursor.execute(QUERIES['COUPON_CODES_FOR_ORDERS'].format(orders=','.join(order_ids)))
-        coupon_data = _dictfetchall(cursor)
+        for chunk in _chunked(order_ids, batch_size or COUPON_BATCH_SIZE):
+            cursor.execute(QUERIES['COUPON_CODES_FOR_ORDERS'].format(orders=','.join(chunk)))
+            coupon_data.extend(_fetch_records(cursor, 'COUPON_CODES_FOR_ORDERS'))
     return coupon_data
 
 
-def _fetch_language_preference_data(usernames):
+def _fetch_for_user_ids(query_name, user_ids, batch_size=None):
+    """
+    Return the rows of a query against the edxapp database for the given user IDs.
+
+    Arguments:
+        query_name (string): The key of the query in QUERIES. The query must accept
+                             a `user_ids` format argument.
+        user_ids (list of ints): The IDs of the users to fetch data for.
+        batch_size (int): The maximum number of user IDs sent in a single query.
+
+    Returns:
+        list of dicts, containing the rows of all slices.
+    """
+    return _fetch_in_slices('user_ids', query_name, [str(int(user_id)) for user_id in user_ids], batch_size)
+
+
+def _fetch_for_usernames(query_name, usernames, batch_size=None):
+    """
+    Return the rows of a query against the edxapp database for the given users.
+
+    Arguments:
+        query_name (string): The key of the query in QUERIES. The query must accept
+                             a `usernames` format argument.
+        usernames (list of strings): The usernames to fetch data for.
+        batch_size (int): The maximum number of usernames sent in a single query.
+
+    Returns:
+        list of dicts, containing the rows of all slices.
+    """
+    return _fetch_in_slices('usernames', query_name, ['"{}"'.format(u) for u in usernames], batch_size)
+
+
+def _fetch_in_slices(argument, query_name, values, batch_size):
+    """
+    Return the rows of a query against the edxapp database for the given SQL values.
+
+    The values are sent in slices of at most `batch_size` values so that a single
+    statement never grows with the total number of users. The rows returned for
+    each slice are merged in order.
+    """
+    rows = []
+    with connections['default'].cursor() as cursor:
+        for chunk in _chunked(values, batch_size):
+            cursor.execute(QUERIES[query_name].format(**{argument: ','.join(chunk)}))
+            rows.extend(_fetch_records(cursor, query_name))
+    return rows
+
+
+def _fetch_language_preference_data(user_ids, batch_size=None):
     """
     Return language preference data for the given users.
 
     Arguments:
-        usernames (list of strings): The usernames to fetch language preference data for.
+        user_ids (list of ints): The IDs of the users to fetch language preference data for.
+        batch_size (int): The maximum number of user IDs sent in a single query.
 
     Returns:
         list of dicts, containing the language preference data.
 
         Example:
             [{
-                'username': 'TestUser',
+                'user_id': 10000000L,
                 'language_preference': 'en'
             },{
-                'username': 'TestUser',
+                'user_id': 10000000L,
                 'language_preference': 'ar'
             }]
     """
-    language_pref_data = []
-    with connections['default'].cursor() as cursor:
-        cursor.execute(
-            QUERIES['LANGUAGE_PREFS_FOR_USERNAMES'].format(usernames=','.join(['"{}"'.format(u) for u in usernames]))
-        )
-        language_pref_data = _dictfetchall(cursor)
-    return language_pref_data
+    return _fetch_for_user_ids('LANGUAGE_PREFS_FOR_USER_IDS', user_ids, batch_size=batch_size)
 
 
-def _fetch_order_data(orgs):
+def _fetch_munged_user_data(user_ids, order_data, batch_size=None, single_pass=False, pool=None):
+    """
+    Return the munged user data for the given users and their course purchases.
+
+    Arguments:
+        user_ids (list of ints): The IDs of the users to fetch data for.
+        order_data (list of dicts): The course purchases of the users.
+        batch_size (int): The maximum number of user IDs sent in a single query.
+        single_pass (bool): If True, fetch the data with USER_PROFILES_FOR_USER_IDS.
+                            Otherwise run the profile, language preference and campaign
+                            tracking queries separately.
+        pool (ThreadPool): If provided, the separate queries run concurrently on this pool.
+
+    Returns:
+        list of dicts, containing the user data in the format returned by fetch_user_data.
+    """
+    user_ids = sorted(user_ids)
+    if single_pass:
+        profile_data = _fetch_user_profile_data(user_ids, batch_size=batch_size)
+        return _munge_user_profile_data(profile_data, order_data)
+
+    user_data, language_pref_data, tracking_data = _call_all([
+        (_fetch_user_data, (user_ids,), {'batch_size': batch_size}),
+        (_fetch_language_preference_data, (user_ids,), {'batch_size': batch_size}),
+        (_fetch_tracking_data, (user_ids,), {'batch_size': batch_size}),
+    ], pool=pool)
+    return _munge_user_data(user_data, language_pref_data, tracking_data, order_data)
+
+
+def _fetch_order_data(orgs, since=None):
     """
     Return order data associated with the given organizations.
 
     An order is associated with an organization if the order contains a product
     that is associated with a course under that organization.
 
+    The coupon codes of the orders are aggregated by the order query where the database
+    supports GROUP_CONCAT. Otherwise they are fetched with separate queries.
+
     Arguments:
         orgs (list of strings): The list of organization names which will be used to find order data.
+        since (dict): If provided, only orders placed after these watermarks are returned.
 
     Returns:
         list of dicts, containing the order data.
@@ -246,53 +746,90 @@ def _fetch_order_data(orgs):
                 'username': u'TestUser'
             }]
     """
-    order_data = []
-    with connections['ecommerce'].cursor() as cursor:
-        cursor.execute(QUERIES['ORDERS_FOR_ORGS'].format(orgs='|'.join(orgs)))
-        order_data = _dictfetchall(cursor)
+    connection = connections['ecommerce']
+    if connection.vendor in GROUP_CONCAT_VENDORS:
+        query_name = 'ORDERS_WITH_COUPONS_FOR_ORGS'
+    else:
+        query_name = 'ORDERS_FOR_ORGS'
 
-    order_ids = [str(order['order_id']) for order in order_data]
+    order_data = []
+    with connection.cursor() as cursor:
+        if query_name == 'ORDERS_WITH_COUPONS_FOR_ORGS' and connection.vendor == 'mysql':
+            cursor.execute('SET SESSION group_concat_max_len = {length}'.format(length=GROUP_CONCAT_MAX_LEN))
+        cursor.execute(QUERIES[query_name].format(
+            org_filter=_org_filter(orgs),
+            changed_filter=_changed_filter('ORDERS_FOR_ORGS', since),
+            coupon_codes=COUPON_CODES_AGGREGATES.get(connection.vendor),
+        ))
+        order_data = _fetch_records(cursor, query_name)
+
+    if query_name == 'ORDERS_WITH_COUPONS_FOR_ORGS':
+        return _split_coupon_codes(order_data)
+
+    order_ids = sorted({str(order['order_id']) for order in order_data})
     coupon_data = _fetch_coupon_data(order_ids)
 
     return _munge_order_data(order_data, coupon_data)
 
 
-def _fetch_tracking_data(usernames):
+def _fetch_records(cursor, query_name):
+    """
+    Return each row from a cursor as a compact record.
+
+    The record class is built once per query from the cursor description. Repeated
+    values of the interned columns of the query share a single string object.
+    """
+    record_name, extra_fields, interned_columns = QUERY_RECORDS[query_name]
+    columns = [col[0] for col in cursor.description]
+    record = record_class(record_name, columns + list(extra_fields))
+
+    interned_positions = [columns.index(column) for column in interned_columns if column in columns]
+    interned_values = {}
+    records = []
+    for row in cursor.fetchall():
+        if interned_positions:
+            row = list(row)
+            for position in interned_positions:
+                value = row[position]
+                if value is not None:
+                    row[position] = interned_values.setdefault(value, value)
+        records.append(record(row))
+    _count_rows(query_name, len(records))
+    return records
+
+
+def _fetch_tracking_data(user_ids, batch_size=None):
     """
     Return campaign tracking data for the given users.
 
     Arguments:
-        usernames (list of strings): The usernames to fetch tracking data for.
+        user_ids (list of ints): The IDs of the users to fetch tracking data for.
+        batch_size (int): The maximum number of user IDs sent in a single query.
 
     Returns:
         list of dicts, containing the campaign tracking data.
 
         Example:
             [{
-                'username': 'TestUser',
+                'user_id': 10000000L,
                 'utm_param_name': 'registration_utm_campaign',
                 'utm_param_value': 'test'
             },{
-                'username': 'TestUser',
+                'user_id': 10000000L,
                 'utm_param_name': 'registration_utm_source',
                 'utm_param_value': 'test'
             }]
     """
-    tracking_data = []
-    with connections['default'].cursor() as cursor:
-        cursor.execute(
-            QUERIES['TRACKING_DATA_FOR_USERNAMES'].format(usernames=','.join(['"{}"'.format(u) for u in usernames]))
-        )
-        tracking_data = _dictfetchall(cursor)
-    return tracking_data
+    return _fetch_for_user_ids('TRACKING_DATA_FOR_USER_IDS', user_ids, batch_size=batch_size)
 
 
-def _fetch_user_data(usernames):
+def _fetch_user_data(user_ids, batch_size=None):
     """
     Return user data for the given users.
 
     Arguments:
-        usernames (list of strings): The usernames to fetch data for.
+        user_ids (list of ints): The IDs of the users to fetch data for.
+        batch_size (int): The maximum number of user IDs sent in a single query.
 
     Returns:
         list of dicts, containing the user data.
@@ -303,6 +840,7 @@ def _fetch_user_data(usernames):
                 'email': 'test@example.com',
                 'country': 'US',
                 'year_of_birth': '1977',
+                'user_id': 10000000L,
                 'username': 'TestUser',
                 'level_of_education': 'b',
                 'goals': 'Learn about foo',
@@ -310,37 +848,129 @@ def _fetch_user_data(usernames):
                 'registration_date': datetime.datetime(2016, 2, 14, 0, 0, 0)
             }]
     """
-    user_data = []
-    with connections['default'].cursor() as cursor:
-        cursor.execute(
-            QUERIES['USERS_FOR_USERNAMES'].format(usernames=','.join(['"{}"'.format(u) for u in usernames]))
-        )
-        user_data = _dictfetchall(cursor)
-    return user_data
+    return _fetch_for_user_ids('USERS_FOR_USER_IDS', user_ids, batch_size=batch_size)
+
+
+def _fetch_user_ids(usernames, batch_size=None):
+    """
+    Return a dict mapping the given usernames to the IDs of the edxapp users.
+    Usernames without an edxapp user account are left out.
+    """
+    return {
+        row['username']: row['user_id']
+        for row in _fetch_for_usernames('USER_IDS_FOR_USERNAMES', usernames, batch_size=batch_size)
+    }
+
+
+def _fetch_user_ids_for_site(site_domain, since=None):
+    """
+    Return a dict mapping the usernames of users whose accounts were created on the
+    given site to their user IDs.
+
+    Unlike _fetch_users_for_site, the rows are read from a server-side cursor, so
+    no intermediate list of rows is built.
+    """
+    user_ids = {
+        row['username']: row['user_id'] for row in _iter_rows('default', QUERIES['USERS_FOR_SITE'].format(
+            site_domain=site_domain,
+            changed_filter=_changed_filter('USERS_FOR_SITE', since),
+        ))
+    }
+    _count_rows('USERS_FOR_SITE', len(user_ids))
+    return user_ids
+
+
+def _fetch_user_profile_data(user_ids, batch_size=None):
+    """
+    Return profile, language preference and campaign tracking data for the given users.
 
+    Unlike _fetch_user_data, _fetch_language_preference_data and _fetch_tracking_data,
+    the data is fetched with a single query which returns exactly one row per user.
 
-def _fetch_users_for_site(site_domain):
+    Arguments:
+        user_ids (list of ints): The IDs of the users to fetch data for.
+        batch_size (int): The maximum number of user IDs sent in a single query.
+
+    Returns:
+        list of dicts, containing the user profile data.
+
+        Example:
+            [{
+                'full_name': 'Test User',
+                'email': 'test@example.com',
+                'country': 'US',
+                'year_of_birth': '1977',
+                'user_id': 10000000L,
+                'username': 'TestUser',
+                'level_of_education': 'b',
+                'goals': 'Learn about foo',
+                'gender': 'f',
+                'registration_date': datetime.datetime(2016, 2, 14, 0, 0, 0),
+                'language_preference': 'en',
+                'utm_campaign': 'test',
+                'utm_content': None,
+                'utm_medium': 'test',
+                'utm_source': 'test',
+                'utm_term': None
+            }]
+    """
+    return _fetch_for_user_ids('USER_PROFILES_FOR_USER_IDS', user_ids, batch_size=batch_size)
+
+
+def _fetch_users_for_site(site_domain, since=None):
     """
     Return users whose accounts were created on the given site.
 
     Arguments:
         site_domain (string): The domain of the site to find users for.
+        since (dict): If provided, only users who registered or whose attributes or
+                      preferences changed after these watermarks are returned.
 
     Returns:
-        list of dicts, containing the user's usernames.
+        list of dicts, containing the user's IDs and usernames.
 
         Example:
             [{
+                'user_id': 10000000L,
                 'username': u'TestUser'
             }]
     """
     users = []
     with connections['default'].cursor() as cursor:
-        cursor.execute(QUERIES['USERS_FOR_SITE'].format(site_domain=site_domain))
-        users = _dictfetchall(cursor)
+        cursor.execute(QUERIES['USERS_FOR_SITE'].format(
+            site_domain=site_domain,
+            changed_filter=_changed_filter('USERS_FOR_SITE', since),
+        ))
+        users = _fetch_records(cursor, 'USERS_FOR_SITE')
     return users
 
 
+def _group_orders_by_username(order_data):
+    """
+    Return a dict mapping each username to the list of that user's orders.
+    """
+    orders_by_username = defaultdict(list)
+    for order in order_data:
+        username = order['username']
+        orders_by_username[username].append(order)
+    return orders_by_username
+
+
+def _iter_rows(alias, sql):
+    """
+    Yield each row of the given query as a dict, reading the rows from a
+    server-side cursor in slices of STREAM_FETCH_SIZE rows.
+    """
+    with _server_side_cursor(alias) as cursor:
+        cursor.execute(sql)
+        columns = [col[0] for col in cursor.description]
+        rows = cursor.fetchmany(STREAM_FETCH_SIZE)
+        while rows:
+            for row in rows:
+                yield dict(zip(columns, row))
+            rows = cursor.fetchmany(STREAM_FETCH_SIZE)
+
+
 def _munge_order_data(order_data, coupon_data):
     """
     Return the order data with associated coupon codes added to each order.
@@ -362,28 +992,136 @@ def _munge_user_data(user_data, language_pref_data, tracking_data, order_data):
     """
     Return user data with associated course purchase data added to each user.
     """
-    orders_by_username = defaultdict(list)
-    for order in order_data:
-        username = order['username']
-        orders_by_username[username].append(order)
+    orders_by_username = _group_orders_by_username(order_data)
 
-    language_prefs_by_username = defaultdict(set)
+    language_prefs_by_user_id = defaultdict(set)
     for item in language_pref_data:
-        username = item['username']
+        user_id = item['user_id']
         language_pref = item['language_preference']
-        language_prefs_by_username[username].add(language_pref)
+        language_prefs_by_user_id[user_id].add(language_pref)
 
-    tracking_by_username = defaultdict(dict)
+    tracking_by_user_id = defaultdict(dict)
     for item in tracking_data:
-        username = item['username']
-        utm_param_name = item['utm_param_name'].replace('registration_', '')
+        user_id = item['user_id']
+        utm_param_name = UTM_PARAMS_BY_ATTRIBUTE[item['utm_param_name']]
         utm_param_value = item['utm_param_value']
-        tracking_by_username[username][utm_param_name] = utm_param_value
+        tracking_by_user_id[user_id][utm_param_name] = utm_param_value
 
     for user in user_data:
-        username = user['username']
-        user['language'] = language_prefs_by_username.get(username, set([None])).pop()
-        user['courses'] = orders_by_username.get(username, [])
-        user['tracking'] = tracking_by_username.get(username, {})
+        user_id = user['user_id']
+        user['language'] = language_prefs_by_user_id.get(user_id, set([None])).pop()
+        user['courses'] = orders_by_username.get(user['username'], [])
+        user['tracking'] = tracking_by_user_id.get(user_id, {})
 
     return user_data
+
+
+def _munge_user_profile_data(profile_data, order_data):
+    """
+    Return user data built from single-pass profile rows, with associated course
+    purchase data added to each user.
+
+    The user data has the same format as the data returned by _munge_user_data.
+    Campaign tracking parameters which are not set for a user are left out.
+    """
+    orders_by_username = _group_orders_by_username(order_data)
+
+    user_data = []
+    user = None
+    for profile in profile_data:
+        if user is None:
+            profile_fields = [
+                field for field in profile.keys() if field != 'language_preference' and field not in UTM_PARAMS
+            ]
+            user = record_class('User', profile_fields + list(USER_FIELDS))
+
+        tracking = {}
+        for utm_param in UTM_PARAMS:
+            utm_param_value = profile[utm_param]
+            if utm_param_value is not None:
+                tracking[utm_param] = utm_param_value
+
+        user_data.append(user(
+            [profile[field] for field in profile_fields],
+            language=profile['language_preference'],
+            courses=orders_by_username.get(profile['username'], []),
+            tracking=tracking,
+        ))
+
+    return user_data
+
+
+def _org_filter(orgs):
+    """
+    Return the SQL condition which selects the products of courses under the given organizations.
+
+    Each organization is matched with a prefix `LIKE` on the course ID rather than a regular
+    expression, which allows MySQL to use a range scan on an index of `catalogue_product.course_id`.
+    LIKE wildcards in the organization names are escaped so they are matched literally.
+    """
+    conditions = []
+    for org in orgs:
+        prefix = 'course-v1:{org}'.format(org=org)
+        for char in (LIKE_ESCAPE, '%', '_'):
+            prefix = prefix.replace(char, LIKE_ESCAPE + char)
+        conditions.append('p.course_id LIKE "{prefix}%" ESCAPE "{escape}"'.format(prefix=prefix, escape=LIKE_ESCAPE))
+    return '({conditions})'.format(conditions=' OR '.join(conditions))
+
+
+def _resolve_user_ids(user_ids, order_data, batch_size=None):
+    """
+    Return a dict mapping the usernames of the given users and of the users who placed the
+    given orders to their edxapp user IDs.
+
+    Ecommerce users are only known by username. The usernames of those which are not already
+    in `user_ids` are resolved to edxapp user IDs with a single lookup, after which all edxapp
+    data is queried by user ID.
+
+    Arguments:
+        user_ids (dict): Maps the usernames of users whose IDs are already known to their IDs.
+        order_data (list of dicts): The course purchases of the users.
+        batch_size (int): The maximum number of usernames sent in a single query.
+    """
+    user_ids = dict(user_ids)
+    unresolved_usernames = {order['username'] for order in order_data}.difference(user_ids)
+    if unresolved_usernames:
+        user_ids.update(_fetch_user_ids(sorted(unresolved_usernames), batch_size=batch_size))
+    return user_ids
+
+
+def _split_coupon_codes(order_data):
+    """
+    Return the order data with the coupon codes aggregated by GROUP_CONCAT split into
+    the same lists of distinct codes as the ones added by _munge_order_data. The codes
+    of the orders whose aggregated codes may have been truncated are fetched with
+    separate queries instead.
+    """
+    truncated = []
+    for order in order_data:
+        coupon_codes = order['coupon_codes']
+        if coupon_codes and len(coupon_codes.encode('utf-8')) >= GROUP_CONCAT_MAX_LEN:
+            truncated.append(order)
+        order['coupon_codes'] = list(set(coupon_codes.split(COUPON_CODE_SEPARATOR))) if coupon_codes else []
+
+    if truncated:
+        order_ids = sorted({str(order['order_id']) for order in truncated})
+        _munge_order_data(truncated, _fetch_coupon_data(order_ids))
+    return order_data
+
+
+def _server_side_cursor(alias):
+    """
+    Return a context manager for a cursor which keeps query results on the database server.
+
+    MySQL cursors buffer the complete result set on the client by default. An unbuffered
+    cursor is used for MySQL databases instead, so rows are only transferred as they are
+    fetched. Other database backends use a regular cursor.
+    """
+    connection = connections[alias]
+    if connection.vendor != 'mysql':
+        return connection.cursor()
+
+    from MySQLdb.cursors import SSCursor  # pylint: disable=import-error
+
+    connection.ensure_connection()
+    return _closing_cursor(connection.connection.cursor(SSCursor))
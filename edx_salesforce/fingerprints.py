@@ -0,0 +1,81 @@
+"""
+Provides a local store of the fingerprints of the user data last synchronized with Salesforce.
+
+A fingerprint is a digest of the normalized Lead or Contact fields and the course purchases
+of a user. Users whose data has the same fingerprint as the data last synchronized with
+Salesforce are known to be in sync, so they can be skipped without any Salesforce request.
+Fingerprints are stored in a SQLite database in the state directory, one per Salesforce org.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import sqlite3
+
+from edx_salesforce.state import org_key, state_path
+
+# Maximum number of usernames in a single query, below the SQLite limit of 999 variables.
+FINGERPRINT_QUERY_SIZE = 500
+
+
+class FingerprintStore(object):
+    """
+    Store of the fingerprints of the synchronized users, by username.
+
+    Arguments:
+        path (string): The path of the SQLite database the fingerprints are stored in.
+    """
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS fingerprint (username TEXT PRIMARY KEY, fingerprint TEXT NOT NULL)'
+            )
+
+    def get_many(self, usernames):
+        """
+        Return the stored fingerprints of the given users, by username. Users without a
+        stored fingerprint are left out.
+        """
+        fingerprints = {}
+        usernames = list(usernames)
+        for index in range(0, len(usernames), FINGERPRINT_QUERY_SIZE):
+            batch = usernames[index:index + FINGERPRINT_QUERY_SIZE]
+            fingerprints.update(self.connection.execute(
+                'SELECT username, fingerprint FROM fingerprint WHERE username IN ({params})'.format(
+                    params=', '.join('?' * len(batch))
+                ),
+                batch,
+            ))
+        return fingerprints
+
+    def set_many(self, fingerprints):
+        """
+        Store the given fingerprints, by username.
+        """
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO fingerprint (username, fingerprint) VALUES (?, ?)', fingerprints.items()
+            )
+
+    def delete_many(self, usernames):
+        """
+        Delete the stored fingerprints of the given users.
+        """
+        with self.connection:
+            self.connection.executemany(
+                'DELETE FROM fingerprint WHERE username = ?', [(username,) for username in usernames]
+            )
+
+    def close(self):
+        """
+        Close the SQLite database.
+        """
+        self.connection.close()
+
+
+def fingerprint_store_path(alias='salesforce'):
+    """
+    Return the path of the fingerprint store of the Salesforce org configured for the given database.
+    """
+    return state_path('fingerprints', '{org}.sqlite3'.format(org=org_key(alias)))
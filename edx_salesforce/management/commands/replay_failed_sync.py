@@ -0,0 +1,50 @@
+"""Django command for synchronizing again the users which sync_salesforce failed to synchronize."""
+
+from __future__ import absolute_import, unicode_literals
+
+from collections import OrderedDict
+
+from edx_salesforce.management.commands.sync_salesforce import Command as SyncSalesforceCommand
+from edx_salesforce.state import read_journal, write_journal
+
+
+class Command(SyncSalesforceCommand):
+    """
+    This command synchronizes again the users which the sync_salesforce command, run with --dead-letter,
+    failed to synchronize for the given site and organizations. The users are synchronized with the
+    user data recorded when they failed, using the same synchronization options as sync_salesforce.
+
+    Users which are synchronized are removed from the dead-letter journal, while users which fail
+    again are recorded with their new error, to be replayed by the next run of this command.
+    """
+    help = 'Synchronize again the users which sync_salesforce failed to synchronize for the given site/organization'
+
+    def add_extraction_arguments(self, parser):
+        """
+        Replayed users are read from the dead-letter journal rather than extracted, so this command
+        has no extraction options.
+        """
+
+    def handle(self, *args, **options):
+        site_domain = options['site_domain']
+        orgs = options['orgs']
+        self._configure(site_domain, orgs, dict(options, dead_letter=True))
+
+        with self.export_metrics(options):
+            # Users may have failed more than once, in which case their latest data is replayed.
+            dead_letters = read_journal(self.dead_letter_path)
+            users = list(OrderedDict((letter['username'], letter['user']) for letter in dead_letters).values())
+
+            if not users:
+                self.stdout.write(
+                    'No failed user accounts to replay for site {site} and orgs {orgs}...'.format(
+                        site=site_domain,
+                        orgs=','.join(orgs),
+                    )
+                )
+                return
+
+            self._sync_and_report(users, site_domain, orgs)
+
+            # Only the users which failed again, recorded by this run, remain to be replayed.
+            write_journal(self.dead_letter_path, read_journal(self.dead_letter_path)[len(dead_letters):])
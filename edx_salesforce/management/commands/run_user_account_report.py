@@ -12,6 +12,8 @@ from django.core.management.base import BaseCommand
 
 from edx_salesforce.choices import COUNTRIES_BY_CODE, EDUCATION_BY_CODE
 from edx_salesforce.edx_data import fetch_user_data
+from edx_salesforce.management.mixins import MetricsExportMixin, UserDataExtractionMixin
+from edx_salesforce.stats import RunStats
 
 REPORT_HEADER = [
     'Email',
@@ -31,8 +33,11 @@ REPORT_HEADER = [
     'Course Runs',
 ]
 
+# Status of the users written to the report, in the metrics of the run.
+STATUS_REPORTED = 'REPORTED'
 
-class Command(BaseCommand):
+
+class Command(UserDataExtractionMixin, MetricsExportMixin, BaseCommand):
     """
     This command creates a CSV report containing user account data related to the given
     site and organizations. The organizations provided are used to find ecommerce orders
@@ -60,12 +65,23 @@ class Command(BaseCommand):
                 'course purchases associated with those organizations'
             )
         )
+        self.add_metrics_arguments(parser)
+        self.add_extraction_arguments(parser)
 
     def handle(self, *args, **options):
+        self.stats = RunStats()
+        with self.export_metrics(options):
+            self._run_report(options)
+
+    def _run_report(self, options):
+        """
+        Writes the CSV report of the user account data of the site and organizations of the given options.
+        """
         site_domain = options['site_domain']
         orgs = options['orgs']
 
-        users = fetch_user_data(site_domain, orgs)
+        with self.stats.phase('extraction'):
+            users = fetch_user_data(site_domain, orgs, **self.get_extraction_kwargs(options))
 
         if not users:
             self.stdout.write(
@@ -74,6 +90,7 @@ class Command(BaseCommand):
                     orgs=','.join(orgs),
                 )
             )
+            self.save_extraction_watermarks(options)
             return
 
         total_users = len(users)
@@ -98,7 +115,7 @@ class Command(BaseCommand):
             timestamp=time.strftime('%Y%m%d-%H%M%S')
         )
 
-        with open(output_filename, 'wb') as csvfile:  # pylint: disable=open-builtin
+        with self.stats.phase('report'), open(output_filename, 'wb') as csvfile:  # pylint: disable=open-builtin
             writer = csv.writer(csvfile, delimiter=str(','))
             writer.writerow(REPORT_HEADER)
             for user in users:
@@ -119,6 +136,7 @@ class Command(BaseCommand):
                     user['tracking'].get('utm_term', ''),
                     ' '.join([c['course_id'] for c in user['courses']]),
                 ])
+                self.stats.count_users(STATUS_REPORTED)
 
         self.stdout.write(
             'Finished running user account report for {total_users} user{pluralize_total_users} '
@@ -130,6 +148,7 @@ class Command(BaseCommand):
                 pluralize_orgs=pluralize_orgs,
             )
         )
+        self.save_extraction_watermarks(options)
 
     def _output_dir(self):
         """
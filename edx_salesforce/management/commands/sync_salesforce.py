@@ -2,29 +2,79 @@
 
 from __future__ import absolute_import, unicode_literals
 
+import os
+import random
+import threading
+import time
 import traceback
 from collections import OrderedDict, defaultdict
-from itertools import izip
+from contextlib import contextmanager
+from functools import partial
+from itertools import islice, izip
+from multiprocessing.pool import ThreadPool
 
 import pytz
+from salesforce.backend.driver import SalesforceError
 from salesforce.utils import convert_lead
 
 from django.conf import settings
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 
+from edx_salesforce.bulk import BulkApiClient
 from edx_salesforce.choices import COUNTRIES_BY_CODE, EDUCATION_BY_CODE
-from edx_salesforce.edx_data import fetch_user_data
-from edx_salesforce.models import (Campaign, CampaignMember, Contact, DiscountCode, Lead, Opportunity,
+from edx_salesforce.edx_data import UserDataStream, fetch_user_data
+from edx_salesforce.fingerprints import FingerprintStore, fingerprint_store_path
+from edx_salesforce.management.mixins import MetricsExportMixin, UserDataExtractionMixin
+from edx_salesforce.models import (Account, Campaign, CampaignMember, Contact, DiscountCode, Lead, Opportunity,
                                    OpportunityContactRole, OpportunityLineItem, Pricebook2, PricebookEntry, Product2)
-from edx_salesforce.utils import parse_user_full_name
+from edx_salesforce.reference_cache import ReferenceCache, reference_cache_path
+from edx_salesforce.sobject_collections import COLLECTION_SIZE, SObjectCollectionsClient, WriteBuffer
+from edx_salesforce.state import (append_journal, checkpoint_path, dead_letter_path, read_journal, value_digest,
+                                  write_state)
+from edx_salesforce.stats import RunStats
+from edx_salesforce.throttling import RequestScheduler, is_throttled_error
+from edx_salesforce.utils import convert_leads, is_stale_reference_error, is_transient_error, parse_user_full_name
 
 
 STATUS_IN_SYNC = 'In Sync'
 STATUS_SYNCHRONIZED = 'SYNCHRONIZED'
 STATUS_FAILED = 'FAILED'
 
+# Number of users whose Salesforce objects are loaded by each prefetch query.
+PREFETCH_BATCH_SIZE = 200
 
-class Command(BaseCommand):
+# Number of users whose Leads and Contacts are upserted by each round of Bulk API jobs.
+BULK_BATCH_SIZE = 10000
+
+# Number of Leads converted by each call to the SOAP API convertLead() endpoint.
+CONVERSION_BATCH_SIZE = 200
+
+# Lead fields holding the UTM parameters a new Lead was created with.
+UTM_FIELDS = ('pi_utm_campaign', 'pi_utm_content', 'pi_utm_medium', 'pi_utm_source', 'pi_utm_term')
+
+# Custom fields copied from a Lead to the Contact it is converted to.
+CONVERTED_CONTACT_FIELDS = ('language', 'country', 'year_of_birth') + UTM_FIELDS
+
+# Opportunity fields the Opportunities of a course purchase are looked up by, besides the Account.
+OPPORTUNITY_LOOKUP_FIELDS = ('name', 'amount', 'close_date', 'paid_date', 'stage_name')
+
+# Number of users synchronized between checkpoints, unless set by the EDX_SALESFORCE_CHECKPOINT_INTERVAL
+# setting. Checkpoints are written once the batch of the last user is complete.
+DEFAULT_CHECKPOINT_INTERVAL = 1000
+
+# Models of the reference objects whose IDs are recorded by checkpoints.
+CHECKPOINT_MODELS = (Campaign, DiscountCode, PricebookEntry, Product2)
+
+# Number of times the synchronization of a user is retried after a transient error, unless set by the
+# EDX_SALESFORCE_SYNC_RETRIES setting, and the number of seconds the first retry is delayed by at most.
+DEFAULT_SYNC_RETRIES = 3
+SYNC_RETRY_DELAY = 1
+
+# Returned by _sync_purchases for users whose Lead is converted with the other Leads of their batch.
+CONVERSION_PENDING = object()
+
+
+class Command(UserDataExtractionMixin, MetricsExportMixin, BaseCommand):
     """
     This command synchronizes Open EdX user account and associated course purchase data with Salesforce
     for the given site and organizations. The organizations provided are used to find ecommerce orders
@@ -44,6 +94,62 @@ class Command(BaseCommand):
 
         self.pricebook = Pricebook2.objects.get(is_standard=True)
         self.cache = defaultdict(dict)
+        self.prefetch = False
+        self.bulk_client = None
+        self.writes = None
+        self.workers = 1
+        self.batch_conversions = False
+        self.plan_pricebook = False
+
+        # Fingerprints of the user data last synchronized, and whether users with an unchanged
+        # fingerprint are compared with Salesforce anyway.
+        self.fingerprints = None
+        self.verify = False
+
+        # Path of the checkpoint journal of this run, the statuses of the users synchronized since
+        # the last checkpoint, by username, and the reference objects recorded by the journal.
+        self.checkpoint_path = None
+        self.checkpoint_statuses = {}
+        self.checkpoint_references = set()
+
+        # Scheduler throttling the Salesforce requests of the command, if any.
+        self.scheduler = None
+
+        # Phase times, API request counts and user latencies of the run, whether they are output with the
+        # summary, the path of the JSON file they are written to, if any, and whether API requests are counted.
+        self.stats = RunStats()
+        self.report_stats = False
+        self.stats_file = None
+        self.count_requests = False
+
+        # Errors of the users which failed to synchronize in the current batch, by username, and the path
+        # of the journal the failed users are recorded in, if any.
+        self.errors = {}
+        self.dead_letter_path = None
+
+        # Users and Leads whose conversion was deferred to the end of the batch.
+        self.pending_conversions = []
+
+        # Locks which keep workers from creating the same Salesforce object twice, by model name and key.
+        self.locks = {}
+        self.locks_lock = threading.Lock()
+
+        # Prefetched Leads by lower case username, converted Contacts by ID, and Opportunities by
+        # Account ID and OPPORTUNITY_LOOKUP_FIELDS values.
+        self.leads = None
+        self.converted_contacts = {}
+        self.opportunities = None
+
+        # Salesforce IDs of reference objects cached by earlier runs, the lookups of the cached objects
+        # used by this run which haven't been looked up again, by model name and key, and the cached
+        # objects used by the user each worker is synchronizing.
+        self.reference_cache = None
+        self.loaded_references = {}
+        self.used_references = threading.local()
+
+        # Number of child objects created for the Salesforce objects whose children are not all created yet,
+        # by model name and key, so a retried synchronization creates the remaining ones.
+        self.unfinished_children = {}
 
     def add_arguments(self, parser):
         parser.add_argument(
@@ -64,27 +170,263 @@ class Command(BaseCommand):
                 'course purchases associated with those organizations'
             )
         )
+        parser.add_argument(
+            '--prefetch',
+            dest='prefetch',
+            action='store_true',
+            default=False,
+            help=(
+                'Load the existing Salesforce objects of each batch of {batch_size} users with a few '
+                'paged queries instead of looking them up one user at a time.'.format(batch_size=PREFETCH_BATCH_SIZE)
+            )
+        )
+        parser.add_argument(
+            '--bulk',
+            dest='bulk',
+            action='store_true',
+            default=False,
+            help=(
+                'Upsert the Leads and Contacts of each batch of {batch_size} users with Salesforce Bulk API 2.0 '
+                'jobs instead of saving them one user at a time. Implies --prefetch.'.format(batch_size=BULK_BATCH_SIZE)
+            )
+        )
+        parser.add_argument(
+            '--collections',
+            dest='collections',
+            action='store_true',
+            default=False,
+            help=(
+                'Buffer the writes of Leads, Contacts, CampaignMembers, OpportunityContactRoles and '
+                'OpportunityLineItems and send them in sObject Collections requests of up to {size} '
+                'records instead of a request per object.'.format(size=COLLECTION_SIZE)
+            )
+        )
+        parser.add_argument(
+            '--batch-conversions',
+            dest='batch_conversions',
+            action='store_true',
+            default=False,
+            help=(
+                'Convert the Leads of users with course purchases in groups of {size} once the rest of their '
+                'batch is synchronized, instead of one Lead at a time.'.format(size=CONVERSION_BATCH_SIZE)
+            )
+        )
+        parser.add_argument(
+            '--workers',
+            dest='workers',
+            type=int,
+            default=1,
+            help=(
+                'Number of users synchronized concurrently, each worker thread using its own Salesforce '
+                'session. Users are synchronized one at a time by default.'
+            )
+        )
+        parser.add_argument(
+            '--plan-pricebook',
+            dest='plan_pricebook',
+            action='store_true',
+            default=False,
+            help=(
+                'Get or create the Product2 and the PricebookEntry of every purchased course, with the '
+                'maximum list price of its purchases, with a few queries before the users are synchronized, '
+                'instead of looking them up for each new Opportunity.'
+            )
+        )
+        parser.add_argument(
+            '--skip-unchanged',
+            dest='skip_unchanged',
+            action='store_true',
+            default=False,
+            help=(
+                'Skip the users whose account and course purchase data is unchanged since it was last '
+                'synchronized, without any Salesforce request, and record the data of the synchronized users.'
+            )
+        )
+        parser.add_argument(
+            '--verify',
+            dest='verify',
+            action='store_true',
+            default=False,
+            help=(
+                'Compare every user with Salesforce, even if their data is unchanged since it was last '
+                'synchronized, and record the data of the synchronized users. Implies --skip-unchanged.'
+            )
+        )
+        parser.add_argument(
+            '--checkpoint',
+            dest='checkpoint',
+            action='store_true',
+            default=False,
+            help=(
+                'Record the synchronized users and the IDs of the reference objects in a local journal every '
+                '{interval} users by default, so an interrupted run can be resumed with --resume.'.format(
+                    interval=DEFAULT_CHECKPOINT_INTERVAL
+                )
+            )
+        )
+        parser.add_argument(
+            '--resume',
+            dest='resume',
+            action='store_true',
+            default=False,
+            help=(
+                'Continue from the last checkpoint of an interrupted run for the same site and orgs, skipping '
+                'the users it synchronized. Implies --checkpoint.'
+            )
+        )
+        parser.add_argument(
+            '--throttle',
+            dest='throttle',
+            action='store_true',
+            default=False,
+            help=(
+                'Throttle the Salesforce requests of the command to the EDX_SALESFORCE_REQUEST_RATE setting, '
+                'and back off when Salesforce rejects requests with REQUEST_LIMIT_EXCEEDED or a 503.'
+            )
+        )
+        parser.add_argument(
+            '--max-api-share',
+            dest='max_api_share',
+            type=float,
+            default=None,
+            help=(
+                'Stop with a checkpoint once this share, between 0 and 1, of the daily API request limit '
+                'of the org is used. The run can be continued with --resume. Implies --throttle and --checkpoint.'
+            )
+        )
+        parser.add_argument(
+            '--dead-letter',
+            dest='dead_letter',
+            action='store_true',
+            default=False,
+            help=(
+                'Record the users which fail to synchronize, with their error and data, so they can be '
+                'synchronized again with the replay_failed_sync command.'
+            )
+        )
+        parser.add_argument(
+            '--reference-cache',
+            dest='reference_cache',
+            action='store_true',
+            default=False,
+            help=(
+                'Reuse the Salesforce IDs of the Campaigns, Product2s, PricebookEntries and DiscountCodes '
+                'looked up by earlier runs, if they are younger than the reference cache TTL, and store '
+                'the IDs looked up by this run.'
+            )
+        )
+        parser.add_argument(
+            '--stats',
+            dest='stats',
+            action='store_true',
+            default=False,
+            help=(
+                'Output the time spent in each phase of the run, the number of Salesforce API requests '
+                'by object type and operation, and the percentiles of the time taken by each user.'
+            )
+        )
+        parser.add_argument(
+            '--stats-file',
+            dest='stats_file',
+            default=None,
+            help='Write the stats of the run to this JSON file. Implies --stats.'
+        )
+        self.add_metrics_arguments(parser)
+        self.add_extraction_arguments(parser)
 
     def handle(self, *args, **options):
         site_domain = options['site_domain']
         orgs = options['orgs']
+        self._configure(site_domain, orgs, options)
 
-        users = fetch_user_data(site_domain, orgs)
+        with self.export_metrics(options):
+            with self.stats.phase('extraction'):
+                users = fetch_user_data(site_domain, orgs, **self.get_extraction_kwargs(options))
 
-        if not users:
-            self.stdout.write(
-                'No user accounts found for site {site} and orgs {orgs}...'.format(
-                    site=site_domain,
-                    orgs=','.join(orgs),
+            if not users:
+                self.stdout.write(
+                    'No user accounts found for site {site} and orgs {orgs}...'.format(
+                        site=site_domain,
+                        orgs=','.join(orgs),
+                    )
                 )
-            )
-            return
+                self.save_extraction_watermarks(options)
+                return
+
+            status_count = self._sync_and_report(users, site_domain, orgs)
+
+            # Users which failed to synchronize must be fetched again by the next incremental run.
+            if not status_count[STATUS_FAILED]:
+                self.save_extraction_watermarks(options)
 
-        status_count = self._sync_user_data(users, site_domain, orgs)
+    def _configure(self, site_domain, orgs, options):
+        """
+        Validates the synchronization options of the command and sets up the clients and local state they use.
+        """
+        self.workers = options.get('workers', 1)
+        if self.workers < 1:
+            raise CommandError('--workers must be at least 1.')
+        if self.workers > 1 and (options.get('bulk', False) or options.get('collections', False)):
+            raise CommandError('--workers cannot be combined with --bulk or --collections.')
+        max_api_share = options.get('max_api_share')
+        if max_api_share is not None and not 0 < max_api_share <= 1:
+            raise CommandError('--max-api-share must be greater than 0 and at most 1.')
+
+        if options.get('throttle', False) or max_api_share is not None:
+            self.scheduler = RequestScheduler(max_api_share)
+            self.scheduler.install()
+            if max_api_share is not None:
+                self.scheduler.update_limits()
+        self.stats_file = options.get('stats_file')
+        self.report_stats = options.get('stats', False) or self.stats_file is not None
+        self.count_requests = bool(
+            self.report_stats or options.get('metrics_textfile') or options.get('metrics_json')
+        )
+        if self.count_requests:
+            self.stats.install()
+
+        self.prefetch = options.get('prefetch', False) or options.get('bulk', False)
+        self.batch_conversions = options.get('batch_conversions', False)
+        self.plan_pricebook = options.get('plan_pricebook', False)
+        self.bulk_client = BulkApiClient.from_connection() if options.get('bulk', False) else None
+        if options.get('collections', False):
+            self.writes = WriteBuffer(SObjectCollectionsClient.from_connection())
+        if options.get('reference_cache', False):
+            self.reference_cache = ReferenceCache(reference_cache_path())
+        self.verify = options.get('verify', False)
+        if options.get('skip_unchanged', False) or self.verify:
+            self.fingerprints = FingerprintStore(fingerprint_store_path())
+        if options.get('dead_letter', False):
+            self.dead_letter_path = dead_letter_path('sync_salesforce', site_domain, orgs)
+        resume = options.get('resume', False)
+        if options.get('checkpoint', False) or resume or max_api_share is not None:
+            self.checkpoint_path = checkpoint_path(self._command_name(), site_domain, orgs)
+            if not resume and os.path.exists(self.checkpoint_path):
+                os.remove(self.checkpoint_path)
+
+    def _sync_and_report(self, users, site_domain, orgs):
+        """
+        Synchronizes the given users, stores the local state of the run and outputs the sync status summary.
+        Returns the count of each sync status.
+        """
+        try:
+            status_count = self._sync_user_data(users, site_domain, orgs)
+        finally:
+            if self.reference_cache is not None:
+                self.reference_cache.save()
+            if self.fingerprints is not None:
+                self.fingerprints.close()
+            if self.stats_file is not None:
+                write_state(self.stats_file, self.stats.as_dict())
 
         # Output sync status summary
         for status, count in status_count.items():
             self.stdout.write('{count} {status}'.format(count=count, status=status))
+        if self.report_stats:
+            for line in self.stats.summary():
+                self.stdout.write(line)
+
+        return status_count
 
     def _sync_user_data(self, users, site_domain, orgs):
         """
@@ -113,71 +455,39 @@ class Command(BaseCommand):
         status_count[STATUS_IN_SYNC] = 0
         status_count[STATUS_SYNCHRONIZED] = 0
 
-        for user in users:
-            try:
-                salesforce_updated = False
-                status = STATUS_IN_SYNC
-                username = user['username']
+        if self.plan_pricebook:
+            with self.stats.phase('pricebook planning'):
+                self._plan_pricebook_entries(_iter_purchases(users))
 
-                # Create a new Lead if it doesn't exist, otherwise
-                # make sure the user account data is in sync with
-                # the Lead or converted Contact object.
-                try:
-                    lead = Lead.objects.get(username=username)
-                    if lead.is_converted:
-                        contact = None
-                        try:
-                            contact = lead.converted_contact
-                        except Contact.DoesNotExist:
-                            # Converted contact must have been manually deleted in Salesforce
-                            pass
-
-                        if contact:
-                            salesforce_updated = self._update_lead_or_contact(lead.converted_contact, user)
-                        else:
-                            self.stdout.write(
-                                '{user}: Converted Contact object manually deleted in Salesforce. '
-                                'This user will no longer be synchronized.'.format(
-                                    user=username
-                                )
+        if self.checkpoint_path is not None:
+            users = self._resume_from_checkpoint(users, status_count)
+
+        batch_size = PREFETCH_BATCH_SIZE if self.bulk_client is None else BULK_BATCH_SIZE
+        interval = getattr(settings, 'EDX_SALESFORCE_CHECKPOINT_INTERVAL', DEFAULT_CHECKPOINT_INTERVAL)
+        try:
+            with _worker_pool(self.workers, self._install_session_hooks) as pool:
+                for batch in _iter_batches(users, batch_size):
+                    if self.scheduler is not None and self.scheduler.exhausted():
+                        raise CommandError(
+                            'Stopped after {usage} of the {limit} daily API requests of the org were used. '
+                            'Run the command with --resume to continue.'.format(
+                                usage=self.scheduler.api_usage, limit=self.scheduler.api_limit
                             )
-                            continue
-                    else:
-                        salesforce_updated = self._update_lead_or_contact(lead, user)
-                except Lead.DoesNotExist:
-                    lead = self._create_lead(user)
-                    salesforce_updated = True
-
-                # Synchronize course purchase data with Salesforce Opportunity objects
-                courses = user['courses']
-                if courses:
-                    if not lead.is_converted:
-                        # Convert the Lead to a Contact
-                        lead = self._convert_lead(lead)
-                        salesforce_updated = True
-
-                    for course in courses:
-                        salesforce_updated = self._sync_opportunity(lead, course) or salesforce_updated
-
-                # Update sync status/count for summary output
-                if salesforce_updated:
-                    status_count[STATUS_SYNCHRONIZED] += 1
-                    status = STATUS_SYNCHRONIZED
-                else:
-                    status_count[STATUS_IN_SYNC] += 1
-            except Exception:  # pylint: disable=broad-except
-                # Output stacktrace and update sync status/count for summary output
-                traceback.print_exc(file=self.stdout)
-                status_count[STATUS_FAILED] += 1
-                status = STATUS_FAILED
+                        )
+                    statuses = self._sync_batch(batch, pool, status_count)
+                    if self.checkpoint_path is not None:
+                        self.checkpoint_statuses.update(statuses)
+                        if len(self.checkpoint_statuses) >= interval:
+                            self._write_checkpoint()
+        except BaseException:
+            # Record the users of the batches completed before the run was interrupted.
+            if self.checkpoint_path is not None:
+                self._write_checkpoint()
+            raise
 
-            # Output the sync status of this user
-            self.stdout.write(
-                '{user}: {status}'.format(
-                    user=username,
-                    status=status
-                )
-            )
+        # The run is complete, so the next run starts from scratch.
+        if self.checkpoint_path is not None and os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
 
         self.stdout.write(
             'Finished processing {total_users} user{pluralize_total_users} '
@@ -192,25 +502,526 @@ class Command(BaseCommand):
 
         return status_count
 
+    def _install_session_hooks(self):
+        """
+        Installs the request scheduler and the request accounting of the run, if any, on the Salesforce
+        session of the current thread.
+        """
+        if self.scheduler is not None:
+            self.scheduler.install()
+        if self.count_requests:
+            self.stats.install()
+
+    def _sync_batch(self, batch, pool, status_count):
+        """
+        Synchronizes a batch of users and outputs their sync status, counting each status in `status_count`.
+        The users are synchronized on the given worker pool, if any, and their statuses are output in the
+        order of the batch. Users whose data is unchanged since it was last synchronized are In Sync,
+        unless they are verified.
+
+        Returns:
+            dict, the final sync status of each user of the batch, by username.
+        """
+        fingerprints = {}
+        unchanged = set()
+        if self.fingerprints is not None:
+            for user in batch:
+                try:
+                    fingerprints[user['username']] = _user_fingerprint(user)
+                except (AttributeError, KeyError):
+                    # Users with missing data are synchronized without a fingerprint, and fail.
+                    pass
+            if not self.verify:
+                stored = self.fingerprints.get_many(fingerprints)
+                unchanged = {username for username, fingerprint in fingerprints.items()
+                             if stored.get(username) == fingerprint}
+        changed = [user for user in batch if user['username'] not in unchanged]
+
+        if self.prefetch:
+            with self.stats.phase('prefetch'):
+                self._prefetch_leads([user['username'] for user in changed])
+
+        if self.bulk_client is not None:
+            statuses = self._sync_users_in_bulk(changed)
+        elif pool is not None:
+            statuses = pool.map(self._sync_user, changed)
+        else:
+            statuses = [self._sync_user(user) for user in changed]
+
+        if self.pending_conversions:
+            converted_statuses = self._convert_pending_leads(pool)
+            statuses = [
+                converted_statuses[user['username']] if status is CONVERSION_PENDING else status
+                for user, status in izip(changed, statuses)
+            ]
+
+        statuses = iter(statuses)
+        statuses = [STATUS_IN_SYNC if user['username'] in unchanged else next(statuses) for user in batch]
+
+        # Send the buffered writes of the batch. Users with failed writes failed to synchronize.
+        failures = {}
+        if self.writes is not None:
+            with self.stats.phase('write flush'):
+                self.writes.flush()
+            failures = self.writes.pop_failures()
+
+        synchronized = {}
+        final_statuses = {}
+        for user, status in izip(batch, statuses):
+            error = self.errors.pop(user['username'], None)
+            if status is None:
+                final_statuses[user['username']] = None
+                continue
+
+            errors = failures.get(user['username'])
+            if errors:
+                for error in errors:
+                    self.stdout.write('{user}: {error}'.format(user=user['username'], error=error))
+                error = '\n'.join(errors)
+                status = STATUS_FAILED
+
+            # Failed users are recorded with their error and data to be replayed by replay_failed_sync.
+            if status == STATUS_FAILED and self.dead_letter_path is not None:
+                append_journal(self.dead_letter_path, {'username': user['username'], 'error': error, 'user': user})
+
+            if user['username'] in fingerprints and status != STATUS_FAILED:
+                synchronized[user['username']] = fingerprints[user['username']]
+            final_statuses[user['username']] = status
+
+            # Update sync status/count for summary output
+            status_count[status] += 1
+            self.stats.count_users(status)
+
+            # Output the sync status of this user
+            self.stdout.write(
+                '{user}: {status}'.format(
+                    user=user['username'],
+                    status=status
+                )
+            )
+
+        # Users which failed to synchronize must not be skipped by the next runs.
+        if self.fingerprints is not None:
+            self.fingerprints.set_many(synchronized)
+            self.fingerprints.delete_many({user['username'] for user in batch} - set(synchronized))
+
+        return final_statuses
+
+    def _resume_from_checkpoint(self, users, status_count):
+        """
+        Counts the statuses of the given users recorded by the checkpoints of an interrupted run in
+        `status_count`, and restores the reference objects they recorded.
+
+        Returns:
+            iterable of the given users which weren't synchronized by the interrupted run. The users are
+            read, and the statuses of the skipped users counted, while it is consumed.
+        """
+        completed = {}
+        for checkpoint in read_journal(self.checkpoint_path):
+            completed.update(checkpoint['users'])
+            for model_name, objects in checkpoint['references'].items():
+                model = globals()[model_name]
+                for key, fields in objects.items():
+                    self.cache[model_name][key] = model(**fields)
+                    self.checkpoint_references.add((model_name, key))
+        if not completed:
+            return users
+
+        self.stdout.write('Resuming after the {count} users synchronized by the interrupted run...'.format(
+            count=len(completed)
+        ))
+        return _skip_completed_users(users, completed, status_count)
+
+    def _write_checkpoint(self):
+        """
+        Appends the statuses of the users synchronized since the last checkpoint and the reference objects
+        looked up since then to the checkpoint journal.
+        """
+        references = defaultdict(dict)
+        for model in CHECKPOINT_MODELS:
+            for key, obj in self.cache[model.__name__].items():
+                if obj.pk is not None and (model.__name__, key) not in self.checkpoint_references:
+                    fields = {'pk': obj.pk}
+                    if model is PricebookEntry:
+                        fields['unit_price'] = obj.unit_price
+                    references[model.__name__][key] = fields
+                    self.checkpoint_references.add((model.__name__, key))
+
+        if self.checkpoint_statuses or references:
+            append_journal(self.checkpoint_path, {'users': self.checkpoint_statuses, 'references': references})
+        self.checkpoint_statuses = {}
+
+    def _sync_user(self, user):
+        """
+        Synchronizes the account and course purchase data of a single user with Salesforce.
+
+        Returns:
+            string, the sync status of the user, or None if the user is no longer synchronized.
+        """
+        self.used_references.objects = []
+        started = time.time()
+        try:
+            return self._with_retries(user['username'], self._sync_user_once, user)
+        except Exception:  # pylint: disable=broad-except
+            # Output stacktrace and update sync status/count for summary output. The stacktrace is
+            # written at once so it isn't interleaved with the output of other workers.
+            return self._fail(user['username'], traceback.format_exc())
+        finally:
+            self.stats.record_latency(time.time() - started)
+
+    def _sync_user_once(self, user):
+        """
+        Makes a single attempt at synchronizing the account and course purchase data of a user,
+        and returns their sync status.
+        """
+        salesforce_updated = False
+        username = user['username']
+
+        # Create a new Lead if it doesn't exist, otherwise
+        # make sure the user account data is in sync with
+        # the Lead or converted Contact object.
+        try:
+            lead = self._get_lead(username)
+            if lead.is_converted:
+                contact = None
+                try:
+                    contact = self._get_converted_contact(lead)
+                except Contact.DoesNotExist:
+                    # Converted contact must have been manually deleted in Salesforce
+                    pass
+
+                if contact:
+                    salesforce_updated = bool(self._update_lead_or_contact(contact, user))
+                else:
+                    self.stdout.write(
+                        '{user}: Converted Contact object manually deleted in Salesforce. '
+                        'This user will no longer be synchronized.'.format(
+                            user=username
+                        )
+                    )
+                    return None
+            else:
+                salesforce_updated = bool(self._update_lead_or_contact(lead, user))
+                salesforce_updated = self._create_lead_children(lead, user, False) or salesforce_updated
+        except Lead.DoesNotExist:
+            with self.stats.phase('lead creation'):
+                lead = self._create_lead(user)
+            salesforce_updated = True
+
+        return self._sync_purchases(user, lead, salesforce_updated)
+
+    def _sync_users_in_bulk(self, users):
+        """
+        Synchronizes the account data of the given users with Salesforce Bulk API 2.0 upsert jobs,
+        then synchronizes the course purchase data of each user.
+
+        New and unconverted Leads are upserted by their Username__c external ID. Contacts have no
+        username field, so the Contacts of converted Leads are upserted by their ID.
+
+        Returns:
+            list of the sync status of each user, None for users which are no longer synchronized.
+        """
+        statuses = [None] * len(users)
+        rows = {Lead: OrderedDict(), Contact: OrderedDict()}
+        queued = []
+        for index, user in enumerate(users):
+            try:
+                queued_user = self._queue_user(user, rows)
+            except Exception:  # pylint: disable=broad-except
+                statuses[index] = self._fail(user['username'], traceback.format_exc())
+                continue
+            if queued_user:
+                queued.append((index, user) + queued_user)
+
+        results = {}
+        for model, key_field in ((Lead, 'username'), (Contact, 'id')):
+            if not rows[model]:
+                continue
+            try:
+                with self.stats.phase('bulk upsert'):
+                    results[model] = self.bulk_client.upsert(
+                        model._meta.db_table,  # pylint: disable=protected-access
+                        model._meta.get_field(key_field).column,  # pylint: disable=protected-access
+                        list(rows[model].values()),
+                    )
+            except Exception:  # pylint: disable=broad-except
+                traceback.print_exc(file=self.stdout)
+                results[model] = {}
+
+        for index, user, lead, model, key, created in queued:
+            self.used_references.objects = []
+            try:
+                if key is not None:
+                    result = results[model].get(key)
+                    if result is None or not result.success:
+                        statuses[index] = self._fail(user['username'], '{user}: Bulk API upsert failed: {error}'.format(
+                            user=user['username'],
+                            error=result.error if result else 'no result',
+                        ))
+                        continue
+
+                    if created:
+                        lead.pk = result.id
+                        utm_campaign = user['tracking'].get('utm_campaign')
+                        if utm_campaign:
+                            self._create_with_references(
+                                CampaignMember, lead.username, partial(self._campaign_reference, utm_campaign),
+                                lead=lead
+                            )
+
+                statuses[index] = self._with_retries(
+                    user['username'], self._sync_purchases, user, lead, key is not None
+                )
+            except Exception:  # pylint: disable=broad-except
+                statuses[index] = self._fail(user['username'], traceback.format_exc())
+
+        return statuses
+
+    def _queue_user(self, user, rows):
+        """
+        Applies the account data of the given user to their Lead or converted Contact and queues
+        the changed fields to be upserted, without saving them.
+
+        Arguments:
+            user (dict): The user account and associated course purchase data.
+            rows (dict): The queued rows of the Lead and Contact upsert jobs, keyed by external ID.
+
+        Returns:
+            tuple of the Lead of the user, the model and the external ID of the queued row and whether
+            the Lead is new, or None if the user is no longer synchronized. The external ID is None
+            if nothing changed.
+        """
+        username = user['username']
+        try:
+            lead = self._get_lead(username)
+        except Lead.DoesNotExist:
+            lead = Lead(username=username, company=username)
+            fields = ['company'] + self._apply_user_data(lead, user)
+            if user['tracking'].get('utm_campaign'):
+                self._set_utm_fields(lead, user['tracking'])
+                fields.extend(UTM_FIELDS)
+            lead.is_converted = False
+            return lead, Lead, self._queue_row(rows[Lead], lead, 'username', fields), True
+
+        if not lead.is_converted:
+            return lead, Lead, self._queue_row(rows[Lead], lead, 'username', self._apply_user_data(lead, user)), False
+
+        contact = None
+        try:
+            contact = self._get_converted_contact(lead)
+        except Contact.DoesNotExist:
+            # Converted contact must have been manually deleted in Salesforce
+            pass
+
+        if not contact:
+            self.stdout.write(
+                '{user}: Converted Contact object manually deleted in Salesforce. '
+                'This user will no longer be synchronized.'.format(
+                    user=username
+                )
+            )
+            return None
+        contact_key = self._queue_row(rows[Contact], contact, 'id', self._apply_user_data(contact, user))
+        return lead, Contact, contact_key, False
+
+    def _queue_row(self, rows, model, key_field, fields):
+        """
+        Queues the given fields of a Lead or Contact to be upserted by its `key_field` external ID.
+
+        Returns:
+            string, the external ID of the queued row, or None if there are no fields to upsert.
+        """
+        if not fields:
+            return None
+
+        key = getattr(model, key_field)
+        rows[key] = {
+            model._meta.get_field(field).column: getattr(model, field)  # pylint: disable=protected-access
+            for field in [key_field] + list(fields)
+        }
+        return key
+
+    def _sync_purchases(self, user, lead, salesforce_updated):
+        """
+        Synchronizes the course purchase data of a user with Salesforce Opportunity objects,
+        converting the Lead of the user to a Contact first if needed.
+
+        Returns:
+            string, the sync status of the user, or CONVERSION_PENDING if the Lead is converted
+            with the other Leads of the batch.
+        """
+        courses = user['courses']
+        if courses and not lead.is_converted:
+            if self.batch_conversions:
+                self.pending_conversions.append((user, lead))
+                return CONVERSION_PENDING
+
+            # Convert the Lead to a Contact
+            lead = self._convert_lead(lead)
+            salesforce_updated = True
+
+        return self._sync_opportunities(user, lead, salesforce_updated)
+
+    def _sync_opportunities(self, user, lead, salesforce_updated):
+        """
+        Synchronizes the course purchase data of a user with the Opportunity objects of their converted Lead.
+
+        Returns:
+            string, the sync status of the user.
+        """
+        for course in user['courses'] or ():
+            with self.stats.phase('opportunities'):
+                salesforce_updated = self._sync_opportunity(lead, course) or salesforce_updated
+
+        return STATUS_SYNCHRONIZED if salesforce_updated else STATUS_IN_SYNC
+
+    def _sync_converted_user(self, pending):
+        """
+        Synchronizes the course purchase data of a user whose Lead was converted with the other Leads
+        of their batch. Returns the sync status of the user.
+        """
+        user, lead = pending
+        self.used_references.objects = []
+        try:
+            return self._with_retries(user['username'], self._sync_opportunities, user, lead, True)
+        except Exception:  # pylint: disable=broad-except
+            return self._fail(user['username'], traceback.format_exc())
+
+    def _with_retries(self, username, func, *args):
+        """
+        Calls the given function with the given arguments to synchronize the given user, and calls it again
+        after a jittered exponential backoff while it fails with a transient error, up to the number of
+        retries set by the EDX_SALESFORCE_SYNC_RETRIES setting. The function must create the objects a
+        failed call didn't create, such as the children of the objects it created, with _create_children.
+        """
+        retries = getattr(settings, 'EDX_SALESFORCE_SYNC_RETRIES', DEFAULT_SYNC_RETRIES)
+        attempt = 0
+        while True:
+            try:
+                return func(*args)
+            except Exception as error:  # pylint: disable=broad-except
+                # Throttled requests were already retried by the request scheduler, if any.
+                throttled = self.scheduler is not None and is_throttled_error(error)
+                if attempt >= retries or throttled or not is_transient_error(error):
+                    raise
+                self.stdout.write('{user}: Retrying after transient error: {error}'.format(user=username, error=error))
+                self.stats.count_retry()
+                time.sleep(random.uniform(0, SYNC_RETRY_DELAY * 2 ** attempt))
+                attempt += 1
+
+    def _fail(self, username, error):
+        """
+        Outputs and records the error the given user failed to synchronize with, invalidates the reference
+        objects cached by earlier runs it used and returns the FAILED status.
+        """
+        self.stdout.write(error, ending='' if error.endswith('\n') else '\n')
+        self.errors[username] = error
+        self._invalidate_used_references()
+        return STATUS_FAILED
+
+    def _convert_pending_leads(self, pool):
+        """
+        Converts the Leads whose conversion was deferred by _sync_purchases in groups of
+        CONVERSION_BATCH_SIZE, using the Contact and Account IDs returned by the conversion instead
+        of loading the converted Leads. The custom fields of the Leads are then copied onto their
+        Contacts with batched updates, and the course purchases of the users are synchronized.
+
+        Returns:
+            dict, the sync status of each user by username.
+        """
+        pending, self.pending_conversions = self.pending_conversions, []
+        statuses = {}
+
+        # Leads created by buffered writes must exist before they are converted.
+        if self.writes is not None:
+            self.writes.flush()
+
+        converted = []
+        writes = WriteBuffer(SObjectCollectionsClient.from_connection())
+        for batch in _iter_batches(pending, CONVERSION_BATCH_SIZE):
+            try:
+                self.stats.count_api_call(Lead.__name__, 'convertLead')
+                with self.stats.phase('conversion'):
+                    results = convert_leads([lead for _, lead in batch], doNotCreateOpportunity=True)
+            except Exception:  # pylint: disable=broad-except
+                error = traceback.format_exc()
+                for user, _ in batch:
+                    statuses[user['username']] = self._fail(user['username'], error)
+                continue
+
+            for (user, lead), result in izip(batch, results):
+                username = user['username']
+                if not result['success']:
+                    statuses[username] = self._fail(username, '{user}: Lead conversion failed: {errors}'.format(
+                        user=username, errors='; '.join(result['errors'])
+                    ))
+                    continue
+
+                contact = Contact(pk=result['contactId'])
+                for field in CONVERTED_CONTACT_FIELDS:
+                    setattr(contact, field, getattr(lead, field))
+                writes.save(contact, username, CONVERTED_CONTACT_FIELDS)
+
+                lead.is_converted = True
+                lead.converted_account = Account(pk=result['accountId'])
+                self._add_new_account(result['accountId'])
+                lead.converted_contact = contact
+                converted.append((user, lead))
+
+        writes.flush()
+        failures = writes.pop_failures()
+        for username, errors in failures.items():
+            for error in errors:
+                self.stdout.write('{user}: {error}'.format(user=username, error=error))
+            self.errors[username] = '\n'.join(errors)
+            statuses[username] = STATUS_FAILED
+        converted = [(user, lead) for user, lead in converted if user['username'] not in failures]
+
+        if pool is not None:
+            converted_statuses = pool.map(self._sync_converted_user, converted)
+        else:
+            converted_statuses = [self._sync_converted_user(pending_user) for pending_user in converted]
+        for (user, _), status in izip(converted, converted_statuses):
+            statuses[user['username']] = status
+
+        return statuses
+
+    def _add_new_account(self, account_id):
+        """
+        Records that the Account a Lead was just converted to has no Opportunities yet, if
+        Opportunities are prefetched.
+        """
+        if self.opportunities is not None and account_id:
+            self.opportunities[account_id] = {}
+
     def _convert_lead(self, lead):
         """
         Converts Lead to Contact and Account objects in Salesforce. Salesforce does not
         automatically populate custom fields on the Contact object with data from the
         Lead object, so we must do that here.
         """
-        _ = convert_lead(lead, doNotCreateOpportunity=True)
+        # The Lead must exist and be up to date before it is converted.
+        if self.writes is not None:
+            self.writes.flush()
+
+        self.stats.count_api_call(Lead.__name__, 'convertLead')
+        with self.stats.phase('conversion'):
+            _ = convert_lead(lead, doNotCreateOpportunity=True)
         lead = Lead.objects.get(username=lead.username)
+        self._add_new_account(lead.converted_account_id)
 
         contact = lead.converted_contact
-        contact.language = lead.language
-        contact.country = lead.country
-        contact.year_of_birth = lead.year_of_birth
-        contact.pi_utm_campaign = lead.pi_utm_campaign
-        contact.pi_utm_content = lead.pi_utm_content
-        contact.pi_utm_medium = lead.pi_utm_medium
-        contact.pi_utm_source = lead.pi_utm_source
-        contact.pi_utm_term = lead.pi_utm_term
-        contact.save()
+        # A synchronization of the user retried after a failure below must find the converted Lead among
+        # the prefetched Leads instead of converting it again.
+        if self.leads is not None:
+            self.leads[lead.username.lower()] = [lead]
+            self.converted_contacts[contact.pk] = contact
+        fields = [
+            field for field in CONVERTED_CONTACT_FIELDS
+            if self._update_field(contact, field, getattr(lead, field))
+        ]
+        if fields:
+            self._save(contact, lead.username, fields)
 
         return lead
 
@@ -224,26 +1035,142 @@ class Command(BaseCommand):
         lead = Lead(username=username, company=username)
         self._update_lead_or_contact(lead, user)
 
-        tracking_data = user['tracking']
-        utm_campaign = tracking_data.get('utm_campaign')
-        if utm_campaign:
-            campaign, _ = self._get_or_create(Campaign.__name__, name=utm_campaign)
-            CampaignMember.objects.create(campaign=campaign, lead=lead)
-
-            lead.campaign = campaign
-            lead.pi_utm_campaign = utm_campaign
-            lead.pi_utm_content = tracking_data.get('utm_content')
-            lead.pi_utm_medium = tracking_data.get('utm_medium')
-            lead.pi_utm_source = tracking_data.get('utm_source')
-            lead.pi_utm_term = tracking_data.get('utm_term')
-            lead.save()
-
         # Set this value here instead of making a GET request
         # to pull the newly created Lead.
         lead.is_converted = False
 
+        # A synchronization of the user retried after a failure below must find the Lead among the
+        # prefetched Leads instead of creating it again.
+        if self.leads is not None:
+            self.leads[username.lower()] = [lead]
+
+        self._create_lead_children(lead, user, True)
         return lead
 
+    def _create_lead_children(self, lead, user, created):
+        """
+        Creates a Campaign object in Salesforce if one does not already exist and associates it with
+        the given Lead, if UTM parameters are available for the user account and the Lead is new or
+        its children weren't all created.
+
+        Returns:
+            boolean, True if the Lead was associated with a Campaign.
+        """
+        username = user['username']
+        tracking_data = user['tracking']
+        utm_campaign = tracking_data.get('utm_campaign')
+        if not utm_campaign:
+            return False
+
+        def save_utm_fields():
+            """
+            Saves the UTM parameters of the user account on the Lead.
+            """
+            self._set_utm_fields(lead, tracking_data)
+            self._save(lead, username, UTM_FIELDS)
+
+        return self._create_children((Lead.__name__, username.lower()), created, [
+            partial(
+                self._create_with_references,
+                CampaignMember, username, partial(self._campaign_reference, utm_campaign), lead=lead
+            ),
+            save_utm_fields,
+        ])
+
+    def _create_children(self, key, created, children):
+        """
+        Calls the given functions creating the child objects of the Salesforce object with the given model
+        name and key once it is created. If one of them fails, the synchronization of the user retried
+        after the failure calls it and the next ones, although the object is no longer new.
+
+        Returns:
+            boolean, True if child objects were created.
+        """
+        if created:
+            self.unfinished_children[key] = 0
+        elif key not in self.unfinished_children:
+            return False
+
+        for create in children[self.unfinished_children[key]:]:
+            create()
+            self.unfinished_children[key] += 1
+        del self.unfinished_children[key]
+        return True
+
+    def _create(self, model, username, **kwargs):
+        """
+        Creates a Salesforce object of the given model for the given user, or buffers its
+        creation if writes are buffered.
+        """
+        if self.writes is None:
+            return model.objects.create(**kwargs)
+        return self.writes.create(model, username, **kwargs)
+
+    def _create_with_references(self, model, username, get_references, **kwargs):
+        """
+        Creates a Salesforce object of the given model for the given user which refers to the reference
+        objects returned by `get_references`, as a dict of field values. If Salesforce rejects the object
+        because a reference object whose ID was cached by an earlier run no longer exists, the cached
+        reference objects used by the user are invalidated, and the object is created once more with
+        the reference objects looked up again.
+        """
+        try:
+            return self._create(model, username, **dict(kwargs, **get_references()))
+        except SalesforceError as error:
+            if not is_stale_reference_error(error) or not getattr(self.used_references, 'objects', None):
+                raise
+            self.stdout.write('{user}: Looking up the cached objects again after error: {error}'.format(
+                user=username, error=error
+            ))
+
+        self._invalidate_used_references()
+        return self._create(model, username, **dict(kwargs, **get_references()))
+
+    def _campaign_reference(self, utm_campaign):
+        """
+        Returns the Campaign with the given name a CampaignMember refers to, as a dict of field values.
+        """
+        campaign, _ = self._get_or_create(Campaign.__name__, name=utm_campaign)
+        return {'campaign': campaign}
+
+    def _get_converted_contact(self, lead):
+        """
+        Returns the Contact the given converted Lead was converted to, from the prefetched
+        Contacts if the Leads were prefetched.
+
+        Raises:
+            Contact.DoesNotExist: if the Contact no longer exists.
+        """
+        if self.leads is None:
+            return lead.converted_contact
+
+        try:
+            return self.converted_contacts[lead.converted_contact_id]
+        except KeyError:
+            raise Contact.DoesNotExist('Contact matching query does not exist.')
+
+    def _get_lead(self, username):
+        """
+        Returns the Lead of the given user, from the prefetched Leads if the Leads were prefetched.
+
+        Raises:
+            Lead.DoesNotExist: if the user has no Lead.
+            Lead.MultipleObjectsReturned: if the user has more than one Lead.
+        """
+        if self.leads is None:
+            with self.stats.phase('lead lookup'):
+                return Lead.objects.get(username=username)
+
+        # Salesforce compares text fields case insensitively, so Leads are indexed by lower case username.
+        leads = self.leads.get(username.lower(), [])
+        if not leads:
+            raise Lead.DoesNotExist('Lead matching query does not exist.')
+        if len(leads) > 1:
+            raise Lead.MultipleObjectsReturned(
+                'get() returned more than one Lead -- it returned {count}!'.format(count=len(leads))
+            )
+        return leads[0]
+
     def _get_or_create(self, model_name, **kwargs):
         """
         Wrapper for Salesforce model manager get_or_create which caches
@@ -254,42 +1181,289 @@ class Command(BaseCommand):
         created = False
         obj = self.cache[model_name].get(cache_key)
         if not obj:
-            obj, created = globals()[model_name].objects.get_or_create(**kwargs)
-            self.cache[model_name][cache_key] = obj
+            with self._lock(model_name, cache_key):
+                obj = self.cache[model_name].get(cache_key)
+                if not obj:
+                    model = globals()[model_name]
+                    obj = self._get_reference(model, cache_key, kwargs)
+                    if obj is None:
+                        obj, created = model.objects.get_or_create(**kwargs)
+                        self._set_reference(obj, cache_key, kwargs)
+                    self.cache[model_name][cache_key] = obj
 
+        self._use_reference(model_name, cache_key)
         return obj, created
 
+    def _get_or_create_opportunity(self, lead, **lookup):
+        """
+        Gets or creates the Opportunity of the Account of the given converted Lead with the given
+        field values. The prefetched Opportunities are used if the Opportunities of the Account
+        were prefetched, so only new Opportunities are sent to Salesforce.
+        """
+        account_id = lead.converted_account_id
+        index = self.opportunities.get(account_id) if self.opportunities is not None and account_id else None
+        if index is None:
+            return Opportunity.objects.get_or_create(account=lead.converted_account, **lookup)
+
+        key = _opportunity_key(lookup)
+        opportunity = index.get(key)
+        if opportunity is not None:
+            return opportunity, False
+
+        opportunity = Opportunity.objects.create(account_id=account_id, **lookup)
+        index[key] = opportunity
+        return opportunity, True
+
     def _get_or_create_pricebook_entry(self, pricebook, product, unit_price):
         """
         Gets or creates a PricebookEntry model using the given Pricebook and Product
         models with the given unit price.
         """
-        created = False
-        try:
-            pricebook_entry = PricebookEntry.objects.get(
-                pricebook2=pricebook,
-                product2=product,
-                is_active=True,
-            )
+        with self._lock(PricebookEntry.__name__, product.pk):
+            # PricebookEntries planned by _plan_pricebook_entries already have the maximum price of the run.
+            pricebook_entry = self.cache[PricebookEntry.__name__].get(product.pk)
+            if pricebook_entry is not None and pricebook_entry.unit_price >= unit_price:
+                self._use_reference(PricebookEntry.__name__, product.pk)
+                return pricebook_entry, False
 
-            # Sometimes the price of a course will get changed by
-            # the course team resulting in course purchase data
-            # associated with the same course with different prices.
-            # This will set the unit price on the PricebookEntry to
-            # the maximum price found for the Product.
-            if pricebook_entry.unit_price < unit_price:
+            lookup = {'pricebook2_id': pricebook.pk, 'product2_id': product.pk}
+            pricebook_entry = self._get_reference(PricebookEntry, product.pk, lookup)
+            if pricebook_entry is not None:
+                try:
+                    if pricebook_entry.unit_price < unit_price:
+                        pricebook_entry.unit_price = unit_price
+                        pricebook_entry.save(update_fields=['unit_price'])
+                except SalesforceError:
+                    # The cached PricebookEntry may have been deleted, so it is looked up again.
+                    self._invalidate_reference(PricebookEntry.__name__, product.pk)
+                else:
+                    self._use_reference(PricebookEntry.__name__, product.pk)
+                    return pricebook_entry, False
+
+            created = False
+            try:
+                pricebook_entry = PricebookEntry.objects.get(
+                    pricebook2=pricebook,
+                    product2=product,
+                    is_active=True,
+                )
+
+                # Sometimes the price of a course will get changed by
+                # the course team resulting in course purchase data
+                # associated with the same course with different prices.
+                # This will set the unit price on the PricebookEntry to
+                # the maximum price found for the Product.
+                if pricebook_entry.unit_price < unit_price:
+                    pricebook_entry.unit_price = unit_price
+                    pricebook_entry.save(update_fields=['unit_price'])
+            except PricebookEntry.DoesNotExist:
+                pricebook_entry = PricebookEntry.objects.create(
+                    pricebook2=pricebook,
+                    product2=product,
+                    is_active=True,
+                    unit_price=unit_price
+                )
+                created = True
+
+            self._set_reference(pricebook_entry, product.pk, lookup, unit_price=pricebook_entry.unit_price)
+            return pricebook_entry, created
+
+    def _plan_pricebook_entries(self, purchases):
+        """
+        Gets or creates the Product2 of each course of the given course purchases and its PricebookEntry
+        in the standard Pricebook, with the maximum list price of the course's purchases, and caches
+        them for _get_or_create and _get_or_create_pricebook_entry.
+
+        Existing objects are loaded with paged queries, so each Product2 and PricebookEntry is read
+        once and written at most once, whatever the number of purchases of its course.
+        """
+        list_prices = {}
+        for course in purchases:
+            course_id, list_price = course['course_id'], course['list_price']
+            if list_price is not None:
+                list_prices[course_id] = max(list_prices.get(course_id, list_price), list_price)
+        if not list_prices:
+            return
+
+        # Products and PricebookEntries cached by earlier runs are used as is, unless their price is lower.
+        products = {}
+        for course_id in list_prices:
+            product = self._get_reference(Product2, course_id, {'name': course_id})
+            if product is not None:
+                products[course_id] = product
+        missing = [course_id for course_id in list_prices if course_id not in products]
+        for batch in _iter_batches(missing, PREFETCH_BATCH_SIZE):
+            for product in Product2.objects.filter(name__in=batch):
+                products.setdefault(product.name, product)
+                self._set_reference(product, product.name, {'name': product.name})
+        for course_id in list_prices:
+            if course_id not in products:
+                products[course_id] = Product2.objects.create(name=course_id)
+                self._set_reference(products[course_id], course_id, {'name': course_id})
+            self.cache[Product2.__name__][course_id] = products[course_id]
+
+        lookups = {
+            course_id: {'pricebook2_id': self.pricebook.pk, 'product2_id': product.pk}
+            for course_id, product in products.items()
+        }
+        pricebook_entries = {}
+        for course_id, product in products.items():
+            pricebook_entry = self._get_reference(PricebookEntry, product.pk, lookups[course_id])
+            if pricebook_entry is not None and pricebook_entry.unit_price >= list_prices[course_id]:
+                pricebook_entries[product.pk] = pricebook_entry
+        missing = {product.pk for product in products.values() if product.pk not in pricebook_entries}
+        for batch in _iter_batches(missing, PREFETCH_BATCH_SIZE):
+            queryset = PricebookEntry.objects.filter(pricebook2=self.pricebook, product2__in=batch, is_active=True)
+            for pricebook_entry in queryset:
+                pricebook_entries.setdefault(pricebook_entry.product2_id, pricebook_entry)
+
+        for course_id, product in products.items():
+            unit_price = list_prices[course_id]
+            pricebook_entry = pricebook_entries.get(product.pk)
+            if pricebook_entry is None:
+                pricebook_entry = PricebookEntry.objects.create(
+                    pricebook2=self.pricebook,
+                    product2=product,
+                    is_active=True,
+                    unit_price=unit_price
+                )
+            elif pricebook_entry.unit_price < unit_price:
+                # Sets the unit price to the maximum price found for the Product, once.
                 pricebook_entry.unit_price = unit_price
-                pricebook_entry.save()
-        except PricebookEntry.DoesNotExist:
-            pricebook_entry = PricebookEntry.objects.create(
-                pricebook2=pricebook,
-                product2=product,
-                is_active=True,
-                unit_price=unit_price
-            )
-            created = True
+                pricebook_entry.save(update_fields=['unit_price'])
+            if product.pk in missing:
+                self._set_reference(
+                    pricebook_entry, product.pk, lookups[course_id], unit_price=pricebook_entry.unit_price
+                )
+            self.cache[PricebookEntry.__name__][product.pk] = pricebook_entry
+
+    def _get_reference(self, model, key, lookup):
+        """
+        Returns an unsaved object of the given model with the Salesforce ID and fields cached by an
+        earlier run for the given lookup field values, or None if the reference cache is disabled or
+        the object isn't cached.
+
+        Arguments:
+            model (Model class): The model of the reference object.
+            key (string): The key of the object in the command's caches.
+            lookup (dict): The field values the object is looked up by.
+        """
+        if self.reference_cache is None:
+            return None
+
+        entry = self.reference_cache.get(model.__name__, lookup)
+        if entry is None:
+            return None
+
+        self.loaded_references[(model.__name__, key)] = lookup
+        fields = dict(lookup, **entry['fields'])
+        return model(pk=entry['id'], **fields)
+
+    def _set_reference(self, obj, key, lookup, **fields):
+        """
+        Caches the Salesforce ID and the given fields of a reference object looked up or created by
+        this run for the next runs.
+        """
+        if self.reference_cache is None or obj.pk is None or None in lookup.values():
+            return
+
+        model_name = type(obj).__name__
+        self.loaded_references.pop((model_name, key), None)
+        self.reference_cache.set(model_name, lookup, obj.pk, **fields)
+
+    def _use_reference(self, model_name, key):
+        """
+        Records that the user synchronized by the current worker uses the reference object with the
+        given model name and key, if its Salesforce ID was cached by an earlier run.
+        """
+        if (model_name, key) in self.loaded_references and hasattr(self.used_references, 'objects'):
+            self.used_references.objects.append((model_name, key))
+
+    def _invalidate_used_references(self):
+        """
+        Invalidates the reference objects cached by earlier runs which were used by the user the current
+        worker failed to synchronize, as the failure may be caused by an object deleted since. The objects
+        are looked up again by the next users which use them.
+        """
+        for model_name, key in getattr(self.used_references, 'objects', ()):
+            self._invalidate_reference(model_name, key)
+        self.used_references.objects = []
+
+    def _invalidate_reference(self, model_name, key):
+        """
+        Removes the reference object with the given model name and key from the reference cache and from
+        the cache of this run, if its Salesforce ID was cached by an earlier run.
+        """
+        lookup = self.loaded_references.pop((model_name, key), None)
+        if lookup is not None:
+            self.reference_cache.invalidate(model_name, lookup)
+            self.cache[model_name].pop(key, None)
+
+    def _lock(self, model_name, key):
+        """
+        Returns the lock held while workers get or create the Salesforce object with the given
+        model name and key.
+        """
+        with self.locks_lock:
+            return self.locks.setdefault((model_name, key), threading.Lock())
+
+    def _prefetch_leads(self, usernames):
+        """
+        Loads the Leads of the given users, the Contacts they were converted to and the Opportunities
+        of their Accounts. The objects are loaded with a few SOQL queries, read in pages, instead of
+        queries per user and course purchase.
+        """
+        self.leads = defaultdict(list)
+        self.converted_contacts = {}
+        self.opportunities = {}
+
+        # Keep each SOQL query well below the query length limit.
+        for batch in _iter_batches(usernames, PREFETCH_BATCH_SIZE):
+            for lead in Lead.objects.filter(username__in=batch):
+                self.leads[lead.username.lower()].append(lead)
+
+        contact_ids = [
+            lead.converted_contact_id
+            for leads in self.leads.values() for lead in leads
+            if lead.is_converted and lead.converted_contact_id
+        ]
+        for batch in _iter_batches(contact_ids, PREFETCH_BATCH_SIZE):
+            for contact in Contact.objects.filter(pk__in=batch):
+                self.converted_contacts[contact.pk] = contact
+
+        account_ids = [
+            lead.converted_account_id
+            for leads in self.leads.values() for lead in leads
+            if lead.is_converted and lead.converted_account_id
+        ]
+        for account_id in account_ids:
+            self.opportunities[account_id] = {}
+        for batch in _iter_batches(account_ids, PREFETCH_BATCH_SIZE):
+            for opportunity in Opportunity.objects.filter(account__in=batch):
+                lookup = {field: getattr(opportunity, field) for field in OPPORTUNITY_LOOKUP_FIELDS}
+                self.opportunities[opportunity.account_id][_opportunity_key(lookup)] = opportunity
+
+    def _save(self, model, username, fields):
+        """
+        Saves the given fields of a Salesforce object of the given user, or buffers their write
+        if writes are buffered. New objects are created with all their fields.
+        """
+        if self.writes is not None:
+            self.writes.save(model, username, fields)
+        elif model.pk:
+            model.save(update_fields=fields)
+        else:
+            model.save()
 
-        return pricebook_entry, created
+    def _set_utm_fields(self, lead, tracking_data):
+        """
+        Sets the UTM parameter fields of a new Lead from the tracking data of the user.
+        """
+        lead.pi_utm_campaign = tracking_data.get('utm_campaign')
+        lead.pi_utm_content = tracking_data.get('utm_content')
+        lead.pi_utm_medium = tracking_data.get('utm_medium')
+        lead.pi_utm_source = tracking_data.get('utm_source')
+        lead.pi_utm_term = tracking_data.get('utm_term')
 
     def _sync_opportunity(self, lead, course_purchase_data):
         """
@@ -301,50 +1475,60 @@ class Command(BaseCommand):
             course_purchase_data (dict): Dictionary containing the course purchase details.
 
         Returns:
-            boolean, True if an Opportunity object was created in Salesforce, otherwise False.
+            boolean, True if an Opportunity object or its children were created in Salesforce, otherwise False.
         """
         course_id = course_purchase_data['course_id']
         quantity = course_purchase_data['quantity']
         unit_price = course_purchase_data['unit_price']
         total_price = unit_price * quantity
         paid_date = course_purchase_data['purchase_date']
-        opportunity, created = Opportunity.objects.get_or_create(
-            account=lead.converted_account,
+        opportunity, created = self._get_or_create_opportunity(
+            lead,
             name=course_id,
             amount=total_price,
             close_date=paid_date,
             paid_date=paid_date,
             stage_name='Paid',
         )
-        if created:
-            quantity = course_purchase_data['quantity']
-            list_price = course_purchase_data['list_price']
-            unit_price = course_purchase_data['unit_price']
-            coupon_codes = course_purchase_data['coupon_codes']
-            discount_code = None
-            if coupon_codes:
-                discount_code, _ = DiscountCode.objects.get_or_create(name=coupon_codes[0])
-
-            product, _ = self._get_or_create(Product2.__name__, name=course_id)
-            pricebook_entry, _ = self._get_or_create_pricebook_entry(self.pricebook, product, list_price)
-
-            OpportunityContactRole.objects.create(
+        children_created = self._create_children((Opportunity.__name__, opportunity.pk), created, [
+            partial(
+                self._create,
+                OpportunityContactRole,
+                lead.username,
                 opportunity=opportunity,
                 contact=lead.converted_contact,
                 role='Participant',
                 is_primary=True
-            )
-
-            OpportunityLineItem.objects.create(
+            ),
+            partial(
+                self._create_with_references,
+                OpportunityLineItem,
+                lead.username,
+                partial(self._line_item_references, course_purchase_data),
                 opportunity=opportunity,
-                pricebook_entry=pricebook_entry,
                 quantity=quantity,
-                list_price=list_price,
+                list_price=course_purchase_data['list_price'],
                 total_price=total_price,
-                discount_code=discount_code,
-            )
+            ),
+        ])
+        return created or children_created
 
-        return created
+    def _line_item_references(self, course_purchase_data):
+        """
+        Gets or creates the PricebookEntry and the DiscountCode, if any, of the OpportunityLineItem of the
+        given course purchase, and returns them as a dict of field values.
+        """
+        coupon_codes = course_purchase_data['coupon_codes']
+        discount_code = None
+        if coupon_codes:
+            discount_code, _ = self._get_or_create(DiscountCode.__name__, name=coupon_codes[0])
+
+        product, _ = self._get_or_create(Product2.__name__, name=course_purchase_data['course_id'])
+        with self.stats.phase('pricebook entries'):
+            pricebook_entry, _ = self._get_or_create_pricebook_entry(
+                self.pricebook, product, course_purchase_data['list_price']
+            )
+        return {'pricebook_entry': pricebook_entry, 'discount_code': discount_code}
 
     def _update_field(self, model, field, value):
         """
@@ -372,40 +1556,135 @@ class Command(BaseCommand):
             user_data (dict): Dictionary containing user account and associated course purchase data.
 
         Returns:
-            boolean, True if the model was updated, False if the model was not updated.
-        """
-        first_name, last_name = parse_user_full_name(user_data['full_name'])
-        fields = (
-            'email',
-            'first_name',
-            'last_name',
-            'country',
-            'year_of_birth',
-            'language',
-            'level_of_education',
-            'interest',
-            'gender',
-            'registration_date',
-        )
-        data = (
-            user_data['email'],
-            first_name,
-            last_name,
-            COUNTRIES_BY_CODE.get((user_data['country'] or '').upper()),
-            str(user_data['year_of_birth']),
-            settings.LANGUAGES_BY_CODE.get(user_data['language']),
-            EDUCATION_BY_CODE.get((user_data['level_of_education'] or '').lower()),
-            user_data['goals'].strip() or None,
-            (user_data['gender'] or '').upper() or None,
-            # Truncate microseconds because Salesforce DateTime fields do not support microsecond precision
-            pytz.utc.localize(user_data['registration_date'].replace(microsecond=0)),
-        )
+            list, the names of the fields which changed and were saved, empty if the model was not updated.
+        """
+        fields = self._apply_user_data(model, user_data)
+        if fields:
+            with self.stats.phase('lead and contact update'):
+                self._save(model, user_data['username'], fields)
 
-        model_updated = False
-        for field, value in izip(fields, data):
-            model_updated = self._update_field(model, field, value) or model_updated
+        return fields
 
-        if model_updated:
-            model.save()
+    def _apply_user_data(self, model, user_data):
+        """
+        Sets the fields of a Lead or Contact model to the user account data, without saving the model.
+
+        Arguments:
+            model (Lead or Contact): Lead or Contact model which will be updated.
+            user_data (dict): Dictionary containing user account and associated course purchase data.
+
+        Returns:
+            list, the names of the fields which changed.
+        """
+        return [
+            field for field, value in _user_fields(user_data).items() if self._update_field(model, field, value)
+        ]
+
+
+def _user_fields(user_data):
+    """
+    Returns the values of the Lead or Contact fields of the given user account data, by field name.
+    """
+    first_name, last_name = parse_user_full_name(user_data['full_name'])
+    fields = (
+        'email',
+        'first_name',
+        'last_name',
+        'country',
+        'year_of_birth',
+        'language',
+        'level_of_education',
+        'interest',
+        'gender',
+        'registration_date',
+    )
+    data = (
+        user_data['email'],
+        first_name,
+        last_name,
+        COUNTRIES_BY_CODE.get((user_data['country'] or '').upper()),
+        str(user_data['year_of_birth']),
+        settings.LANGUAGES_BY_CODE.get(user_data['language']),
+        EDUCATION_BY_CODE.get((user_data['level_of_education'] or '').lower()),
+        user_data['goals'].strip() or None,
+        (user_data['gender'] or '').upper() or None,
+        # Truncate microseconds because Salesforce DateTime fields do not support microsecond precision
+        pytz.utc.localize(user_data['registration_date'].replace(microsecond=0)),
+    )
+    return OrderedDict(izip(fields, data))
 
-        return model_updated
+
+def _user_fingerprint(user_data):
+    """
+    Returns the fingerprint of the Lead or Contact fields and the course purchases of the given user
+    account data. The order of the purchases doesn't change the fingerprint.
+    """
+    return value_digest({
+        'fields': _user_fields(user_data),
+        'courses': sorted(value_digest(course) for course in user_data['courses'] or ()),
+    })
+
+
+def _iter_purchases(users):
+    """
+    Returns an iterator over the course purchases of the given users. The purchases of the users of a
+    UserDataStream are those it fetched when it was created, so the stream isn't consumed.
+    """
+    if isinstance(users, UserDataStream):
+        return users.orders()
+    return (course for user in users for course in user.get('courses') or ())
+
+
+def _opportunity_key(lookup):
+    """
+    Returns the key of the prefetched Opportunities index for the given OPPORTUNITY_LOOKUP_FIELDS values.
+    The values are converted like Salesforce returns them, e.g. purchase datetimes to dates.
+    """
+    return tuple(
+        Opportunity._meta.get_field(field).to_python(lookup[field])  # pylint: disable=protected-access
+        for field in OPPORTUNITY_LOOKUP_FIELDS
+    )
+
+
+@contextmanager
+def _worker_pool(workers, initializer=None):
+    """
+    Return a context manager for the thread pool users are synchronized on. No pool is provided
+    if users are synchronized one at a time.
+
+    Django database connections are local to each thread, so each worker opens its own
+    Salesforce connection and session, and calls the given initializer, if any, when it starts.
+    """
+    if workers <= 1:
+        yield None
+        return
+
+    pool = ThreadPool(workers, initializer)
+    try:
+        yield pool
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _skip_completed_users(users, completed, status_count):
+    """
+    Yield the given users which aren't among the given completed users, counting the statuses of the
+    completed users in `status_count`.
+    """
+    for user in users:
+        if user['username'] not in completed:
+            yield user
+        elif completed[user['username']] is not None:
+            status_count[completed[user['username']]] += 1
+
+
+def _iter_batches(items, size):
+    """
+    Yield successive lists of at most `size` items, reading the items one batch at a time.
+    """
+    items = iter(items)
+    batch = list(islice(items, size))
+    while batch:
+        yield batch
+        batch = list(islice(items, size))
@@ -0,0 +1,190 @@
+"""Mixins shared by the edx_salesforce management commands."""
+
+from __future__ import absolute_import, unicode_literals
+
+from contextlib import contextmanager
+
+from edx_salesforce.edx_data import fetch_watermarks, observe_query_rows
+from edx_salesforce.metrics import MetricsExporter
+from edx_salesforce.state import load_watermarks, save_watermarks
+
+
+class UserDataExtractionMixin(object):
+    """
+    Mixin for management commands which extract Open EdX user data with fetch_user_data.
+
+    The commands must provide the site_domain and orgs options.
+    """
+
+    watermarks = None
+
+    def add_extraction_arguments(self, parser):
+        """
+        Adds the command line options which control how user data is extracted.
+        """
+        parser.add_argument(
+            '--batch-size',
+            dest='batch_size',
+            type=int,
+            default=None,
+            help=(
+                'Maximum number of users whose data is fetched from the edxapp database in a single query. '
+                'By default the data of all users is fetched in one query.'
+            )
+        )
+        parser.add_argument(
+            '--stream',
+            dest='stream',
+            action='store_true',
+            default=False,
+            help=(
+                'Fetch and process user data one batch of users at a time instead of loading '
+                'the data for all users into memory. The batch size is set by --batch-size.'
+            )
+        )
+        parser.add_argument(
+            '--parallel',
+            dest='parallel',
+            action='store_true',
+            default=False,
+            help=(
+                'Run the independent queries against the edxapp and ecommerce databases '
+                'concurrently, each on its own thread and database connection.'
+            )
+        )
+        parser.add_argument(
+            '--single-pass',
+            dest='single_pass',
+            action='store_true',
+            default=False,
+            help=(
+                'Fetch the profile, language preference and campaign tracking data of the users '
+                'with a single query returning one row per user.'
+            )
+        )
+        parser.add_argument(
+            '--use-snapshot',
+            dest='use_snapshot',
+            action='store_true',
+            default=False,
+            help=(
+                'Reuse the on-disk snapshot of the user data extracted by an earlier run for the same '
+                'site, orgs and database state, if it is younger than the snapshot TTL. Otherwise the '
+                'extracted user data is stored in a new snapshot.'
+            )
+        )
+        parser.add_argument(
+            '--incremental',
+            dest='incremental',
+            action='store_true',
+            default=False,
+            help=(
+                'Only fetch the users and orders which changed since the last successful incremental '
+                'run of this command for the same site and orgs, and record the new watermarks when '
+                'this run succeeds.'
+            )
+        )
+        parser.add_argument(
+            '--full',
+            dest='full',
+            action='store_true',
+            default=False,
+            help=(
+                'Fetch all users and orders, ignoring the watermarks of previous incremental runs, '
+                'and record the new watermarks when this run succeeds.'
+            )
+        )
+
+    def get_extraction_kwargs(self, options):
+        """
+        Returns the keyword arguments for fetch_user_data built from the command options.
+
+        With --incremental or --full, the current watermarks are taken before any user data is
+        fetched so that changes made while the command runs are fetched again by the next run.
+        """
+        kwargs = {
+            'batch_size': options.get('batch_size'),
+            'stream': options.get('stream', False),
+            'parallel': options.get('parallel', False),
+            'single_pass': options.get('single_pass', False),
+            'snapshot': options.get('use_snapshot', False),
+        }
+
+        self.watermarks = None
+        if options.get('incremental') or options.get('full'):
+            self.watermarks = fetch_watermarks()
+            if not options.get('full'):
+                kwargs['since'] = load_watermarks(
+                    self._command_name(), options['site_domain'], options['orgs']
+                )
+
+        return kwargs
+
+    def save_extraction_watermarks(self, options):
+        """
+        Records the watermarks taken by get_extraction_kwargs for the next incremental run.
+        Should only be called once the command has successfully processed the user data.
+        """
+        if self.watermarks is not None:
+            save_watermarks(self._command_name(), options['site_domain'], options['orgs'], self.watermarks)
+
+    def _command_name(self):
+        """
+        Returns the name of the management command.
+        """
+        return self.__module__.rsplit('.', 1)[-1]
+
+
+class MetricsExportMixin(object):
+    """
+    Mixin for management commands which export the RunStats of their run as metrics files.
+
+    The commands must set the stats attribute to the RunStats of the run, and provide _command_name,
+    e.g. with UserDataExtractionMixin.
+    """
+
+    stats = None
+
+    def add_metrics_arguments(self, parser):
+        """
+        Adds the command line options which select the metrics files the run is exported to.
+        """
+        parser.add_argument(
+            '--metrics-textfile',
+            dest='metrics_textfile',
+            default=None,
+            help=(
+                'Write the metrics of the run to this Prometheus textfile collector file, periodically '
+                'while the command runs and once it ends.'
+            )
+        )
+        parser.add_argument(
+            '--metrics-json',
+            dest='metrics_json',
+            default=None,
+            help='Write the metrics of the run to this JSON file, periodically while the command runs and once it ends.'
+        )
+
+    @contextmanager
+    def export_metrics(self, options):
+        """
+        Returns a context manager which writes the metrics files selected by the command options, if
+        any, while its block runs and once it exits, and counts the rows of the extraction queries run
+        within it. Streamed user data is fetched while it is processed, so the block should cover the
+        whole run.
+        """
+        textfile_path = options.get('metrics_textfile')
+        json_path = options.get('metrics_json')
+        exporter = None
+        if textfile_path or json_path:
+            exporter = MetricsExporter(self.stats, self._command_name(), textfile_path, json_path)
+            exporter.start()
+
+        complete = False
+        try:
+            with observe_query_rows(self.stats.count_rows):
+                yield
+            complete = True
+        finally:
+            if exporter is not None:
+                exporter.stop(complete)
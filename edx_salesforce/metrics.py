@@ -0,0 +1,155 @@
+"""
+Provides the export of the RunStats of a command run as metrics files.
+
+The metrics are written to a Prometheus textfile collector file, a JSON file, or both, every
+EDX_SALESFORCE_METRICS_INTERVAL seconds while the command runs and once more when it ends, so
+that a slow or stalled run shows up on the dashboards before it completes. Each file is replaced
+atomically, so the collector never reads a partially written file.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import json
+import os
+import threading
+import time
+
+from django.conf import settings
+
+# Number of seconds between the writes of the metrics files during a run, unless set by the
+# EDX_SALESFORCE_METRICS_INTERVAL setting.
+DEFAULT_METRICS_INTERVAL = 60
+
+# Prefix of the names of the exported Prometheus metrics.
+METRIC_PREFIX = 'edx_salesforce'
+
+
+class MetricsExporter(object):
+    """
+    Periodically writes the stats of a command run to metrics files.
+
+    Arguments:
+        stats (RunStats): The stats of the run.
+        command_name (string): The name of the command, exported as the command label of the metrics.
+        textfile_path (string): The path of the Prometheus textfile collector file, if any.
+        json_path (string): The path of the JSON file, if any.
+    """
+
+    def __init__(self, stats, command_name, textfile_path=None, json_path=None):
+        self.stats = stats
+        self.command_name = command_name
+        self.textfile_path = textfile_path
+        self.json_path = json_path
+        self.interval = getattr(settings, 'EDX_SALESFORCE_METRICS_INTERVAL', DEFAULT_METRICS_INTERVAL)
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """
+        Write the metrics files, then write them again every interval in a background thread.
+        """
+        self.write()
+        self._thread = threading.Thread(target=self._run, name='metrics-exporter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, complete):
+        """
+        Stop the background writes and write the final metrics files.
+
+        Arguments:
+            complete (bool): Whether the run completed successfully.
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.write(complete)
+
+    def write(self, complete=False):
+        """
+        Write the current metrics files.
+        """
+        stats = self.stats.as_dict()
+        stats.update(command=self.command_name, complete=complete, timestamp=time.time())
+        if self.textfile_path:
+            _write_atomically(self.textfile_path, prometheus_text(stats))
+        if self.json_path:
+            _write_atomically(self.json_path, json.dumps(stats, sort_keys=True))
+
+    def _run(self):
+        """
+        Write the metrics files every interval until the exporter is stopped.
+        """
+        while not self._stopped.wait(self.interval):
+            self.write()
+
+
+def prometheus_text(stats):
+    """
+    Return the given stats of a run in the Prometheus text exposition format. Every sample has the
+    command label, and the values of each run replace those of the previous run, so all metrics are
+    gauges.
+    """
+    command = {'command': stats['command']}
+    latency = stats['user_latency']
+    metrics = [
+        ('run_complete', 'Whether the run completed successfully.', [(command, int(stats['complete']))]),
+        ('last_update_timestamp_seconds', 'Time the metrics were written at.', [(command, stats['timestamp'])]),
+        ('elapsed_seconds', 'Seconds since the run started.', [(command, stats['elapsed'])]),
+        ('users', 'Users processed by the run, by status.', [
+            (dict(command, status=status), count) for status, count in sorted(stats['users'].items())
+        ]),
+        ('users_per_second', 'Users processed per second.', [(command, stats['users_per_second'])]),
+        ('retries', 'Retries after transient errors.', [(command, stats['retries'])]),
+        ('query_rows', 'Rows returned by the extraction queries, by query.', [
+            (dict(command, query=query), count) for query, count in sorted(stats['query_rows'].items())
+        ]),
+        ('phase_seconds', 'Seconds spent in each phase, summed over workers.', [
+            (dict(command, phase=phase), values['seconds']) for phase, values in stats['phases'].items()
+        ]),
+        ('api_calls', 'Salesforce API requests, by object type and operation.', [
+            (dict(command, object_type=object_type, operation=operation), count)
+            for object_type, operations in sorted(stats['api_calls'].items())
+            for operation, count in sorted(operations.items())
+        ]),
+        ('user_latency_seconds', 'Percentiles of the seconds taken to process a single user.', [
+            (dict(command, quantile='{:g}'.format(float(key[1:]) / 100)), latency[key])
+            for key in latency if key.startswith('p') and latency[key] is not None
+        ]),
+    ]
+
+    lines = []
+    for name, description, samples in metrics:
+        if not samples:
+            continue
+        name = '{prefix}_{name}'.format(prefix=METRIC_PREFIX, name=name)
+        lines.append('# HELP {name} {description}'.format(name=name, description=description))
+        lines.append('# TYPE {name} gauge'.format(name=name))
+        for labels, value in samples:
+            lines.append('{name}{{{labels}}} {value}'.format(
+                name=name,
+                labels=','.join(
+                    '{label}="{value}"'.format(label=label, value=_escape_label_value(value))
+                    for label, value in sorted(labels.items())
+                ),
+                value=repr(float(value)),
+            ))
+    return '\n'.join(lines) + '\n'
+
+
+def _escape_label_value(value):
+    """
+    Return the given label value escaped for the Prometheus text exposition format.
+    """
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _write_atomically(path, content):
+    """
+    Replace the file at the given path with the given text.
+    """
+    tmp_path = '{path}.tmp'.format(path=path)
+    with open(tmp_path, 'wb') as metrics_file:  # pylint: disable=open-builtin
+        metrics_file.write(content.encode('utf-8'))
+    os.rename(tmp_path, path)
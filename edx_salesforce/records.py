@@ -0,0 +1,134 @@
+"""
+Provides compact records for holding the rows of the EdX data extraction queries.
+
+A record stores its fields in slots rather than in a per-row dict, while still
+supporting the read and write access of a dict, so code written against dict
+rows works unchanged against records.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+from collections import Mapping
+
+# Record classes by name and fields, so each class is only built once.
+_RECORD_CLASSES = {}
+
+
+class Record(object):
+    """
+    Base class of the record classes returned by record_class.
+    """
+    __slots__ = ()
+    _fields = ()
+    _field_set = frozenset()
+
+    def __init__(self, values=(), **kwargs):
+        for field, value in zip(self._fields, values):
+            setattr(self, field, value)
+        for field in self._fields[len(values):]:
+            setattr(self, field, kwargs.pop(field, None))
+        for field, value in kwargs.items():
+            self[field] = value
+
+    def __getitem__(self, key):
+        if key not in self._field_set:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self._field_set:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self._field_set
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __eq__(self, other):
+        if not isinstance(other, Mapping):
+            return NotImplemented
+        return dict(self.items()) == dict(other.items())
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __reduce__(self):
+        return _make_record, (type(self).__name__, self._fields, self.values())
+
+    def __repr__(self):
+        return '{name}({fields})'.format(
+            name=type(self).__name__,
+            fields=', '.join('{}={!r}'.format(field, value) for field, value in self.items()),
+        )
+
+    def get(self, key, default=None):
+        """
+        Return the value of the given field, or `default` if the record has no such field.
+        """
+        return getattr(self, key) if key in self._field_set else default
+
+    def items(self):
+        """
+        Return the list of (field, value) pairs of the record.
+        """
+        return [(field, getattr(self, field)) for field in self._fields]
+
+    def keys(self):
+        """
+        Return the list of fields of the record.
+        """
+        return list(self._fields)
+
+    def values(self):
+        """
+        Return the list of values of the record.
+        """
+        return [getattr(self, field) for field in self._fields]
+
+
+Mapping.register(Record)
+
+
+def record_class(name, fields):
+    """
+    Return the record class with the given name and fields, building it on first use.
+
+    Arguments:
+        name (string): The name of the record class.
+        fields (list of strings): The names of the fields of the records.
+
+    Returns:
+        Record subclass, whose instances are built from a sequence of field values.
+
+    Raises:
+        ValueError: if a field name is not an identifier or clashes with a Record attribute.
+    """
+    fields = tuple(str(field) for field in fields)
+    key = (name, fields)
+    cls = _RECORD_CLASSES.get(key)
+    if cls is None:
+        for field in fields:
+            if not (field.replace('_', 'a').isalnum() and not field[0].isdigit()) or hasattr(Record, field):
+                raise ValueError('Invalid record field name: {field}'.format(field=field))
+        cls = type(str(name), (Record,), {
+            '__slots__': fields,
+            '_fields': fields,
+            '_field_set': frozenset(fields),
+        })
+        _RECORD_CLASSES[key] = cls
+    return cls
+
+
+def _make_record(name, fields, values):
+    """
+    Return a record of the given class built from the given values. Used to unpickle records.
+    """
+    return record_class(name, fields)(values)
@@ -0,0 +1,116 @@
+"""
+Provides a persistent cache of the Salesforce IDs of reference objects.
+
+Reference objects, e.g. Campaigns, Product2s, PricebookEntries and DiscountCodes, are shared
+by many users and rarely change, so their IDs are kept in a state file between runs instead of
+being looked up again by every run. Entries expire after the EDX_SALESFORCE_REFERENCE_CACHE_TTL
+setting, and the least recently used entries are evicted once the cache holds more than
+EDX_SALESFORCE_REFERENCE_CACHE_SIZE entries.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+from edx_salesforce.state import org_key, read_state, state_path, write_state
+
+# Number of seconds an entry is used for, unless set by the EDX_SALESFORCE_REFERENCE_CACHE_TTL setting.
+DEFAULT_REFERENCE_CACHE_TTL = 7 * 24 * 60 * 60
+
+# Maximum number of entries, unless set by the EDX_SALESFORCE_REFERENCE_CACHE_SIZE setting.
+DEFAULT_REFERENCE_CACHE_SIZE = 10000
+
+
+class ReferenceCache(object):
+    """
+    Cache of the IDs of Salesforce objects by model name and lookup fields, stored in a state file.
+
+    The cache can be used by several threads at once.
+
+    Arguments:
+        path (string): The path of the state file the cache is loaded from and saved to.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.ttl = getattr(settings, 'EDX_SALESFORCE_REFERENCE_CACHE_TTL', DEFAULT_REFERENCE_CACHE_TTL)
+        self.max_size = getattr(settings, 'EDX_SALESFORCE_REFERENCE_CACHE_SIZE', DEFAULT_REFERENCE_CACHE_SIZE)
+        self.lock = threading.Lock()
+
+        # Entries by key, from the least to the most recently used.
+        self.entries = OrderedDict()
+        stored = read_state(path) or {}
+        for key, entry in sorted(stored.items(), key=lambda item: item[1]['used']):
+            if not self._expired(entry):
+                self.entries[key] = entry
+
+    def get(self, model_name, lookup):
+        """
+        Return the cached ID and fields of the object of the given model with the given lookup
+        field values, or None if it isn't cached or its entry expired.
+
+        Returns:
+            dict, with the ID of the object under 'id' and its other cached fields under 'fields'.
+        """
+        key = _cache_key(model_name, lookup)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or self._expired(entry):
+                return None
+            entry['used'] = time.time()
+            self.entries[key] = entry
+            return entry
+
+    def set(self, model_name, lookup, pk, **fields):
+        """
+        Cache the ID and the given other fields of the object of the given model with the given
+        lookup field values.
+        """
+        key = _cache_key(model_name, lookup)
+        now = time.time()
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = {'id': pk, 'fields': fields, 'cached': now, 'used': now}
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, model_name, lookup):
+        """
+        Remove the entry of the object of the given model with the given lookup field values.
+        """
+        with self.lock:
+            self.entries.pop(_cache_key(model_name, lookup), None)
+
+    def save(self):
+        """
+        Store the cache in its state file.
+        """
+        with self.lock:
+            write_state(self.path, dict(self.entries))
+
+    def _expired(self, entry):
+        """
+        Return whether the given entry is older than the TTL.
+        """
+        return entry['cached'] <= time.time() - self.ttl
+
+
+def reference_cache_path(alias='salesforce'):
+    """
+    Return the path of the reference cache of the Salesforce org configured for the given database.
+    """
+    return state_path('reference_cache', '{org}.json'.format(org=org_key(alias)))
+
+
+def _cache_key(model_name, lookup):
+    """
+    Return the key of the entry of the object of the given model with the given lookup field values.
+    """
+    return '{model}:{lookup}'.format(model=model_name, lookup=json.dumps(
+        sorted((field, '{}'.format(value)) for field, value in lookup.items())
+    ))
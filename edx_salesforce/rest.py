@@ -0,0 +1,79 @@
+"""
+Provides the base of the clients for the Salesforce REST API resources which django-salesforce does not use.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+from salesforce.backend.driver import SalesforceError, handle_api_exceptions
+
+from django.conf import settings
+from django.db import connections
+
+# API version of the resources used by the clients. The Bulk API 2.0 is available from
+# version 41.0 and sObject Collections from version 42.0, while django-salesforce uses an
+# older version for its own requests.
+DEFAULT_API_VERSION = '42.0'
+
+# Number of seconds to wait for a response to a single request.
+REST_REQUEST_TIMEOUT = 120
+
+
+class RestApiError(Exception):
+    """
+    Raised when a request to the Salesforce REST API fails.
+
+    Arguments:
+        message (string): The description of the failure.
+        cause (SalesforceError): The error the request failed with, if any.
+    """
+
+    def __init__(self, message, cause=None):
+        super(RestApiError, self).__init__(message)
+        self.cause = cause
+
+
+class RestApiClient(object):
+    """
+    Base class of the Salesforce REST API clients.
+
+    Arguments:
+        session (requests.Session): The authenticated session used to make requests.
+        instance_url (string): The URL of the Salesforce instance.
+    """
+    error_class = RestApiError
+
+    def __init__(self, session, instance_url):
+        self.session = session
+        self.instance_url = instance_url
+
+    @classmethod
+    def from_connection(cls, alias='salesforce'):
+        """
+        Return a client using the session of the given django-salesforce database connection.
+        """
+        session = connections[alias].sf_session
+        return cls(session, session.auth.instance_url)
+
+    def _request(self, method, path, **kwargs):
+        """
+        Make a request to the REST API and return its decoded JSON response, if any.
+
+        Raises:
+            RestApiError: if the request fails.
+        """
+        url = '{base}/services/data/v{version}/{path}'.format(
+            base=self.instance_url,
+            version=getattr(settings, 'EDX_SALESFORCE_API_VERSION', DEFAULT_API_VERSION),
+            path=path,
+        )
+        kwargs.setdefault('timeout', REST_REQUEST_TIMEOUT)
+        try:
+            response = handle_api_exceptions(url, getattr(self.session, method), **kwargs)
+        except SalesforceError as error:
+            raise self.error_class('{method} {url} failed: {error}'.format(
+                method=method.upper(), url=url, error=error
+            ), error)
+
+        if response.headers.get('Content-Type', '').startswith('application/json') and response.content:
+            return response.json()
+        return response
@@ -0,0 +1,140 @@
+"""
+Provides an on-disk snapshot cache of extracted EdX user data.
+
+A snapshot file starts with a header holding SNAPSHOT_MAGIC and the number of users,
+followed by blocks of users. Each block is a zlib compressed pickle of a list of at most
+SNAPSHOT_BLOCK_SIZE users, prefixed by its length. Snapshots are read through a memory map
+one block at a time, so only a single block of users is held in memory while a snapshot
+is consumed.
+
+Snapshots are written to the local state directory and are trusted: they are only ever
+read by the commands which wrote them.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import cPickle as pickle
+import mmap
+import os
+import struct
+import time
+import zlib
+
+from django.conf import settings
+
+from edx_salesforce.state import run_key, state_path, value_digest
+
+# Identifies snapshot files and the version of their format.
+SNAPSHOT_MAGIC = b'EDXSNAP1'
+
+# Number of users stored in each compressed block of a snapshot.
+SNAPSHOT_BLOCK_SIZE = 1000
+
+# Number of seconds a snapshot is used for, unless set by the EDX_SALESFORCE_SNAPSHOT_TTL setting.
+DEFAULT_SNAPSHOT_TTL = 6 * 60 * 60
+
+_HEADER = struct.Struct(str('>8sQ'))
+_BLOCK_LENGTH = struct.Struct(str('>I'))
+
+
+class Snapshot(object):
+    """
+    Iterable over the users stored in a snapshot file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as snapshot_file:  # pylint: disable=open-builtin
+            magic, self.user_count = _HEADER.unpack(snapshot_file.read(_HEADER.size))
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError('{path} is not a user data snapshot'.format(path=path))
+
+    def __len__(self):
+        return self.user_count
+
+    def __iter__(self):
+        if not self.user_count:
+            return
+
+        with open(self.path, 'rb') as snapshot_file:  # pylint: disable=open-builtin
+            data = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                offset = _HEADER.size
+                while offset < len(data):
+                    length, = _BLOCK_LENGTH.unpack_from(data, offset)
+                    offset += _BLOCK_LENGTH.size
+                    for user in pickle.loads(zlib.decompress(data[offset:offset + length])):
+                        yield user
+                    offset += length
+            finally:
+                data.close()
+
+
+def load_snapshot(path):
+    """
+    Return the snapshot stored at the given path, or None if there is no snapshot
+    or the snapshot is older than the snapshot TTL.
+    """
+    ttl = getattr(settings, 'EDX_SALESFORCE_SNAPSHOT_TTL', DEFAULT_SNAPSHOT_TTL)
+    if not os.path.exists(path) or os.path.getmtime(path) < time.time() - ttl:
+        return None
+    return Snapshot(path)
+
+
+def snapshot_path(site_domain, orgs, since, watermarks):
+    """
+    Return the path of the snapshot of the user data extracted for the given site and orgs.
+
+    Arguments:
+        site_domain (string): The domain of the site the user data is extracted for.
+        orgs (list of strings): The organizations the user data is extracted for.
+        since (dict): The watermarks the user data changed after, if the extraction is incremental.
+        watermarks (dict): The current watermarks returned by edx_data.fetch_watermarks.
+    """
+    return state_path('snapshots', '{run}-{data}.snapshot'.format(
+        run=run_key(site_domain, orgs),
+        data=value_digest({'since': since, 'watermarks': watermarks}),
+    ))
+
+
+def write_snapshot(path, users):
+    """
+    Store the given users in a snapshot file at the given path. The users are read one block
+    at a time, so a UserDataStream is never held in memory as a whole.
+
+    The file is replaced atomically once all users are written. Older snapshots of the same
+    site and orgs are removed.
+    """
+    tmp_path = '{path}.tmp'.format(path=path)
+    with open(tmp_path, 'wb') as snapshot_file:  # pylint: disable=open-builtin
+        snapshot_file.write(_HEADER.pack(SNAPSHOT_MAGIC, 0))
+        user_count = 0
+        block = []
+        for user in users:
+            block.append(user)
+            if len(block) == SNAPSHOT_BLOCK_SIZE:
+                user_count += _write_block(snapshot_file, block)
+                block = []
+        if block:
+            user_count += _write_block(snapshot_file, block)
+
+        # The number of users is only known once they have all been read.
+        snapshot_file.seek(0)
+        snapshot_file.write(_HEADER.pack(SNAPSHOT_MAGIC, user_count))
+
+    run_prefix = '{run}-'.format(run=os.path.basename(path).rsplit('-', 1)[0])
+    directory = os.path.dirname(path)
+    for filename in os.listdir(directory):
+        if filename.startswith(run_prefix) and filename.endswith('.snapshot'):
+            os.remove(os.path.join(directory, filename))
+    os.rename(tmp_path, path)
+
+
+def _write_block(snapshot_file, block):
+    """
+    Write a compressed block of users to a snapshot file. Returns the number of users written.
+    """
+    data = zlib.compress(pickle.dumps(block, pickle.HIGHEST_PROTOCOL))
+    snapshot_file.write(_BLOCK_LENGTH.pack(len(data)))
+    snapshot_file.write(data)
+    return len(block)
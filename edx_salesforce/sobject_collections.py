@@ -0,0 +1,173 @@
+"""
+Provides buffered writes of Salesforce objects through the sObject Collections REST resource.
+
+A WriteBuffer collects the creates and updates of Salesforce objects and sends them in
+requests of up to COLLECTION_SIZE records each, instead of a request per object. Requests
+are sent with allOrNone disabled, so a failed record doesn't roll back the others, and the
+errors of failed records are recorded by the key the writes were buffered with.
+
+See the "sObject Collections" resource in the Salesforce REST API Developer Guide.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+from collections import OrderedDict, defaultdict
+from itertools import izip
+
+from salesforce.backend.query import process_json_args
+from salesforce.fields import NOT_CREATEABLE, NOT_UPDATEABLE, DefaultedOnCreate
+
+from edx_salesforce.rest import RestApiClient, RestApiError
+
+# Maximum number of records in a single sObject Collections request.
+COLLECTION_SIZE = 200
+
+
+class SObjectCollectionsClient(RestApiClient):
+    """
+    Client for the sObject Collections resource.
+    """
+
+    def create(self, records):
+        """
+        Create the given records and return the result of each record, in the same order.
+
+        Arguments:
+            records (list of dicts): The field values of each record, keyed by field API name,
+                                     with the type of the record under 'attributes'.
+        """
+        return self._request('post', 'composite/sobjects', json={'allOrNone': False, 'records': records})
+
+    def update(self, records):
+        """
+        Update the given records and return the result of each record, in the same order.
+
+        Arguments:
+            records (list of dicts): The field values of each record, keyed by field API name,
+                                     with the type of the record under 'attributes'.
+        """
+        return self._request('patch', 'composite/sobjects', json={'allOrNone': False, 'records': records})
+
+
+class WriteBuffer(object):
+    """
+    Buffers the creates and updates of Salesforce objects and sends them in sObject Collections requests.
+
+    Buffered writes are sent in the order their operation and model were first buffered, so objects
+    created earlier can be referenced by objects buffered later: foreign keys are only read when the
+    objects are sent. All buffered writes are sent once a collection of COLLECTION_SIZE is full.
+
+    Arguments:
+        client (SObjectCollectionsClient): The client the writes are sent with.
+        size (int): The maximum number of records sent in a single request.
+    """
+
+    def __init__(self, client, size=COLLECTION_SIZE):
+        self.client = client
+        self.size = size
+        self.failures = defaultdict(list)
+        # Lists of [obj, fields, key] writes by (operation, model), and the pending write of each object.
+        self._pending = OrderedDict()
+        self._pending_objects = {}
+
+    def create(self, model, key, **kwargs):
+        """
+        Buffer the creation of a new object of the given model and return the unsaved object.
+        Its primary key is set once it is created.
+        """
+        obj = model(**kwargs)
+        self.save(obj, key)
+        return obj
+
+    def save(self, obj, key, fields=None):
+        """
+        Buffer the creation of the given object, or the update of the given fields if it exists.
+
+        Arguments:
+            obj (Model): The Salesforce object to save.
+            key (string): The key the errors of the write are recorded by.
+            fields (iterable of strings): The names of the fields to update, or None for all fields.
+                                          New objects are always created with all their fields.
+        """
+        write = self._pending_objects.get(id(obj))
+        if write is not None:
+            # An object saved again before it is sent is written once, with the fields of both saves.
+            if write[1] is not None:
+                write[1] = None if fields is None else write[1] | set(fields)
+            return
+
+        operation = 'update' if obj.pk else 'create'
+        write = [obj, set(fields) if operation == 'update' and fields is not None else None, key]
+        writes = self._pending.setdefault((operation, type(obj)), [])
+        writes.append(write)
+        self._pending_objects[id(obj)] = write
+        if len(writes) >= self.size:
+            self.flush()
+
+    def flush(self):
+        """
+        Send all buffered writes.
+        """
+        while self._pending:
+            (operation, model), writes = self._pending.popitem(last=False)
+            for write in writes:
+                del self._pending_objects[id(write[0])]
+            for index in range(0, len(writes), self.size):
+                self._send(operation, model, writes[index:index + self.size])
+
+    def pop_failures(self):
+        """
+        Return the errors of the failed writes by key, and forget them.
+        """
+        failures, self.failures = self.failures, defaultdict(list)
+        return dict(failures)
+
+    def _send(self, operation, model, writes):
+        """
+        Send a single sObject Collections request with the given writes.
+        """
+        records = [_record(obj, fields, operation) for obj, fields, _ in writes]
+        try:
+            results = getattr(self.client, operation)(records)
+        except RestApiError as error:
+            for _, _, key in writes:
+                self.failures[key].append('{model}: {error}'.format(model=model.__name__, error=error))
+            return
+
+        for (obj, _, key), result in izip(writes, results):
+            if result['success']:
+                if operation == 'create':
+                    obj.pk = result['id']
+            else:
+                for error in result['errors']:
+                    self.failures[key].append('{model}: {code}: {message}'.format(
+                        model=model.__name__, code=error['statusCode'], message=error['message']
+                    ))
+
+
+def _record(obj, fields, operation):
+    """
+    Return the sObject Collections record of the given object, serialized like django-salesforce
+    serializes the values of an insert or update.
+    """
+    meta = obj._meta  # pylint: disable=protected-access
+    record = {'attributes': {'type': meta.db_table}}
+    if operation == 'update':
+        record[meta.pk.column] = obj.pk
+
+    read_only = NOT_UPDATEABLE if operation == 'update' else NOT_CREATEABLE
+    for field in meta.fields:
+        if field.primary_key or getattr(field, 'sf_read_only', 0) & read_only:
+            continue
+        if fields is not None and field.name not in fields:
+            continue
+
+        value = getattr(obj, field.attname)
+        if value is None and field.is_relation:
+            # The related object may have been created after this object was buffered.
+            related = getattr(obj, field.get_cache_name(), None)
+            value = related.pk if related is not None else None
+        if isinstance(value, DefaultedOnCreate) or value in ('DEFAULT', 'DEFAULTED_ON_CREATE'):
+            continue
+        record[field.column], = process_json_args([value])
+    return record
@@ -0,0 +1,186 @@
+"""
+Local state kept by the edx_salesforce management commands between runs.
+
+State files are written to the directory named by the EDX_SALESFORCE_STATE_DIR setting,
+which defaults to PROJECT_ROOT/state.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import hashlib
+import json
+import os
+from collections import Mapping
+from datetime import date, datetime
+from decimal import Decimal
+
+import pytz
+
+from django.conf import settings
+
+
+def load_watermarks(command_name, site_domain, orgs):
+    """
+    Return the watermarks saved by the last successful run of a command for a site and orgs.
+
+    Arguments:
+        command_name (string): The name of the management command.
+        site_domain (string): The domain of the site the command was run for.
+        orgs (list of strings): The organizations the command was run for.
+
+    Returns:
+        dict, the saved watermarks, or None if no watermarks have been saved.
+    """
+    return read_state(state_path('watermarks', command_name, run_key(site_domain, orgs)))
+
+
+def save_watermarks(command_name, site_domain, orgs, watermarks):
+    """
+    Save the watermarks of a successful run of a command for a site and orgs.
+
+    Arguments:
+        command_name (string): The name of the management command.
+        site_domain (string): The domain of the site the command was run for.
+        orgs (list of strings): The organizations the command was run for.
+        watermarks (dict): The watermarks returned by edx_data.fetch_watermarks.
+    """
+    write_state(state_path('watermarks', command_name, run_key(site_domain, orgs)), watermarks)
+
+
+def checkpoint_path(command_name, site_domain, orgs):
+    """
+    Return the path of the checkpoint journal of a run of a command for a site and orgs.
+    """
+    return state_path('checkpoints', command_name, run_key(site_domain, orgs))
+
+
+def dead_letter_path(command_name, site_domain, orgs):
+    """
+    Return the path of the journal of the users a command failed to synchronize for a site and orgs.
+    """
+    return state_path('dead_letters', command_name, run_key(site_domain, orgs))
+
+
+def run_key(site_domain, orgs):
+    """
+    Return a file name safe key identifying a run for a site and set of orgs.
+    """
+    orgs_digest = hashlib.sha1(','.join(sorted(set(orgs))).encode('utf-8')).hexdigest()[:12]
+    return '{site}-{orgs}'.format(site=site_domain.replace(os.sep, '_'), orgs=orgs_digest)
+
+
+def org_key(alias='salesforce'):
+    """
+    Return a file name safe key identifying the Salesforce org configured for the given database,
+    so state kept for one org is never used with another.
+    """
+    database = settings.DATABASES.get(alias, {})
+    return value_digest([database.get('HOST'), database.get('USER')])[:12]
+
+
+def value_digest(value):
+    """
+    Return a digest identifying a value which can be stored in a state file.
+    """
+    return hashlib.sha1(json.dumps(value, default=_encode, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def state_path(*parts):
+    """
+    Return the path of a file in the state directory. Creates its parent directory if it doesn't exist.
+    """
+    state_dir = getattr(settings, 'EDX_SALESFORCE_STATE_DIR', os.path.join(settings.PROJECT_ROOT, 'state'))
+    path = os.path.join(state_dir, *parts)
+    directory = os.path.dirname(path)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    return path
+
+
+def read_state(path):
+    """
+    Return the value stored in a state file, or None if the file doesn't exist.
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as state_file:  # pylint: disable=open-builtin
+        return json.loads(state_file.read().decode('utf-8'), object_hook=_decode)
+
+
+def write_state(path, value):
+    """
+    Store a value in a state file. The file is replaced atomically so that an interrupted
+    run never leaves a partially written file behind.
+    """
+    tmp_path = '{path}.tmp'.format(path=path)
+    with open(tmp_path, 'wb') as state_file:  # pylint: disable=open-builtin
+        state_file.write(json.dumps(value, default=_encode, sort_keys=True).encode('utf-8'))
+    os.rename(tmp_path, path)
+
+
+def append_journal(path, value):
+    """
+    Append a value to a journal file, as a line of JSON written to disk before returning.
+    """
+    with open(path, 'ab') as journal_file:  # pylint: disable=open-builtin
+        journal_file.write(json.dumps(value, default=_encode, sort_keys=True).encode('utf-8') + b'\n')
+        journal_file.flush()
+        os.fsync(journal_file.fileno())
+
+
+def write_journal(path, values):
+    """
+    Replace a journal file with the given list of values. The file is replaced atomically.
+    """
+    tmp_path = '{path}.tmp'.format(path=path)
+    with open(tmp_path, 'wb') as journal_file:  # pylint: disable=open-builtin
+        for value in values:
+            journal_file.write(json.dumps(value, default=_encode, sort_keys=True).encode('utf-8') + b'\n')
+    os.rename(tmp_path, path)
+
+
+def read_journal(path):
+    """
+    Return the list of values appended to a journal file, or an empty list if the file doesn't exist.
+    A last line left incomplete by an interrupted run is ignored.
+    """
+    if not os.path.exists(path):
+        return []
+    values = []
+    with open(path, 'rb') as journal_file:  # pylint: disable=open-builtin
+        for line in journal_file:
+            if not line.endswith(b'\n'):
+                break
+            values.append(json.loads(line.decode('utf-8'), object_hook=_decode))
+    return values
+
+
+def _decode(value):
+    """
+    Restore the values encoded by _encode.
+    """
+    if '__datetime__' in value:
+        return datetime.strptime(value['__datetime__'], '%Y-%m-%dT%H:%M:%S.%f')
+    if '__date__' in value:
+        return datetime.strptime(value['__date__'], '%Y-%m-%d').date()
+    if '__decimal__' in value:
+        return Decimal(value['__decimal__'])
+    return value
+
+
+def _encode(value):
+    """
+    Encode the values which json can't serialize. Timezone aware datetimes are stored in UTC, and
+    mappings which aren't dicts, such as the records of the extracted user data, are stored as dicts.
+    """
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(pytz.utc)
+        return {'__datetime__': value.replace(tzinfo=None).strftime('%Y-%m-%dT%H:%M:%S.%f')}
+    if isinstance(value, date):
+        return {'__date__': value.strftime('%Y-%m-%d')}
+    if isinstance(value, Decimal):
+        return {'__decimal__': str(value)}
+    if isinstance(value, Mapping):
+        return dict(value.items())
+    raise TypeError('{value!r} is not JSON serializable'.format(value=value))
@@ -0,0 +1,224 @@
+"""
+Provides the timing and Salesforce API request accounting of a command run.
+
+The time spent in each phase of a run, e.g. the extraction of the user data or the creation of
+Opportunities, is recorded with RunStats.phase(). Phases may be nested, and the time of a phase
+entered by several workers at once is the sum of the time of each worker. The Salesforce REST API
+requests of the sessions the stats are installed on are counted by object type and operation, and
+the users processed, the retries and the rows returned by each extraction query are counted too.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import json
+import re
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from urlparse import parse_qs, urlparse
+
+from django.db import connections
+
+# Percentiles of the time taken to synchronize a single user which are reported.
+LATENCY_PERCENTILES = (50, 90, 99)
+
+# Matches the path of a REST API resource, with the name of the sObject or sub-resource, if any.
+RESOURCE_PATTERN = re.compile(r'/services/data/v[0-9.]+/(?P<resource>[^/]+)(?:/(?P<name>[^/]+))?')
+
+# Matches the object type a SOQL query selects from, once its subqueries are removed.
+QUERY_OBJECT_PATTERN = re.compile(r'\bFROM\s+(\w+)', re.IGNORECASE)
+SUBQUERY_PATTERN = re.compile(r'\([^()]*\)')
+
+# Operations of the requests to the sObject and sObject Collections resources, by HTTP method.
+SOBJECT_OPERATIONS = {'GET': 'retrieve', 'POST': 'insert', 'PATCH': 'update', 'DELETE': 'delete'}
+
+
+class RunStats(object):
+    """
+    Collects the phase times, the API request and row counts and the per-user latencies of a command run.
+
+    The stats can be updated by several threads at once.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+        # Total seconds and number of times each phase was entered, by phase name.
+        self.phases = OrderedDict()
+
+        # Number of API requests by object type and operation.
+        self.api_calls = defaultdict(lambda: defaultdict(int))
+
+        # Seconds taken to synchronize each user.
+        self.latencies = []
+
+        # Number of users processed by status, number of retries after transient errors, and number of
+        # rows returned by the extraction queries by query name.
+        self.users = OrderedDict()
+        self.retries = 0
+        self.query_rows = defaultdict(int)
+
+    def install(self, alias='salesforce'):
+        """
+        Count the requests of the Salesforce session of the current thread's connection to the given database.
+        """
+        connections[alias].sf_session.hooks['response'].append(self._count_response)
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Return a context manager which records the time spent in its block under the given phase.
+        """
+        started = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - started
+            with self.lock:
+                phase = self.phases.setdefault(name, {'seconds': 0.0, 'count': 0})
+                phase['seconds'] += elapsed
+                phase['count'] += 1
+
+    def count_api_call(self, object_type, operation, count=1):
+        """
+        Count API requests made with the given operation on objects of the given type.
+        """
+        with self.lock:
+            self.api_calls[object_type][operation] += count
+
+    def count_users(self, status, count=1):
+        """
+        Count users processed with the given status.
+        """
+        with self.lock:
+            self.users[status] = self.users.get(status, 0) + count
+
+    def count_retry(self):
+        """
+        Count a retry after a transient error.
+        """
+        with self.lock:
+            self.retries += 1
+
+    def count_rows(self, query_name, count):
+        """
+        Count the rows returned by a run of the given extraction query.
+        """
+        with self.lock:
+            self.query_rows[query_name] += count
+
+    def record_latency(self, seconds):
+        """
+        Record the time taken to synchronize a single user.
+        """
+        with self.lock:
+            self.latencies.append(seconds)
+
+    def as_dict(self):
+        """
+        Return the stats as a JSON serializable dict.
+        """
+        with self.lock:
+            latencies = sorted(self.latencies)
+            elapsed = time.time() - self.started
+            return {
+                'elapsed': elapsed,
+                'users': dict(self.users),
+                'users_per_second': sum(self.users.values()) / elapsed if elapsed > 0 else 0.0,
+                'retries': self.retries,
+                'query_rows': dict(self.query_rows),
+                'phases': OrderedDict((name, dict(phase)) for name, phase in self.phases.items()),
+                'api_calls': {object_type: dict(operations) for object_type, operations in self.api_calls.items()},
+                'api_call_count': sum(sum(operations.values()) for operations in self.api_calls.values()),
+                'user_latency': OrderedDict(
+                    [('count', len(latencies))] +
+                    [('p{}'.format(percentile), _percentile(latencies, percentile))
+                     for percentile in LATENCY_PERCENTILES] +
+                    [('max', latencies[-1] if latencies else None)]
+                ),
+            }
+
+    def summary(self):
+        """
+        Return the lines of the human readable summary of the stats.
+        """
+        stats = self.as_dict()
+        lines = ['Elapsed: {:.3f}s'.format(stats['elapsed']), 'Phases (seconds, summed over workers):']
+        for name, phase in stats['phases'].items():
+            lines.append('  {name}: {seconds:.3f}s in {count} call{plural}'.format(
+                name=name, plural='' if phase['count'] == 1 else 's', **phase
+            ))
+
+        lines.append('API calls: {count}'.format(count=stats['api_call_count']))
+        for object_type, operations in sorted(stats['api_calls'].items()):
+            for operation, count in sorted(operations.items()):
+                lines.append('  {object_type} {operation}: {count}'.format(
+                    object_type=object_type or '-', operation=operation, count=count
+                ))
+
+        latency = stats['user_latency']
+        if latency['count']:
+            lines.append('User latency: {percentiles}, max {max:.3f}s over {count} users'.format(
+                percentiles=', '.join(
+                    'p{percentile} {seconds:.3f}s'.format(
+                        percentile=percentile, seconds=latency['p{}'.format(percentile)]
+                    )
+                    for percentile in LATENCY_PERCENTILES
+                ),
+                max=latency['max'],
+                count=latency['count'],
+            ))
+        return lines
+
+    def _count_response(self, response, *args, **kwargs):  # pylint: disable=unused-argument
+        """
+        Count the request of the given response. Used as a response hook of a requests session.
+        """
+        object_type, operation = request_operation(response.request)
+        self.count_api_call(object_type, operation)
+
+
+def request_operation(request):
+    """
+    Return the object type and the operation of the given Salesforce REST API request. The object
+    type is empty for the requests which aren't made on a single type of object.
+    """
+    url = urlparse(request.url)
+    match = RESOURCE_PATTERN.search(url.path)
+    if match is None:
+        return '', request.method.lower()
+
+    resource, name = match.group('resource', 'name')
+    if resource in ('query', 'queryAll'):
+        # Requests for the next batch of query results have no query string.
+        soql = parse_qs(url.query).get('q', [''])[0]
+        while SUBQUERY_PATTERN.search(soql):
+            soql = SUBQUERY_PATTERN.sub('', soql)
+        query_object = QUERY_OBJECT_PATTERN.search(soql)
+        return query_object.group(1) if query_object else '', 'query'
+    if resource == 'sobjects' and name:
+        return name, SOBJECT_OPERATIONS.get(request.method, request.method.lower())
+    if resource == 'composite' and name == 'sobjects':
+        return _collection_type(request.body), SOBJECT_OPERATIONS.get(request.method, request.method.lower())
+    return '', resource
+
+
+def _collection_type(body):
+    """
+    Return the object type of the records of an sObject Collections request body, if any.
+    """
+    try:
+        return json.loads(body)['records'][0]['attributes']['type']
+    except (TypeError, ValueError, KeyError, IndexError):
+        return ''
+
+
+def _percentile(values, percentile):
+    """
+    Return the given nearest-rank percentile of the given sorted values, or None if there are none.
+    """
+    if not values:
+        return None
+    return values[max(0, -(-len(values) * percentile // 100) - 1)]
@@ -6,15 +6,15 @@ from __future__ import absolute_import, unicode_literals
 from datetime import datetime
 from decimal import Decimal
 
-SITE_USERS = [{'username': 'fake-user1'}, {'username': 'fake-user2'}]
+SITE_USERS = [{'user_id': 1, 'username': 'fake-user1'}, {'user_id': 2, 'username': 'fake-user2'}]
 
 LANGUAGE_PREF_DATA = [
     {
-        'username': 'fake-user1',
+        'user_id': 1,
         'language_preference': 'en'
     },
     {
-        'username': 'fake-user2',
+        'user_id': 2,
         'language_preference': 'fr'
     }
 ]
@@ -45,6 +45,7 @@ ORDER_DATA = [
 
 USER_PROFILE_DATA = [
     {
+        'user_id': 1,
         'username': 'fake-user1',
         'country': 'US',
         'year_of_birth': 1990,
@@ -56,6 +57,7 @@ USER_PROFILE_DATA = [
         'registration_date': datetime(2016, 1, 1, 11, 11, 11)
     },
     {
+        'user_id': 2,
         'username': 'fake-user2',
         'country': 'US',
         'year_of_birth': 1980,
@@ -68,54 +70,57 @@ USER_PROFILE_DATA = [
     }
 ]
 
+# The user rows fetched before munging, which hold no language, course or tracking data yet.
+USER_ROWS = [dict(user, language=None, courses=None, tracking=None) for user in USER_PROFILE_DATA]
+
 TRACKING_DATA = [
     {
-        'username': 'fake-user1',
+        'user_id': 1,
         'utm_param_name': 'registration_utm_campaign',
         'utm_param_value': 'fake_registration_utm_campaign'
     },
     {
-        'username': 'fake-user1',
+        'user_id': 1,
         'utm_param_name': 'registration_utm_medium',
         'utm_param_value': 'fake_registration_utm_medium'
     },
     {
-        'username': 'fake-user1',
+        'user_id': 1,
         'utm_param_name': 'registration_utm_source',
         'utm_param_value': 'fake_registration_utm_source'
     },
     {
-        'username': 'fake-user1',
+        'user_id': 1,
         'utm_param_name': 'registration_utm_term',
         'utm_param_value': 'fake_registration_utm_term'
     },
     {
-        'username': 'fake-user1',
+        'user_id': 1,
         'utm_param_name': 'registration_utm_content',
         'utm_param_value': 'fake_registration_utm_content'
     },
     {
-        'username': 'fake-user2',
+        'user_id': 2,
         'utm_param_name': 'registration_utm_campaign',
         'utm_param_value': 'test_registration_utm_campaign'
     },
     {
-        'username': 'fake-user2',
+        'user_id': 2,
         'utm_param_name': 'registration_utm_medium',
         'utm_param_value': 'test_registration_utm_medium'
     },
     {
-        'username': 'fake-user2',
+        'user_id': 2,
         'utm_param_name': 'registration_utm_source',
         'utm_param_value': 'test_registration_utm_source'
     },
     {
-        'username': 'fake-user2',
+        'user_id': 2,
         'utm_param_name': 'registration_utm_term',
         'utm_param_value': 'test_registration_utm_term'
     },
     {
-        'username': 'fake-user2',
+        'user_id': 2,
         'utm_param_name': 'registration_utm_content',
         'utm_param_value': 'test_registration_utm_content'
     }
@@ -123,6 +128,7 @@ TRACKING_DATA = [
 
 USER_DATA = [
     {
+        'user_id': 1,
         'username': 'fake-user1',
         'year_of_birth': 1990,
         'full_name': 'fake user1',
@@ -151,6 +157,7 @@ USER_DATA = [
             'utm_term': 'fake_registration_utm_term'
         }
     }, {
+        'user_id': 2,
         'username': 'fake-user2',
         'year_of_birth': 1980,
         'full_name': 'fake user2',
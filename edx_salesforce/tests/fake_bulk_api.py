@@ -0,0 +1,181 @@
+"""
+A local fake of the Salesforce Bulk API 2.0 ingest job endpoints, used to test the Bulk API client.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import json
+import re
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from io import BytesIO
+
+import unicodecsv as csv
+
+JOB_URL_PATTERN = re.compile(
+    r'^/services/data/v[0-9.]+/jobs/ingest/(?:(?P<job_id>[^/]+)/(?:(?P<resource>[A-Za-z]+)/)?)?$'
+)
+
+
+class FakeBulkApiServer(object):
+    """
+    Serves the Bulk API 2.0 ingest job endpoints on a local port.
+
+    Every job is processed when its upload is completed. Rows whose external ID is in `failing`
+    fail with a fake error, other rows succeed and are created unless their external ID is in
+    `existing`. Jobs report the InProgress state once before they are complete.
+
+    Arguments:
+        failing (dict): Maps the external IDs of failing rows to their error message.
+        existing (set): The external IDs of objects which already exist.
+    """
+
+    def __init__(self, failing=None, existing=None):
+        self.failing = failing or {}
+        self.existing = existing or set()
+        self.jobs = {}
+        self.requests = []
+        self.httpd = HTTPServer(('127.0.0.1', 0), _FakeBulkApiHandler)
+        self.httpd.fake = self
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+
+    @property
+    def url(self):
+        """
+        The instance URL the fake server is listening on.
+        """
+        return 'http://127.0.0.1:{port}'.format(port=self.httpd.server_port)
+
+    def start(self):
+        """
+        Start serving requests in a background thread.
+        """
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop serving requests.
+        """
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def create_job(self, job):
+        """
+        Create a job from the JSON body of a create job request.
+        """
+        job_id = '750{number:015d}'.format(number=len(self.jobs) + 1)
+        job.update(id=job_id, state='Open', polls=0, data=b'', successful=[], failed=[])
+        self.jobs[job_id] = job
+        return job
+
+    def process_job(self, job):
+        """
+        Process the uploaded rows of a job.
+        """
+        external_id_field = job['externalIdFieldName']
+        reader = csv.DictReader(BytesIO(job['data']), encoding='utf-8')
+        job['fields'] = reader.fieldnames
+        for number, row in enumerate(reader, 1):
+            key = row[external_id_field]
+            if key in self.failing:
+                job['failed'].append(dict(row, sf__Id='', sf__Error=self.failing[key]))
+            else:
+                created = key not in self.existing
+                object_id = '00Q{number:015d}'.format(number=number) if created else key
+                job['successful'].append(dict(row, sf__Id=object_id, sf__Created='true' if created else 'false'))
+        job['state'] = 'InProgress'
+
+
+class _FakeBulkApiHandler(BaseHTTPRequestHandler):
+    """
+    Handles the requests made to the fake Bulk API server.
+    """
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        self._handle('POST')
+
+    def do_PUT(self):  # pylint: disable=invalid-name
+        self._handle('PUT')
+
+    def do_PATCH(self):  # pylint: disable=invalid-name
+        self._handle('PATCH')
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        self._handle('GET')
+
+    def _handle(self, method):
+        fake = self.server.fake
+        body = self.rfile.read(int(self.headers.getheader('Content-Length') or 0))
+        fake.requests.append((method, self.path))
+
+        match = JOB_URL_PATTERN.match(self.path)
+        if not match:
+            return self._respond(404, [{'errorCode': 'NOT_FOUND', 'message': 'Not found'}])
+
+        job_id, resource = match.group('job_id'), match.group('resource')
+        if job_id is None and method == 'POST':
+            return self._respond(200, _job_info(fake.create_job(json.loads(body))))
+
+        job = fake.jobs.get(job_id)
+        if job is None:
+            return self._respond(404, [{'errorCode': 'NOT_FOUND', 'message': 'Unknown job'}])
+
+        if resource == 'batches' and method == 'PUT':
+            job['data'] += body
+            return self._respond(201)
+        if resource is None and method == 'PATCH':
+            state = json.loads(body)['state']
+            if state == 'UploadComplete':
+                fake.process_job(job)
+            else:
+                job['state'] = state
+            return self._respond(200, _job_info(job))
+        if resource is None and method == 'GET':
+            if job['state'] == 'InProgress':
+                job['polls'] += 1
+                if job['polls'] > 1:
+                    job['state'] = 'JobComplete'
+            return self._respond(200, _job_info(job))
+        if resource == 'successfulResults':
+            return self._respond_csv(['sf__Id', 'sf__Created'] + job['fields'], job['successful'])
+        if resource == 'failedResults':
+            return self._respond_csv(['sf__Id', 'sf__Error'] + job['fields'], job['failed'])
+        return self._respond(404, [{'errorCode': 'NOT_FOUND', 'message': 'Not found'}])
+
+    def _respond(self, status, content=None):
+        self.send_response(status)
+        if content is None:
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        data = json.dumps(content).encode('utf-8')
+        self.send_header('Content-Type', 'application/json;charset=UTF-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _respond_csv(self, fields, rows):
+        output = BytesIO()
+        writer = csv.DictWriter(output, fields, lineterminator=str('\n'), encoding='utf-8')
+        writer.writeheader()
+        writer.writerows(rows)
+        data = output.getvalue()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/csv')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def _job_info(job):
+    """
+    Return the public job info of a fake job.
+    """
+    return {
+        key: value for key, value in job.items()
+        if key in ('id', 'object', 'externalIdFieldName', 'operation', 'contentType', 'lineEnding', 'state')
+    }
@@ -1,10 +1,15 @@
 """
-Mixin to create test edxapp and ecommerce database schemas and load test data into them.
+Mixins to create test edxapp and ecommerce database schemas and load test data into them, and
+to keep the local state of the tests in a temporary directory.
 """
 
 from __future__ import absolute_import, unicode_literals
 
+import shutil
+import tempfile
+
 from django.db import connections
+from django.test import override_settings
 
 from edx_salesforce.tests.fixtures.data import DATA
 from edx_salesforce.tests.fixtures.schema import SCHEMA
@@ -48,3 +53,21 @@ class DatabaseMixin(object):
                         values=','.join(str(v) for v in values)
                     )
                 )
+
+
+class StateDirMixin(object):
+    """
+    Mixin for writing the state files of each test to its own temporary state directory.
+    """
+
+    def setUp(self):
+        """
+        Set up the temporary state directory, removed once the test is complete.
+        """
+        super(StateDirMixin, self).setUp()
+
+        self.state_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.state_dir)
+        settings_override = override_settings(EDX_SALESFORCE_STATE_DIR=self.state_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
@@ -0,0 +1,98 @@
+"""
+Unit tests for edx_salesforce bulk module.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+from datetime import datetime
+
+import pytz
+import requests
+from mock import patch
+
+from django.test import TestCase, override_settings
+
+from edx_salesforce.bulk import BULK_NULL, BulkApiClient, BulkApiError, BulkResult
+from edx_salesforce.rest import DEFAULT_API_VERSION
+from edx_salesforce.tests.fake_bulk_api import FakeBulkApiServer
+
+
+@override_settings(EDX_SALESFORCE_BULK_POLL_INTERVAL=0)
+class TestBulkApiClient(TestCase):
+    """
+    Test the Bulk API client against a fake Bulk API server.
+    """
+
+    def setUp(self):
+        super(TestBulkApiClient, self).setUp()
+
+        self.server = FakeBulkApiServer(
+            failing={'fake-user2': 'DUPLICATE_EXTERNAL_ID:more than one record found for external id field'},
+            existing={'fake-user3'},
+        )
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        self.client = BulkApiClient(requests.Session(), self.server.url)
+
+    def test_upsert(self):
+        rows = [
+            {'Username__c': 'fake-user1', 'Email': 'fake1@example.com', 'Company': 'fake-user1'},
+            {'Username__c': 'fake-user2', 'Email': 'fake2@example.com'},
+            {
+                'Username__c': 'fake-user3',
+                'Country': None,
+                'Registration_Date__c': pytz.utc.localize(datetime(2017, 1, 1, 11, 11, 11)),
+            },
+        ]
+
+        results = self.client.upsert('Lead', 'Username__c', rows)
+
+        self.assertEqual(results, {
+            'fake-user1': BulkResult(True, '00Q000000000000001', True, None),
+            'fake-user2': BulkResult(
+                False, None, False, 'DUPLICATE_EXTERNAL_ID:more than one record found for external id field'
+            ),
+            'fake-user3': BulkResult(True, 'fake-user3', False, None),
+        })
+
+        job = self.server.jobs.values()[0]
+        self.assertEqual(job['object'], 'Lead')
+        self.assertEqual(job['operation'], 'upsert')
+        self.assertEqual(job['externalIdFieldName'], 'Username__c')
+        self.assertEqual(job['data'].splitlines(), [
+            b'Username__c,Company,Country,Email,Registration_Date__c',
+            b'fake-user1,fake-user1,,fake1@example.com,',
+            b'fake-user2,,,fake2@example.com,',
+            b'fake-user3,,{null},,2017-01-01T11:11:11.000Z'.format(null=BULK_NULL),
+        ])
+        # The job is polled until it is complete.
+        self.assertEqual([path for method, path in self.server.requests if method == 'GET'].count(
+            '/services/data/v{version}/jobs/ingest/{job_id}/'.format(version=DEFAULT_API_VERSION, job_id=job['id'])
+        ), 2)
+
+    @patch('edx_salesforce.bulk.BULK_MAX_ROWS_PER_JOB', 2)
+    def test_upsert_in_several_jobs(self):
+        rows = [{'Id': 'fake-contact{}'.format(number), 'Email': 'fake@example.com'} for number in range(5)]
+
+        results = self.client.upsert('Contact', 'Id', rows)
+
+        self.assertEqual(len(self.server.jobs), 3)
+        self.assertEqual(sorted(results), ['fake-contact{}'.format(number) for number in range(5)])
+        self.assertTrue(all(result.success for result in results.values()))
+
+    @override_settings(EDX_SALESFORCE_BULK_JOB_TIMEOUT=-1)
+    def test_upsert_timeout(self):
+        with self.assertRaises(BulkApiError):
+            self.client.upsert('Lead', 'Username__c', [{'Username__c': 'fake-user1'}])
+
+    def test_aborted_job(self):
+        with patch.object(self.server, 'process_job', lambda job: job.update(state='Aborted', fields=[])):
+            results = self.client.upsert('Lead', 'Username__c', [{'Username__c': 'fake-user1'}])
+
+        self.assertEqual(results, {'fake-user1': BulkResult(False, None, False, 'Row not processed, job Aborted.')})
+
+    def test_request_error(self):
+        self.client.instance_url = '{url}/unknown'.format(url=self.server.url)
+
+        with self.assertRaises(BulkApiError):
+            self.client.upsert('Lead', 'Username__c', [{'Username__c': 'fake-user1'}])
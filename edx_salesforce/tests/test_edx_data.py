@@ -3,23 +3,29 @@ Unit tests for edx_data.py.
 """
 from __future__ import absolute_import, unicode_literals
 
+from datetime import datetime
+
+import mock
+
+from django.db import connections
 from django.test import TestCase
 
 from edx_salesforce import edx_data
 from edx_salesforce.tests import edx_sample_data
-from edx_salesforce.tests.mixins import DatabaseMixin
+from edx_salesforce.tests.mixins import DatabaseMixin, StateDirMixin
 
 
-class EdxDataTests(DatabaseMixin, TestCase):
+class EdxDataTests(StateDirMixin, DatabaseMixin, TestCase):
     """
     Test cases for edx_data.py
     """
+    multi_db = True
 
     def setUp(self):
         super(EdxDataTests, self).setUp()
         self.site_domain = 'fake-site-domain.com'
         self.orgs = ['testX']
-        self.usernames = ['fake-user1', 'fake-user2']
+        self.user_ids = [1, 2]
 
     @classmethod
     def setUpTestData(cls):
@@ -43,21 +49,21 @@ class EdxDataTests(DatabaseMixin, TestCase):
         """
         Test _fetch_users_for_site for given site-domain
         """
-        actual = edx_data._fetch_language_preference_data(self.usernames)   # pylint: disable=protected-access
+        actual = edx_data._fetch_language_preference_data(self.user_ids)   # pylint: disable=protected-access
         self.assertListEqual(actual, edx_sample_data.LANGUAGE_PREF_DATA)
 
     def test_fetch_user_profile_data(self):
         """
         Test _fetch_user_data for given username
         """
-        actual = edx_data._fetch_user_data(self.usernames)  # pylint: disable=protected-access
-        self.assertListEqual(actual, edx_sample_data.USER_PROFILE_DATA)
+        actual = edx_data._fetch_user_data(self.user_ids)  # pylint: disable=protected-access
+        self.assertListEqual(actual, edx_sample_data.USER_ROWS)
 
     def test_fetch_tracking_data(self):
         """
         Test _fetch_tracking_data for given username
         """
-        actual = edx_data._fetch_tracking_data(self.usernames)  # pylint: disable=protected-access
+        actual = edx_data._fetch_tracking_data(self.user_ids)  # pylint: disable=protected-access
         self.assertListEqual(actual, edx_sample_data.TRACKING_DATA)
 
     def test_fetch_user_data(self):
@@ -66,3 +72,362 @@ class EdxDataTests(DatabaseMixin, TestCase):
         """
         actual = edx_data.fetch_user_data(self.site_domain, self.orgs)
         self.assertListEqual(actual, edx_sample_data.USER_DATA)
+
+    def test_observe_query_rows(self):
+        """
+        Test the rows of the queries run by fetch_user_data are counted by query name
+        """
+        rows = []
+        with edx_data.observe_query_rows(lambda query_name, count: rows.append((query_name, count))):
+            edx_data.fetch_user_data(self.site_domain, self.orgs)
+        edx_data.fetch_user_data(self.site_domain, self.orgs)
+
+        self.assertIn(('USERS_FOR_SITE', len(edx_sample_data.SITE_USERS)), rows)
+        self.assertIn(('USERS_FOR_USER_IDS', len(edx_sample_data.USER_DATA)), rows)
+        self.assertEqual(len(rows), len(set(query_name for query_name, _ in rows)))
+
+    def test_fetch_user_data_in_batches(self):
+        """
+        Test fetch_user_data returns the same data when user IDs are queried in batches
+        """
+        actual = edx_data.fetch_user_data(self.site_domain, self.orgs, batch_size=1)
+        self.assertEqual(
+            sorted(actual, key=lambda user: user['username']),
+            edx_sample_data.USER_DATA
+        )
+
+    def test_fetch_for_user_ids_in_batches(self):
+        """
+        Test each batch of user IDs is sent in its own query and the rows are merged
+        """
+        with mock.patch.object(edx_data, '_fetch_records', wraps=edx_data._fetch_records) as mock_fetchall:
+            actual = edx_data._fetch_user_data(self.user_ids, batch_size=1)  # pylint: disable=protected-access
+
+        self.assertEqual(mock_fetchall.call_count, 2)
+        self.assertListEqual(actual, edx_sample_data.USER_ROWS)
+
+    def test_fetch_for_user_ids_without_user_ids(self):
+        """
+        Test no query is sent when there are no users to fetch data for
+        """
+        with mock.patch.object(edx_data, '_fetch_records') as mock_fetchall:
+            actual = edx_data._fetch_tracking_data([], batch_size=100)  # pylint: disable=protected-access
+
+        self.assertFalse(mock_fetchall.called)
+        self.assertListEqual(actual, [])
+
+    def test_stream_user_data(self):
+        """
+        Test fetch_user_data in streaming mode yields the same data one batch at a time
+        """
+        users = edx_data.fetch_user_data(self.site_domain, self.orgs, batch_size=1, stream=True)
+        self.assertIsInstance(users, edx_data.UserDataStream)
+        self.assertEqual(len(users), 2)
+
+        with mock.patch.object(edx_data, '_munge_user_data', wraps=edx_data._munge_user_data) as mock_munge:
+            actual = list(users)
+
+        self.assertEqual(mock_munge.call_count, 2)
+        self.assertListEqual(actual, edx_sample_data.USER_DATA)
+
+    def test_stream_orders(self):
+        """
+        Test the orders of the users of a stream are returned without extracting their user data
+        """
+        users = edx_data.fetch_user_data(self.site_domain, self.orgs, batch_size=1, stream=True)
+
+        with mock.patch.object(edx_data, '_fetch_munged_user_data') as mock_fetch_munged_user_data:
+            orders = list(users.orders())
+
+        self.assertFalse(mock_fetch_munged_user_data.called)
+        self.assertEqual(
+            [(order['course_id'], order['list_price']) for order in orders],
+            [(course['course_id'], course['list_price']) for user in edx_sample_data.USER_DATA
+             for course in user['courses']]
+        )
+
+    def test_stream_user_data_without_users(self):
+        """
+        Test an empty stream is returned when no users are found
+        """
+        users = edx_data.fetch_user_data('unknown-site-domain.com', ['unknownX'], stream=True)
+        self.assertFalse(users)
+        self.assertListEqual(list(users), [])
+
+    def test_fetch_order_data_for_multiple_orgs(self):
+        """
+        Test _fetch_order_data only returns orders for products of courses under the given organizations
+        """
+        with connections['ecommerce'].cursor() as cursor:
+            cursor.execute('INSERT INTO catalogue_product VALUES (3, "course-v1:otherX:fake-course-id3")')
+            cursor.execute('INSERT INTO catalogue_product VALUES (4, "course-v1:thirdX:fake-course-id4")')
+            cursor.execute('INSERT INTO order_line VALUES (3, 1, 3.33, 3.33, 1, 3)')
+            cursor.execute('INSERT INTO order_line VALUES (4, 1, 4.44, 4.44, 2, 4)')
+
+        actual = edx_data._fetch_order_data(['testX', 'otherX'])  # pylint: disable=protected-access
+        self.assertEqual(
+            sorted(order['course_id'] for order in actual),
+            [
+                'course-v1:otherX:fake-course-id3',
+                'course-v1:testX:fake-course-id1',
+                'course-v1:testX:fake-course-id2',
+            ]
+        )
+
+    def test_fetch_records(self):
+        """
+        Test rows are fetched as compact records with interned values
+        """
+        actual = edx_data._fetch_order_data(self.orgs)  # pylint: disable=protected-access
+        self.assertFalse(hasattr(actual[0], '__dict__'))
+        self.assertIs(type(actual[0]), type(actual[1]))
+
+        with connections['default'].cursor() as cursor:
+            cursor.execute('UPDATE auth_userprofile SET country = "C" || "A"')
+        actual = edx_data._fetch_user_data(self.user_ids)  # pylint: disable=protected-access
+        self.assertEqual(actual[0]['country'], 'CA')
+        self.assertIs(actual[0]['country'], actual[1]['country'])
+
+    def test_resolve_user_ids(self):
+        """
+        Test the usernames of ecommerce users which did not register on the site are resolved to user IDs
+        """
+        with connections['default'].cursor() as cursor:
+            cursor.execute(
+                'INSERT INTO auth_user (id, password, is_superuser, username, first_name, last_name, email, '
+                'is_staff, is_active, date_joined) VALUES (3, "fake", 0, "fake-user3", "", "", "", 0, 1, '
+                '"2016-01-01 11:11:11")'
+            )
+        order_data = [{'username': 'fake-user1'}, {'username': 'fake-user3'}, {'username': 'unknown-user'}]
+
+        with mock.patch.object(edx_data, '_fetch_records', wraps=edx_data._fetch_records) as mock_fetchall:
+            actual = edx_data._resolve_user_ids({'fake-user1': 1}, order_data)  # pylint: disable=protected-access
+
+        self.assertEqual(mock_fetchall.call_count, 1)
+        self.assertEqual(actual, {'fake-user1': 1, 'fake-user3': 3})
+
+    def test_fetch_order_data_with_coupons(self):
+        """
+        Test the coupon codes aggregated by the order query match the codes fetched by separate queries
+        """
+        with connections['ecommerce'].cursor() as cursor:
+            cursor.execute('INSERT INTO voucher_voucher VALUES (3, "fake-code3,with-comma")')
+            cursor.execute('INSERT INTO voucher_voucherapplication VALUES (3, 1, 3)')
+            cursor.execute('INSERT INTO order_line VALUES (3, 1, 3.33, 3.33, 1, 2)')
+
+        joined = edx_data._fetch_order_data(self.orgs)  # pylint: disable=protected-access
+        with mock.patch.object(edx_data, 'GROUP_CONCAT_VENDORS', ()):
+            with mock.patch.object(edx_data, 'COUPON_BATCH_SIZE', 1):
+                with mock.patch.object(edx_data, '_fetch_records', wraps=edx_data._fetch_records) as mock_fetch:
+                    separate = edx_data._fetch_order_data(self.orgs)  # pylint: disable=protected-access
+
+        # The order query, then a coupon code query for each order.
+        self.assertEqual(mock_fetch.call_count, 3)
+        self.assertEqual(len(joined), 3)
+        for order in joined + separate:
+            order['coupon_codes'] = sorted(order['coupon_codes'])
+        key = lambda order: (order['order_id'], order['course_id'])
+        self.assertEqual(sorted(joined, key=key), sorted(separate, key=key))
+        self.assertEqual(sorted(joined, key=key)[0]['coupon_codes'], ['fake-code1', 'fake-code3,with-comma'])
+
+    def test_fetch_order_data_with_truncated_coupons(self):
+        """
+        Test the coupon codes of orders whose aggregated codes may be truncated are fetched by separate queries
+        """
+        with connections['ecommerce'].cursor() as cursor:
+            cursor.execute('INSERT INTO voucher_voucher VALUES (3, "fake-code3")')
+            cursor.execute('INSERT INTO voucher_voucherapplication VALUES (3, 1, 3)')
+
+        # Only the codes of the first order, 'fake-code1' and 'fake-code3', reach the maximum length.
+        with mock.patch.object(edx_data, 'GROUP_CONCAT_MAX_LEN', len('fake-code1\nfake-code3')):
+            with mock.patch.object(edx_data, '_fetch_coupon_data', wraps=edx_data._fetch_coupon_data) as mock_fetch:
+                orders = edx_data._fetch_order_data(self.orgs)  # pylint: disable=protected-access
+
+        mock_fetch.assert_called_once_with(['1'])
+        self.assertEqual(
+            sorted((order['order_id'], sorted(order['coupon_codes'])) for order in orders),
+            [(1, ['fake-code1', 'fake-code3']), (2, ['fake-code2'])]
+        )
+
+    def test_fetch_coupon_data_without_orders(self):
+        """
+        Test no coupon code query is sent when there are no orders
+        """
+        with mock.patch.object(edx_data, '_fetch_records') as mock_fetch:
+            self.assertEqual(edx_data._fetch_coupon_data([]), [])  # pylint: disable=protected-access
+        self.assertFalse(mock_fetch.called)
+
+    def test_org_filter(self):
+        """
+        Test _org_filter matches course ID prefixes and escapes LIKE wildcards in organization names
+        """
+        self.assertEqual(
+            edx_data._org_filter(['testX', 'Org_100%']),  # pylint: disable=protected-access
+            '(p.course_id LIKE "course-v1:testX%" ESCAPE "!" OR '
+            'p.course_id LIKE "course-v1:Org!_100!%%" ESCAPE "!")'
+        )
+
+    def test_fetch_user_profile_data_in_single_pass(self):
+        """
+        Test _fetch_user_profile_data returns one row per user with the language and tracking data pivoted
+        """
+        actual = edx_data._fetch_user_profile_data(self.user_ids)  # pylint: disable=protected-access
+        self.assertEqual(len(actual), len(self.user_ids))
+        self.assertEqual(actual[0]['language_preference'], 'en')
+        self.assertEqual(actual[0]['utm_campaign'], 'fake_registration_utm_campaign')
+        self.assertEqual(actual[1]['language_preference'], 'fr')
+        self.assertEqual(actual[1]['utm_term'], 'test_registration_utm_term')
+
+    def test_fetch_user_data_in_single_pass(self):
+        """
+        Test fetch_user_data returns the same data when user profiles are fetched in a single pass
+        """
+        with mock.patch.object(edx_data, '_fetch_tracking_data') as mock_fetch_tracking_data:
+            actual = edx_data.fetch_user_data(self.site_domain, self.orgs, single_pass=True)
+
+        self.assertFalse(mock_fetch_tracking_data.called)
+        self.assertListEqual(actual, edx_sample_data.USER_DATA)
+
+    def test_stream_user_data_in_single_pass(self):
+        """
+        Test streamed user data is the same when user profiles are fetched in a single pass
+        """
+        users = edx_data.fetch_user_data(self.site_domain, self.orgs, batch_size=1, stream=True, single_pass=True)
+        self.assertListEqual(list(users), edx_sample_data.USER_DATA)
+
+    def test_munge_user_profile_data_without_tracking(self):
+        """
+        Test tracking parameters which are not set are left out of the munged user data
+        """
+        profile_data = [dict(
+            edx_sample_data.USER_PROFILE_DATA[0],
+            language_preference=None,
+            utm_campaign='test-campaign',
+            utm_content=None,
+            utm_medium=None,
+            utm_source=None,
+            utm_term=None,
+        )]
+        actual = edx_data._munge_user_profile_data(profile_data, [])  # pylint: disable=protected-access
+        self.assertIsNone(actual[0]['language'])
+        self.assertEqual(actual[0]['tracking'], {'utm_campaign': 'test-campaign'})
+        self.assertEqual(actual[0]['courses'], [])
+
+    def test_fetch_watermarks(self):
+        """
+        Test fetch_watermarks returns the high-water marks of the edxapp and ecommerce data
+        """
+        self.assertEqual(edx_data.fetch_watermarks(), {
+            'date_joined': datetime(2016, 1, 1, 11, 11, 11),
+            'date_placed': datetime(2017, 1, 1, 11, 11, 11),
+            'user_attribute_id': 12,
+            'user_preference_id': 2,
+        })
+
+    def test_fetch_user_data_since_watermarks(self):
+        """
+        Test fetch_user_data only returns the users and orders changed after the given watermarks
+        """
+        since = edx_data.fetch_watermarks()
+        self.assertListEqual(edx_data.fetch_user_data(self.site_domain, self.orgs, since=since), [])
+
+        with connections['default'].cursor() as cursor:
+            cursor.execute('INSERT INTO user_api_userpreference VALUES (3, "pref-lang", "de", 2)')
+
+        actual = edx_data.fetch_user_data(self.site_domain, self.orgs, since=since)
+        self.assertEqual([user['username'] for user in actual], ['fake-user2'])
+        # The orders of the user were placed before the watermarks.
+        self.assertEqual(actual[0]['courses'], [])
+
+        with connections['ecommerce'].cursor() as cursor:
+            cursor.execute('INSERT INTO order_order VALUES (3, "ORDER-3", "2017-02-01 00:00:00", 1)')
+            cursor.execute('INSERT INTO order_line VALUES (3, 1, 3.33, 3.33, 3, 2)')
+
+        users = edx_data.fetch_user_data(self.site_domain, self.orgs, stream=True, since=since)
+        self.assertEqual(users.usernames, ['fake-user1', 'fake-user2'])
+        self.assertEqual([order['order_id'] for user in users for order in user['courses']], [3])
+
+    def test_fetch_user_data_with_snapshot(self):
+        """
+        Test fetch_user_data reuses the snapshot of an earlier extraction until the data changes
+        """
+        self.assertListEqual(edx_data.fetch_user_data(self.site_domain, self.orgs, snapshot=True),
+                             edx_sample_data.USER_DATA)
+
+        with mock.patch.object(edx_data, '_fetch_order_data') as mock_fetch_order_data:
+            users = edx_data.fetch_user_data(self.site_domain, self.orgs, stream=True, snapshot=True)
+            self.assertEqual(len(users), 2)
+            self.assertListEqual(list(users), edx_sample_data.USER_DATA)
+        self.assertFalse(mock_fetch_order_data.called)
+
+        with connections['default'].cursor() as cursor:
+            cursor.execute('INSERT INTO user_api_userpreference VALUES (3, "pref-lang", "de", 2)')
+
+        users = edx_data.fetch_user_data(self.site_domain, self.orgs, batch_size=1, stream=True, snapshot=True)
+        self.assertIsInstance(users, edx_data.Snapshot)
+        self.assertEqual([user['username'] for user in users], ['fake-user1', 'fake-user2'])
+
+    def test_changed_filter_without_watermarks(self):
+        """
+        Test no condition is added to the queries when no watermarks are given
+        """
+        self.assertEqual(edx_data._changed_filter('USERS_FOR_SITE', None), '')  # pylint: disable=protected-access
+
+    def test_fetch_user_data_since_empty_watermarks(self):
+        """
+        Test fetch_user_data returns all the users and orders changed after the watermarks of empty tables
+        """
+        since = dict.fromkeys(edx_data.fetch_watermarks())
+        self.assertListEqual(edx_data.fetch_user_data(self.site_domain, self.orgs, since=since),
+                             edx_sample_data.USER_DATA)
+
+    def _share_test_connections(self):
+        """
+        Patches the calls made on extraction pool threads to use the test database connections.
+
+        Each pool thread would otherwise open its own connections to private in-memory SQLite
+        databases which do not contain the test data.
+        """
+        test_connections = {alias: connections[alias] for alias in edx_data.EXTRACTION_DATABASES}
+        call_with_own_connections = edx_data._call_with_own_connections  # pylint: disable=protected-access
+
+        def call_with_test_connections(func, args, kwargs):
+            """
+            Installs the test database connections on the current thread and makes the call.
+            """
+            for alias, connection in test_connections.items():
+                connection.allow_thread_sharing = True
+                connections[alias] = connection
+            return call_with_own_connections(func, args, kwargs)
+
+        return mock.patch.object(edx_data, '_call_with_own_connections', side_effect=call_with_test_connections)
+
+    def test_fetch_user_data_in_parallel(self):
+        """
+        Test fetch_user_data returns the same data when the queries run concurrently
+        """
+        with self._share_test_connections() as mock_call:
+            actual = edx_data.fetch_user_data(self.site_domain, self.orgs, parallel=True)
+
+        # Orders and site users, then the three queries for the user IDs.
+        self.assertEqual(mock_call.call_count, 5)
+        self.assertEqual(sorted(actual, key=lambda user: user['username']), edx_sample_data.USER_DATA)
+
+    def test_stream_user_data_in_parallel(self):
+        """
+        Test streamed user data is the same when the queries run concurrently
+        """
+        with self._share_test_connections():
+            users = edx_data.fetch_user_data(self.site_domain, self.orgs, batch_size=1, stream=True, parallel=True)
+            actual = list(users)
+
+        self.assertListEqual(actual, edx_sample_data.USER_DATA)
+
+    def test_fetch_user_data_in_parallel_with_error(self):
+        """
+        Test an error raised by a concurrent query is raised by fetch_user_data
+        """
+        with self._share_test_connections():
+            with mock.patch.object(edx_data, '_fetch_users_for_site', side_effect=ValueError):
+                with self.assertRaises(ValueError):
+                    edx_data.fetch_user_data(self.site_domain, self.orgs, parallel=True)
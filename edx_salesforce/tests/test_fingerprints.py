@@ -0,0 +1,51 @@
+"""
+Unit tests for edx_salesforce fingerprints module.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import os
+
+from mock import patch
+
+from django.test import TestCase
+
+from edx_salesforce.fingerprints import FingerprintStore, fingerprint_store_path
+from edx_salesforce.tests.mixins import StateDirMixin
+
+
+class TestFingerprintStore(StateDirMixin, TestCase):
+    """
+    Test the store of the fingerprints of synchronized users.
+    """
+
+    def setUp(self):
+        super(TestFingerprintStore, self).setUp()
+
+        self.path = fingerprint_store_path()
+
+    def test_set_get_and_delete(self):
+        store = FingerprintStore(self.path)
+        store.set_many({'fake-user1': 'fingerprint1', 'fake-user2': 'fingerprint2'})
+        store.set_many({'fake-user2': 'fingerprint3'})
+        store.close()
+
+        self.assertTrue(os.path.exists(self.path))
+        store = FingerprintStore(self.path)
+        self.assertEqual(store.get_many(['fake-user1', 'fake-user2', 'fake-user3']), {
+            'fake-user1': 'fingerprint1',
+            'fake-user2': 'fingerprint3',
+        })
+
+        store.delete_many(['fake-user1', 'fake-user3'])
+        self.assertEqual(store.get_many(['fake-user1', 'fake-user2']), {'fake-user2': 'fingerprint3'})
+        store.close()
+
+    @patch('edx_salesforce.fingerprints.FINGERPRINT_QUERY_SIZE', 2)
+    def test_get_many_in_several_queries(self):
+        store = FingerprintStore(self.path)
+        fingerprints = {'fake-user{}'.format(number): 'fingerprint{}'.format(number) for number in range(5)}
+        store.set_many(fingerprints)
+
+        self.assertEqual(store.get_many(sorted(fingerprints)), fingerprints)
+        store.close()
@@ -0,0 +1,93 @@
+"""
+Unit tests for edx_salesforce metrics module.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import json
+import os
+import shutil
+import tempfile
+
+from mock import patch
+
+from django.test import TestCase
+
+from edx_salesforce.metrics import MetricsExporter, prometheus_text
+from edx_salesforce.stats import RunStats
+
+
+class TestMetricsExporter(TestCase):
+    """
+    Test the export of the stats of a run as metrics files.
+    """
+
+    def setUp(self):
+        super(TestMetricsExporter, self).setUp()
+        self.metrics_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.metrics_dir)
+        self.textfile_path = os.path.join(self.metrics_dir, 'sync.prom')
+        self.json_path = os.path.join(self.metrics_dir, 'sync.json')
+
+        self.stats = RunStats()
+        self.stats.count_users('FAILED')
+        self.stats.count_users('SYNCHRONIZED', 3)
+        self.stats.count_retry()
+        self.stats.count_rows('USERS_FOR_SITE', 4)
+        self.stats.count_api_call('Lead', 'query', 2)
+        self.stats.record_latency(0.5)
+        with self.stats.phase('extraction'):
+            pass
+
+    def _read_json(self):
+        """
+        Return the metrics of the JSON file.
+        """
+        with open(self.json_path) as json_file:  # pylint: disable=open-builtin
+            return json.load(json_file)
+
+    def test_prometheus_text(self):
+        stats = self.stats.as_dict()
+        stats.update(command='sync_salesforce', complete=True, timestamp=1500000000.0)
+        lines = prometheus_text(stats).splitlines()
+
+        for line in (
+                '# TYPE edx_salesforce_users gauge',
+                'edx_salesforce_run_complete{command="sync_salesforce"} 1.0',
+                'edx_salesforce_users{command="sync_salesforce",status="FAILED"} 1.0',
+                'edx_salesforce_users{command="sync_salesforce",status="SYNCHRONIZED"} 3.0',
+                'edx_salesforce_retries{command="sync_salesforce"} 1.0',
+                'edx_salesforce_query_rows{command="sync_salesforce",query="USERS_FOR_SITE"} 4.0',
+                'edx_salesforce_api_calls{command="sync_salesforce",object_type="Lead",operation="query"} 2.0',
+                'edx_salesforce_user_latency_seconds{command="sync_salesforce",quantile="0.99"} 0.5',
+        ):
+            self.assertIn(line, lines)
+        self.assertTrue(any(line.startswith('edx_salesforce_phase_seconds{') for line in lines))
+
+    def test_prometheus_text_escapes_label_values(self):
+        stats = RunStats().as_dict()
+        stats.update(command='sync "salesforce"\\', complete=False, timestamp=1500000000.0)
+        self.assertIn('edx_salesforce_run_complete{command="sync \\"salesforce\\"\\\\"} 0.0', prometheus_text(stats))
+
+    def test_start_and_stop(self):
+        exporter = MetricsExporter(self.stats, 'sync_salesforce', self.textfile_path, self.json_path)
+        exporter.start()
+        self.assertFalse(self._read_json()['complete'])
+
+        exporter.stop(complete=True)
+        metrics = self._read_json()
+        self.assertTrue(metrics['complete'])
+        self.assertEqual(metrics['users'], {'FAILED': 1, 'SYNCHRONIZED': 3})
+        self.assertEqual(metrics['command'], 'sync_salesforce')
+        with open(self.textfile_path) as textfile:  # pylint: disable=open-builtin
+            self.assertIn('edx_salesforce_run_complete{command="sync_salesforce"} 1.0\n', textfile.read())
+        self.assertEqual(sorted(os.listdir(self.metrics_dir)), ['sync.json', 'sync.prom'])
+
+    def test_periodic_writes(self):
+        exporter = MetricsExporter(self.stats, 'sync_salesforce', json_path=self.json_path)
+        with patch.object(exporter, '_stopped') as mock_stopped, patch.object(exporter, 'write') as mock_write:
+            mock_stopped.wait.side_effect = [False, False, True]
+            exporter._run()  # pylint: disable=protected-access
+
+        self.assertEqual(mock_write.call_count, 2)
+        mock_stopped.wait.assert_called_with(exporter.interval)
@@ -0,0 +1,62 @@
+"""
+Unit tests for edx_salesforce records module.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import copy
+import pickle
+
+from django.test import TestCase
+
+from edx_salesforce.records import record_class
+
+
+class TestRecords(TestCase):
+    """
+    Test records module.
+    """
+
+    def setUp(self):
+        super(TestRecords, self).setUp()
+
+        self.record = record_class('Order', ['order_id', 'course_id', 'coupon_codes'])
+
+    def test_record_class_is_built_once(self):
+        self.assertIs(record_class('Order', ['order_id', 'course_id', 'coupon_codes']), self.record)
+        self.assertIsNot(record_class('Order', ['order_id', 'course_id']), self.record)
+
+    def test_record_behaves_like_dict(self):
+        order = self.record([1, 'course-v1:testX:fake-course-id1'])
+
+        self.assertFalse(hasattr(order, '__dict__'))
+        self.assertEqual(order['order_id'], 1)
+        self.assertIsNone(order['coupon_codes'])
+        self.assertIsNone(order.get('username'))
+        self.assertIn('course_id', order)
+        self.assertNotIn('username', order)
+        with self.assertRaises(KeyError):
+            order['username']  # pylint: disable=pointless-statement
+        with self.assertRaises(KeyError):
+            order['username'] = 'fake-user1'
+
+        order['coupon_codes'] = ['fake-code1']
+        expected = {'order_id': 1, 'course_id': 'course-v1:testX:fake-course-id1', 'coupon_codes': ['fake-code1']}
+        self.assertEqual(order, expected)
+        self.assertEqual(expected, order)
+        self.assertNotEqual(order, dict(expected, order_id=2))
+        self.assertEqual(dict(order), expected)
+        self.assertEqual(len(order), 3)
+
+    def test_record_copy_and_pickle(self):
+        order = self.record([1, 'course-v1:testX:fake-course-id1'], coupon_codes=['fake-code1'])
+
+        self.assertEqual(copy.deepcopy(order), order)
+        unpickled = pickle.loads(pickle.dumps(order, pickle.HIGHEST_PROTOCOL))
+        self.assertIs(type(unpickled), self.record)
+        self.assertEqual(unpickled, order)
+
+    def test_invalid_field_name(self):
+        for field in ('keys', 'course id', '1st'):
+            with self.assertRaises(ValueError):
+                record_class('Invalid', [field])
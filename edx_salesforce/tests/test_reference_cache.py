@@ -0,0 +1,76 @@
+"""
+Unit tests for edx_salesforce reference_cache module.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+from decimal import Decimal
+
+from mock import patch
+
+from django.test import TestCase, override_settings
+
+from edx_salesforce.reference_cache import ReferenceCache, reference_cache_path
+from edx_salesforce.tests.mixins import StateDirMixin
+
+
+class TestReferenceCache(StateDirMixin, TestCase):
+    """
+    Test the persistent cache of reference object IDs.
+    """
+
+    def setUp(self):
+        super(TestReferenceCache, self).setUp()
+
+        self.path = reference_cache_path()
+
+    def test_set_and_get(self):
+        cache = ReferenceCache(self.path)
+        self.assertIsNone(cache.get('Product2', {'name': 'course-v1:testX+Test+T1'}))
+
+        cache.set('Product2', {'name': 'course-v1:testX+Test+T1'}, 'fake-product')
+        cache.set('PricebookEntry', {'pricebook2_id': 'fake-pricebook', 'product2_id': 'fake-product'},
+                  'fake-entry', unit_price=Decimal('49.00'))
+        cache.save()
+
+        cache = ReferenceCache(self.path)
+        self.assertEqual(cache.get('Product2', {'name': 'course-v1:testX+Test+T1'})['id'], 'fake-product')
+        entry = cache.get('PricebookEntry', {'product2_id': 'fake-product', 'pricebook2_id': 'fake-pricebook'})
+        self.assertEqual(entry['id'], 'fake-entry')
+        self.assertEqual(entry['fields'], {'unit_price': Decimal('49.00')})
+        self.assertIsNone(cache.get('Campaign', {'name': 'course-v1:testX+Test+T1'}))
+
+    def test_invalidate(self):
+        cache = ReferenceCache(self.path)
+        cache.set('Campaign', {'name': 'fake-campaign'}, 'fake-campaign-id')
+        cache.invalidate('Campaign', {'name': 'fake-campaign'})
+        cache.save()
+
+        self.assertIsNone(ReferenceCache(self.path).get('Campaign', {'name': 'fake-campaign'}))
+
+    def test_ttl(self):
+        with patch('edx_salesforce.reference_cache.time.time', return_value=1000):
+            cache = ReferenceCache(self.path)
+            cache.set('Campaign', {'name': 'fake-campaign'}, 'fake-campaign-id')
+            cache.save()
+
+        with override_settings(EDX_SALESFORCE_REFERENCE_CACHE_TTL=60):
+            with patch('edx_salesforce.reference_cache.time.time', return_value=1059):
+                self.assertIsNotNone(ReferenceCache(self.path).get('Campaign', {'name': 'fake-campaign'}))
+            with patch('edx_salesforce.reference_cache.time.time', return_value=1060):
+                cache = ReferenceCache(self.path)
+                self.assertEqual(cache.entries, {})
+
+    @override_settings(EDX_SALESFORCE_REFERENCE_CACHE_SIZE=2)
+    def test_lru_eviction(self):
+        cache = ReferenceCache(self.path)
+        for name in ('campaign1', 'campaign2'):
+            cache.set('Campaign', {'name': name}, name)
+        cache.get('Campaign', {'name': 'campaign1'})
+        cache.set('Campaign', {'name': 'campaign3'}, 'campaign3')
+        cache.save()
+
+        cache = ReferenceCache(self.path)
+        self.assertIsNone(cache.get('Campaign', {'name': 'campaign2'}))
+        self.assertIsNotNone(cache.get('Campaign', {'name': 'campaign1'}))
+        self.assertIsNotNone(cache.get('Campaign', {'name': 'campaign3'}))
@@ -0,0 +1,107 @@
+"""
+Unit tests for replay_failed_sync management command.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import copy
+from StringIO import StringIO
+
+from mock import patch
+
+from django.core.management import call_command
+from django.test import TestCase
+
+from edx_salesforce.models import Contact, Lead, Pricebook2
+from edx_salesforce.records import record_class
+from edx_salesforce.state import dead_letter_path, read_journal
+from edx_salesforce.tests.edx_sample_data import USER_DATA
+from edx_salesforce.tests.mixins import StateDirMixin
+
+
+class TestReplayFailedSync(StateDirMixin, TestCase):
+    """
+    Test replay_failed_sync management command.
+    """
+
+    def setUp(self):
+        super(TestReplayFailedSync, self).setUp()
+
+        self.orgs = ['testX']
+        self.site_domain = 'test_server.fake_domain'
+
+    def _call_command(self, command_name, *args):
+        """
+        Runs the given command for the test site and orgs and returns its output.
+        """
+        out = StringIO()
+        call_command(command_name, '--site-domain', self.site_domain, '--orgs', *(self.orgs + list(args)), stdout=out)
+        return out.getvalue()
+
+    @patch.object(Lead, 'save')
+    @patch('edx_salesforce.models.Lead.objects.get')
+    @patch('edx_salesforce.models.Pricebook2.objects.get')
+    @patch('edx_salesforce.management.commands.sync_salesforce.fetch_user_data')
+    def test_dead_letter_records(self, mock_user_fetch_data, mock_pricebook_get, mock_lead_get, mock_lead_save):
+        """
+        Test the extracted user records of failed users are stored as dicts, with their course records.
+        """
+        mock_pricebook_get.return_value = Pricebook2(is_standard=True)
+        order = record_class('Order', sorted(USER_DATA[0]['courses'][0]))
+        user = record_class('User', sorted(USER_DATA[0]))
+        mock_user_fetch_data.return_value = [
+            user(**dict(user_data, courses=[order(**course) for course in user_data['courses']]))
+            for user_data in USER_DATA
+        ]
+        mock_lead_get.side_effect = lambda username: Lead(
+            username=username, is_converted=False, converted_contact=Contact()
+        )
+        mock_lead_save.side_effect = Exception('fake error')
+
+        output = self._call_command('sync_salesforce', '--dead-letter')
+
+        self.assertIn('2 FAILED', output)
+        dead_letters = read_journal(dead_letter_path('sync_salesforce', self.site_domain, self.orgs))
+        self.assertEqual([letter['user'] for letter in dead_letters], USER_DATA)
+        for letter in dead_letters:
+            self.assertIs(type(letter['user']['courses'][0]), dict)
+
+    @patch.object(Lead, 'save')
+    @patch('edx_salesforce.models.Lead.objects.get')
+    @patch('edx_salesforce.models.Pricebook2.objects.get')
+    @patch('edx_salesforce.management.commands.sync_salesforce.fetch_user_data')
+    def test_replay_failed_users(self, mock_user_fetch_data, mock_pricebook_get, mock_lead_get, mock_lead_save):
+        mock_pricebook_get.return_value = Pricebook2(is_standard=True)
+        users = [dict(copy.deepcopy(user), courses=[]) for user in USER_DATA]
+        mock_user_fetch_data.return_value = users
+        mock_lead_get.side_effect = lambda username: Lead(
+            username=username, is_converted=False, converted_contact=Contact()
+        )
+        mock_lead_save.side_effect = [None, Exception('fake error')]
+
+        output = self._call_command('sync_salesforce', '--dead-letter')
+
+        self.assertIn('fake-user2: FAILED', output)
+        dead_letters = read_journal(dead_letter_path('sync_salesforce', self.site_domain, self.orgs))
+        self.assertEqual([letter['username'] for letter in dead_letters], ['fake-user2'])
+        self.assertIn('Exception: fake error', dead_letters[0]['error'])
+        self.assertEqual(dead_letters[0]['user'], users[1])
+
+        # The user fails again, then is synchronized.
+        mock_lead_save.side_effect = Exception('fake error again')
+        output = self._call_command('replay_failed_sync')
+        self.assertIn('1 FAILED', output)
+        mock_lead_get.assert_called_with(username='fake-user2')
+        dead_letters = read_journal(dead_letter_path('sync_salesforce', self.site_domain, self.orgs))
+        self.assertEqual(len(dead_letters), 1)
+        self.assertIn('Exception: fake error again', dead_letters[0]['error'])
+
+        mock_lead_save.side_effect = None
+        output = self._call_command('replay_failed_sync')
+        self.assertIn('fake-user2: SYNCHRONIZED', output)
+        self.assertEqual(read_journal(dead_letter_path('sync_salesforce', self.site_domain, self.orgs)), [])
+
+        mock_lead_get.reset_mock()
+        output = self._call_command('replay_failed_sync')
+        self.assertIn('No failed user accounts to replay', output)
+        self.assertFalse(mock_lead_get.called)
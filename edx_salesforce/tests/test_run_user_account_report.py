@@ -4,8 +4,10 @@ Unit tests for run_user_account_report management command.
 from __future__ import absolute_import, unicode_literals
 
 import glob
+import json
 import os
 import shutil
+from datetime import datetime
 
 import mock
 
@@ -14,9 +16,10 @@ from django.core.management import CommandError, call_command
 from django.test import TestCase
 
 from edx_salesforce.tests.edx_sample_data import USER_DATA
+from edx_salesforce.tests.mixins import StateDirMixin
 
 
-class TestUserAccountReport(TestCase):
+class TestUserAccountReport(StateDirMixin, TestCase):
     """
     Test run_user_account_report management command.
     """
@@ -99,6 +102,79 @@ class TestUserAccountReport(TestCase):
         # Output directory will be empty.
         self.assertEqual(len(output_directory), 0)
 
+    @mock.patch('edx_salesforce.management.commands.run_user_account_report.fetch_user_data')
+    def test_command_with_streamed_user_data(self, mock_user_fetch_data):
+        """
+        Test management command writes every user of a streamed data set to the csv file.
+        """
+        self._remove_output_directory()
+        users = mock.MagicMock()
+        users.__len__.return_value = len(USER_DATA)
+        users.__iter__.return_value = iter(USER_DATA)
+        mock_user_fetch_data.return_value = users
+        call_command(
+            'run_user_account_report',
+            '--site-domain', self.site_domain,
+            '--orgs', self.orgs,
+            '--stream',
+            '--batch-size', '1',
+        )
+        _, kwargs = mock_user_fetch_data.call_args
+        self.assertEqual(kwargs['batch_size'], 1)
+        self.assertTrue(kwargs['stream'])
+
+        output_directory = self._get_output_directory()
+        self.assertEqual(len(output_directory), 1)
+        with open(output_directory[0]) as csvfile:  # pylint: disable=open-builtin
+            # The header row followed by a row per user.
+            self.assertEqual(len(csvfile.readlines()), len(USER_DATA) + 1)
+
+    @mock.patch('edx_salesforce.management.mixins.fetch_watermarks')
+    @mock.patch('edx_salesforce.management.commands.run_user_account_report.fetch_user_data')
+    def test_command_incremental(self, mock_user_fetch_data, mock_fetch_watermarks):
+        """
+        Test incremental runs fetch the user data changed since the watermarks of the previous run.
+        """
+        first_watermarks = {'date_joined': datetime(2017, 1, 1), 'user_attribute_id': 12}
+        second_watermarks = {'date_joined': datetime(2017, 1, 2), 'user_attribute_id': 14}
+        mock_fetch_watermarks.side_effect = [first_watermarks, second_watermarks, second_watermarks]
+        mock_user_fetch_data.return_value = USER_DATA
+
+        for args in (['--incremental'], ['--incremental'], ['--full']):
+            call_command(
+                'run_user_account_report',
+                '--site-domain', self.site_domain,
+                '--orgs', *self.orgs + args
+            )
+
+        since = [kwargs.get('since') for _, kwargs in mock_user_fetch_data.call_args_list]
+        self.assertEqual(since, [None, first_watermarks, None])
+
+    @mock.patch('edx_salesforce.management.commands.run_user_account_report.fetch_user_data')
+    def test_command_with_metrics(self, mock_user_fetch_data):
+        """
+        Test management command writes the metrics of the run to the metrics files.
+        """
+        textfile_path = os.path.join(self.state_dir, 'report.prom')
+        json_path = os.path.join(self.state_dir, 'report.json')
+        mock_user_fetch_data.return_value = USER_DATA
+        call_command(
+            'run_user_account_report',
+            '--site-domain', self.site_domain,
+            '--orgs', *self.orgs + ['--metrics-textfile', textfile_path, '--metrics-json', json_path]
+        )
+
+        with open(json_path) as json_file:  # pylint: disable=open-builtin
+            metrics = json.load(json_file)
+        self.assertEqual(metrics['command'], 'run_user_account_report')
+        self.assertTrue(metrics['complete'])
+        self.assertEqual(metrics['users'], {'REPORTED': len(USER_DATA)})
+        self.assertEqual(sorted(metrics['phases']), ['extraction', 'report'])
+        with open(textfile_path) as textfile:  # pylint: disable=open-builtin
+            self.assertIn(
+                'edx_salesforce_users{command="run_user_account_report",status="REPORTED"} 2.0\n', textfile.read()
+            )
+
     def test_command_with_invalid_arguments(self):
         """
         Test management command raises CommandError with invalid argument.
@@ -0,0 +1,80 @@
+"""
+Unit tests for edx_salesforce snapshot module.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import os
+import time
+
+import mock
+
+from django.test import TestCase, override_settings
+
+from edx_salesforce import snapshot
+from edx_salesforce.records import record_class
+from edx_salesforce.tests.edx_sample_data import USER_DATA
+from edx_salesforce.tests.mixins import StateDirMixin
+
+
+class TestSnapshot(StateDirMixin, TestCase):
+    """
+    Test snapshot module.
+    """
+
+    def setUp(self):
+        super(TestSnapshot, self).setUp()
+
+        self.watermarks = {'user_attribute_id': 12}
+        self.path = snapshot.snapshot_path('fake-site.com', ['testX'], None, self.watermarks)
+
+    def test_write_and_load_snapshot(self):
+        user = record_class('User', USER_DATA[0].keys())
+        users = [user(USER_DATA[0].values()), user(USER_DATA[1].values())]
+
+        with mock.patch.object(snapshot, 'SNAPSHOT_BLOCK_SIZE', 1):
+            snapshot.write_snapshot(self.path, iter(users))
+
+        loaded = snapshot.load_snapshot(self.path)
+        self.assertEqual(len(loaded), 2)
+        self.assertEqual(list(loaded), USER_DATA)
+        self.assertIs(type(list(loaded)[0]), user)
+
+    def test_write_empty_snapshot(self):
+        snapshot.write_snapshot(self.path, [])
+
+        loaded = snapshot.load_snapshot(self.path)
+        self.assertFalse(loaded)
+        self.assertEqual(list(loaded), [])
+
+    def test_load_missing_or_expired_snapshot(self):
+        self.assertIsNone(snapshot.load_snapshot(self.path))
+
+        snapshot.write_snapshot(self.path, USER_DATA)
+        expired = time.time() - snapshot.DEFAULT_SNAPSHOT_TTL - 1
+        os.utime(self.path, (expired, expired))
+
+        self.assertIsNone(snapshot.load_snapshot(self.path))
+        with override_settings(EDX_SALESFORCE_SNAPSHOT_TTL=snapshot.DEFAULT_SNAPSHOT_TTL * 2):
+            self.assertIsNotNone(snapshot.load_snapshot(self.path))
+
+    def test_write_snapshot_replaces_older_snapshots(self):
+        snapshot.write_snapshot(self.path, USER_DATA)
+        other_site_path = snapshot.snapshot_path('other-site.com', ['testX'], None, self.watermarks)
+        snapshot.write_snapshot(other_site_path, USER_DATA)
+
+        new_path = snapshot.snapshot_path('fake-site.com', ['testX'], None, {'user_attribute_id': 13})
+        self.assertNotEqual(new_path, self.path)
+        snapshot.write_snapshot(new_path, USER_DATA[:1])
+
+        self.assertEqual(
+            sorted(os.listdir(os.path.dirname(self.path))),
+            sorted([os.path.basename(new_path), os.path.basename(other_site_path)])
+        )
+
+    def test_invalid_snapshot(self):
+        with open(self.path, 'wb') as snapshot_file:  # pylint: disable=open-builtin
+            snapshot_file.write(b'NOTASNAPSHOT' * 2)
+
+        with self.assertRaises(ValueError):
+            snapshot.load_snapshot(self.path)
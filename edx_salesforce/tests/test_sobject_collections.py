@@ -0,0 +1,135 @@
+"""
+Unit tests for edx_salesforce sobject_collections module.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+from datetime import datetime
+
+import pytz
+from mock import Mock
+
+from django.test import TestCase
+
+from edx_salesforce.models import Campaign, CampaignMember, Contact, Lead
+from edx_salesforce.rest import RestApiError
+from edx_salesforce.sobject_collections import SObjectCollectionsClient, WriteBuffer
+
+
+def _results(records, errors=None):
+    """
+    Return fake sObject Collections results of the given records, failing the records of the given usernames.
+    """
+    errors = errors or {}
+    results = []
+    for number, record in enumerate(records, 1):
+        error = errors.get(record.get('Username__c'))
+        if error:
+            results.append({'id': None, 'success': False, 'errors': [
+                {'statusCode': error, 'message': 'fake message', 'fields': []}
+            ]})
+        else:
+            results.append({'id': record.get('Id', '{type}{number}'.format(
+                type=record['attributes']['type'], number=number
+            )), 'success': True, 'errors': []})
+    return results
+
+
+class TestWriteBuffer(TestCase):
+    """
+    Test the buffering of writes in sObject Collections requests.
+    """
+
+    def setUp(self):
+        super(TestWriteBuffer, self).setUp()
+
+        self.client = Mock(spec=SObjectCollectionsClient)
+        self.client.create.side_effect = _results
+        self.client.update.side_effect = _results
+        self.writes = WriteBuffer(self.client, size=3)
+
+    def test_create_and_update(self):
+        lead = Lead(username='fake-user1', company='fake-user1', last_name='Fake')
+        self.writes.save(lead, 'fake-user1', ['last_name'])
+        member = self.writes.create(CampaignMember, 'fake-user1', campaign=Campaign(id='fake-campaign'), lead=lead)
+        lead.pi_utm_campaign = 'fake-campaign'
+        self.writes.save(lead, 'fake-user1', ['pi_utm_campaign'])
+        contact = Contact(id='fake-contact1', email='fake@example.com', last_name='Fake')
+        self.writes.save(contact, 'fake-user2', ['email'])
+        self.writes.save(contact, 'fake-user2', ['last_name'])
+
+        self.assertFalse(self.client.create.called)
+        self.writes.flush()
+
+        self.assertEqual(lead.pk, 'Lead1')
+        self.assertEqual(member.pk, 'CampaignMember1')
+        lead_records, member_records = [args[0] for args, _ in self.client.create.call_args_list]
+        self.assertEqual(len(lead_records), 1)
+        self.assertEqual(lead_records[0]['Username__c'], 'fake-user1')
+        self.assertEqual(lead_records[0]['Company'], 'fake-user1')
+        self.assertEqual(lead_records[0]['pi__utm_campaign__c'], 'fake-campaign')
+        self.assertNotIn('Id', lead_records[0])
+        self.assertNotIn('ConvertedContactId', lead_records[0])
+        self.assertEqual(member_records, [
+            {'attributes': {'type': 'CampaignMember'}, 'CampaignId': 'fake-campaign', 'LeadId': 'Lead1'}
+        ])
+        self.client.update.assert_called_once_with([{
+            'attributes': {'type': 'Contact'},
+            'Id': 'fake-contact1',
+            'Email': 'fake@example.com',
+            'LastName': 'Fake',
+        }])
+        self.assertEqual(self.writes.pop_failures(), {})
+
+    def test_flush_full_collection(self):
+        for number in range(4):
+            contact = Contact(
+                id='fake-contact{}'.format(number),
+                registration_date=pytz.utc.localize(datetime(2017, 1, 1, 11, 11, 11)),
+            )
+            self.writes.save(contact, 'fake-user{}'.format(number), ['registration_date'])
+
+        self.assertEqual(self.client.update.call_count, 1)
+        self.assertEqual(len(self.client.update.call_args[0][0]), 3)
+        record = self.client.update.call_args[0][0][0]
+        self.assertEqual(record['Registration_Date__c'], '2017-01-01T11:11:11.000+0000')
+        self.writes.flush()
+        self.assertEqual(self.client.update.call_count, 2)
+
+    def test_failures(self):
+        self.client.create.side_effect = lambda records: _results(records, {'fake-user2': 'DUPLICATE_VALUE'})
+        for username in ('fake-user1', 'fake-user2'):
+            self.writes.save(Lead(username=username, company=username), username)
+        self.writes.save(Contact(id='fake-contact1'), 'fake-user3', ['email'])
+        self.client.update.side_effect = RestApiError('fake error')
+
+        self.writes.flush()
+
+        self.assertEqual(self.writes.pop_failures(), {
+            'fake-user2': ['Lead: DUPLICATE_VALUE: fake message'],
+            'fake-user3': ['Contact: fake error'],
+        })
+        self.assertEqual(self.writes.pop_failures(), {})
+
+
+class TestSObjectCollectionsClient(TestCase):
+    """
+    Test the sObject Collections client requests.
+    """
+
+    def test_create(self):
+        session = Mock()
+        session.post.return_value = Mock(
+            status_code=200,
+            headers={'Content-Type': 'application/json;charset=UTF-8'},
+            content=b'[]',
+            json=Mock(return_value=[{'id': 'fake-lead1', 'success': True, 'errors': []}]),
+        )
+        client = SObjectCollectionsClient(session, 'https://fake.salesforce.com')
+
+        records = [{'attributes': {'type': 'Lead'}, 'Username__c': 'fake-user1'}]
+        self.assertEqual(client.create(records), [{'id': 'fake-lead1', 'success': True, 'errors': []}])
+
+        args, kwargs = session.post.call_args
+        self.assertEqual(args, ('https://fake.salesforce.com/services/data/v42.0/composite/sobjects',))
+        self.assertEqual(kwargs['json'], {'allOrNone': False, 'records': records})
@@ -0,0 +1,86 @@
+"""
+Unit tests for edx_salesforce state module.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import os
+from datetime import date, datetime
+from decimal import Decimal
+
+import pytz
+
+from django.test import TestCase
+
+from edx_salesforce import state
+from edx_salesforce.records import record_class
+from edx_salesforce.tests.mixins import StateDirMixin
+
+
+class TestState(StateDirMixin, TestCase):
+    """
+    Test state module.
+    """
+
+    def test_save_and_load_watermarks(self):
+        watermarks = {
+            'date_joined': datetime(2017, 1, 1, 11, 11, 11, 123),
+            'date_placed': None,
+            'user_attribute_id': 12,
+        }
+        self.assertIsNone(state.load_watermarks('sync_salesforce', 'fake-site.com', ['testX']))
+
+        state.save_watermarks('sync_salesforce', 'fake-site.com', ['testX'], watermarks)
+
+        self.assertEqual(state.load_watermarks('sync_salesforce', 'fake-site.com', ['testX']), watermarks)
+        self.assertIsNone(state.load_watermarks('run_user_account_report', 'fake-site.com', ['testX']))
+        self.assertIsNone(state.load_watermarks('sync_salesforce', 'fake-site.com', ['testX', 'TestB']))
+        self.assertEqual(os.listdir(os.path.join(self.state_dir, 'watermarks', 'sync_salesforce')), [
+            state.run_key('fake-site.com', ['testX'])
+        ])
+
+    def test_run_key_ignores_org_order(self):
+        self.assertEqual(
+            state.run_key('fake-site.com', ['testX', 'TestB']),
+            state.run_key('fake-site.com', ['TestB', 'testX', 'TestB'])
+        )
+
+    def test_write_and_read_state(self):
+        path = state.state_path('test', 'value.json')
+        value = {
+            'aware': pytz.timezone('America/New_York').localize(datetime(2017, 1, 1, 6, 0, 0)),
+            'date': date(2017, 1, 1),
+            'price': Decimal('10.11'),
+        }
+        state.write_state(path, value)
+
+        self.assertEqual(state.read_state(path), {
+            'aware': datetime(2017, 1, 1, 11, 0, 0),
+            'date': date(2017, 1, 1),
+            'price': Decimal('10.11'),
+        })
+        self.assertFalse(os.path.exists('{path}.tmp'.format(path=path)))
+
+    def test_append_and_read_journal(self):
+        path = state.state_path('test', 'journal')
+        self.assertEqual(state.read_journal(path), [])
+
+        state.append_journal(path, {'users': {'fake-user1': 'SYNCHRONIZED'}})
+        state.append_journal(path, {'price': Decimal('10.11')})
+        with open(path, 'ab') as journal_file:  # pylint: disable=open-builtin
+            journal_file.write(b'{"users": {"fake-us')
+
+        self.assertEqual(state.read_journal(path), [
+            {'users': {'fake-user1': 'SYNCHRONIZED'}},
+            {'price': Decimal('10.11')},
+        ])
+
+    def test_value_digest_of_records(self):
+        order = record_class('Order', ['order_id', 'unit_price'])
+        user = record_class('User', ['username', 'courses'])
+        records = user(['fake-user1', [order([1, Decimal('10.11')])]])
+
+        self.assertEqual(
+            state.value_digest(records),
+            state.value_digest({'username': 'fake-user1', 'courses': [{'order_id': 1, 'unit_price': Decimal('10.11')}]})
+        )
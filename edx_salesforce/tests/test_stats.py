@@ -0,0 +1,89 @@
+"""
+Unit tests for edx_salesforce stats module.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import json
+
+import ddt
+import requests
+from mock import patch
+
+from django.test import TestCase
+
+from edx_salesforce.stats import RunStats, request_operation
+
+BASE_URL = 'https://na1.salesforce.com/services/data/v42.0/'
+
+
+@ddt.ddt
+class TestRunStats(TestCase):
+    """
+    Test the timing and API request accounting of a run.
+    """
+
+    @ddt.data(
+        ('GET', 'query/?q=SELECT+Id+FROM+Lead+WHERE+Username__c+%3D+%27a%27', None, ('Lead', 'query')),
+        (
+            'GET',
+            'query/?q=SELECT+Id%2C+%28SELECT+Id+FROM+Contacts%29+FROM+Account',
+            None,
+            ('Account', 'query'),
+        ),
+        ('GET', 'query/01gD0000002HU6KIAW-2000', None, ('', 'query')),
+        ('POST', 'sobjects/Opportunity/', '{}', ('Opportunity', 'insert')),
+        ('PATCH', 'sobjects/Lead/00Q000000000001', '{}', ('Lead', 'update')),
+        ('DELETE', 'sobjects/Lead/00Q000000000001', None, ('Lead', 'delete')),
+        (
+            'PATCH',
+            'composite/sobjects',
+            json.dumps({'allOrNone': False, 'records': [{'attributes': {'type': 'Contact'}}]}),
+            ('Contact', 'update'),
+        ),
+        ('POST', 'jobs/ingest/', '{}', ('', 'jobs')),
+        ('GET', 'limits/', None, ('', 'limits')),
+    )
+    @ddt.unpack
+    def test_request_operation(self, method, path, body, expected):
+        request = requests.Request(method, BASE_URL + path, data=body).prepare()
+        self.assertEqual(request_operation(request), expected)
+
+    def test_counts_responses(self):
+        stats = RunStats()
+        for path in ('sobjects/Lead/', 'sobjects/Lead/', 'query/?q=SELECT+Id+FROM+Product2'):
+            response = requests.Response()
+            response.request = requests.Request('POST' if 'sobjects' in path else 'GET', BASE_URL + path).prepare()
+            stats._count_response(response)  # pylint: disable=protected-access
+        stats.count_api_call('Lead', 'convertLead')
+
+        result = stats.as_dict()
+        self.assertEqual(result['api_calls'], {'Lead': {'insert': 2, 'convertLead': 1}, 'Product2': {'query': 1}})
+        self.assertEqual(result['api_call_count'], 4)
+        self.assertIn('  Lead insert: 2', stats.summary())
+
+    @patch('edx_salesforce.stats.time.time')
+    def test_phases_and_latencies(self, mock_time):
+        mock_time.side_effect = [100.0, 100.0, 102.5, 103.0, 103.5, 110.0, 110.0]
+        stats = RunStats()
+        with stats.phase('extraction'):
+            pass
+        with self.assertRaises(ValueError):
+            with stats.phase('extraction'):
+                raise ValueError
+        for latency in range(1, 101):
+            stats.record_latency(float(latency))
+
+        result = stats.as_dict()
+        self.assertEqual(result['elapsed'], 10.0)
+        self.assertEqual(result['phases'], {'extraction': {'seconds': 3.0, 'count': 2}})
+        self.assertEqual(
+            dict(result['user_latency']),
+            {'count': 100, 'p50': 50.0, 'p90': 90.0, 'p99': 99.0, 'max': 100.0}
+        )
+        self.assertIn('  extraction: 3.000s in 2 calls', stats.summary())
+
+    def test_empty_latencies(self):
+        result = RunStats().as_dict()
+        self.assertEqual(result['user_latency']['count'], 0)
+        self.assertIsNone(result['user_latency']['p50'])
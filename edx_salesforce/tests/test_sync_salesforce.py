@@ -5,24 +5,42 @@ Unit tests for sync_salesforce management command.
 
 from __future__ import absolute_import, unicode_literals
 
+import copy
 import decimal
+import json
+import os
+import re
+import time
+from multiprocessing.pool import ThreadPool
+from StringIO import StringIO
 
 import pytz
-from mock import Mock, patch, PropertyMock
+import requests
+from mock import ANY, MagicMock, Mock, patch, PropertyMock
+from salesforce.backend.driver import SalesforceError
 
 from django.conf import settings
-from django.core.management import call_command
-from django.test import TestCase
+from django.core.management import CommandError, call_command
+from django.test import TestCase, override_settings
 
+from edx_salesforce.bulk import BulkApiClient
 from edx_salesforce.choices import COUNTRIES_BY_CODE, EDUCATION_BY_CODE
+from edx_salesforce.edx_data import UserDataStream, fetch_user_data
+from edx_salesforce.management.commands.sync_salesforce import (DEFAULT_SYNC_RETRIES, STATUS_SYNCHRONIZED, UTM_FIELDS,
+                                                                 _user_fingerprint)
 from edx_salesforce.management.commands.sync_salesforce import Command as SyncSalesforceCommand
-from edx_salesforce.models import (Campaign, Contact, DiscountCode, Lead, Opportunity, Pricebook2, PricebookEntry,
-                                   Product2)
+from edx_salesforce.models import (Account, Campaign, Contact, DiscountCode, Lead, Opportunity, Pricebook2,
+                                   PricebookEntry, Product2)
+from edx_salesforce.sobject_collections import SObjectCollectionsClient
+from edx_salesforce.state import append_journal
 from edx_salesforce.tests.edx_sample_data import USER_DATA
+from edx_salesforce.tests.fake_bulk_api import FakeBulkApiServer
+from edx_salesforce.tests.mixins import DatabaseMixin, StateDirMixin
+from edx_salesforce.throttling import RequestScheduler
 from edx_salesforce.utils import parse_user_full_name
 
 
-class TestSyncSalesForce(TestCase):
+class TestSyncSalesForce(StateDirMixin, TestCase):
     """
     Test sync_salesforce management command.
     """
@@ -32,7 +50,7 @@ class TestSyncSalesForce(TestCase):
 
         self.orgs = ['testX']
         self.site_domain = 'test_server.fake_domain'
-        self.user_data = USER_DATA[0]
+        self.user_data = copy.deepcopy(USER_DATA[0])
 
     def _get_user_data(self):
         """
@@ -143,7 +161,7 @@ class TestSyncSalesForce(TestCase):
         self.assertTrue(mock_convert_lead.called)
         self.assertTrue(mock_contact_save.called)
         self.assertTrue(mock_opp_contact_role_create.called)
-        self.assertTrue(mock_price_book_save.called)
+        mock_price_book_save.assert_called_once_with(update_fields=['unit_price'])
         self.assertTrue(mock_opp_line_item_create.called)
 
     @patch.object(PricebookEntry, 'save')
@@ -226,6 +244,38 @@ class TestSyncSalesForce(TestCase):
         self.assertTrue(mock_campaign_member_create.called)
         self.assertTrue(mock_lead_save.called)
 
+    @patch('edx_salesforce.models.CampaignMember.objects.create')
+    @patch('edx_salesforce.models.Campaign.objects.get_or_create')
+    @patch.object(Lead, 'save_base', autospec=True)
+    @patch('edx_salesforce.models.Lead.objects.get', side_effect=Lead.DoesNotExist)
+    @patch('edx_salesforce.models.Pricebook2.objects.get')
+    @patch('edx_salesforce.management.commands.sync_salesforce.fetch_user_data')
+    def test_command_with_no_lead_saves_utm_fields(self, mock_user_fetch_data, mock_pricebook_get, mock_lead_get,
+                                                   mock_lead_save_base, mock_campaign_get_or_create,
+                                                   mock_campaign_member_create):
+        """
+        Test the UTM fields of a new Lead are saved through Lead.save once the Lead is created.
+        """
+        def save_base(lead, **kwargs):
+            """
+            Assigns an ID to the Lead when it is created.
+            """
+            if not lead.pk:
+                lead.pk = '00Q000000000001'
+
+        mock_lead_save_base.side_effect = save_base
+        mock_pricebook_get.return_value = Pricebook2(is_standard=True)
+        mock_user_fetch_data.return_value = [dict(self.user_data, courses=[])]
+        mock_campaign_get_or_create.return_value = Campaign(name=self.user_data['tracking']['utm_campaign']), True
+
+        out = StringIO()
+        call_command('sync_salesforce', '--site-domain', self.site_domain, '--orgs', self.orgs, stdout=out)
+
+        self.assertIn('fake-user1: SYNCHRONIZED', out.getvalue())
+        self.assertEqual(mock_lead_save_base.call_count, 2)
+        _, kwargs = mock_lead_save_base.call_args
+        self.assertEqual(sorted(kwargs['update_fields']), sorted(UTM_FIELDS))
+
     @patch('edx_salesforce.models.CampaignMember.objects.create')
     @patch('edx_salesforce.models.Campaign.objects.get_or_create')
     @patch.object(Lead, 'save')
@@ -387,6 +437,64 @@ class TestSyncSalesForce(TestCase):
         mock_pricebook_get.assert_called_with(is_standard=True)
         self.assertFalse(mock_lead_save.called)
 
+    @patch.object(Lead, 'save')
+    @patch('edx_salesforce.models.Lead.objects.get')
+    @patch('edx_salesforce.models.Pricebook2.objects.get')
+    @patch('edx_salesforce.management.commands.sync_salesforce.fetch_user_data')
+    def test_command_saves_changed_fields(self, mock_user_fetch_data, mock_pricebook_get, mock_lead_get,
+                                          mock_lead_save):
+        """
+        Test only the changed fields of an existing Lead are saved.
+        """
+        mock_pricebook_get.return_value = Pricebook2(is_standard=True)
+        lead = self._get_lead_object(is_converted=False)
+        lead.pk = '00Q000000000001'
+        mock_lead_get.return_value = lead
+        mock_user_fetch_data.return_value = [dict(self.user_data, courses=[], country='FR')]
+
+        out = StringIO()
+        call_command('sync_salesforce', '--site-domain', self.site_domain, '--orgs', self.orgs, stdout=out)
+
+        self.assertIn('fake-user1: SYNCHRONIZED', out.getvalue())
+        mock_lead_save.assert_called_once_with(update_fields=['country'])
+        self.assertEqual(lead.country, 'France FR')
+
+    @patch('edx_salesforce.stats.RunStats.install')
+    @patch.object(Lead, 'save')
+    @patch('edx_salesforce.models.Lead.objects.get')
+    @patch('edx_salesforce.models.Pricebook2.objects.get')
+    @patch('edx_salesforce.management.commands.sync_salesforce.fetch_user_data')
+    def test_command_with_stats(self, mock_user_fetch_data, mock_pricebook_get, mock_lead_get, mock_lead_save,
+                                mock_stats_install):
+        """
+        Test the stats of the run are output and written to the stats and metrics files.
+        """
+        mock_pricebook_get.return_value = Pricebook2(is_standard=True)
+        mock_lead_get.return_value = self._get_lead_object(is_converted=False)
+        mock_user_fetch_data.return_value = [dict(self.user_data, courses=[], country='FR')]
+        stats_file = '{dir}/stats.json'.format(dir=self.state_dir)
+        metrics_file = '{dir}/metrics.json'.format(dir=self.state_dir)
+
+        out = StringIO()
+        call_command(
+            'sync_salesforce', '--site-domain', self.site_domain, '--orgs', self.orgs, '--stats-file', stats_file,
+            '--metrics-json', metrics_file, stdout=out
+        )
+
+        self.assertTrue(mock_stats_install.called)
+        output = out.getvalue()
+        self.assertIn('Phases (seconds, summed over workers):', output)
+        self.assertIn('  lead lookup: ', output)
+        self.assertIn('User latency: p50 ', output)
+        with open(stats_file) as stats:
+            result = json.load(stats)
+        self.assertEqual(sorted(result['phases']), ['extraction', 'lead and contact update', 'lead lookup'])
+        self.assertEqual(result['user_latency']['count'], 1)
+        with open(metrics_file) as metrics:
+            result = json.load(metrics)
+        self.assertTrue(result['complete'])
+        self.assertEqual(result['users'], {'SYNCHRONIZED': 1})
+
     @patch.object(Lead, 'save')
     @patch('edx_salesforce.models.Campaign.objects.get_or_create')
     @patch('edx_salesforce.models.CampaignMember.objects.create')
@@ -419,6 +527,832 @@ class TestSyncSalesForce(TestCase):
             '--orgs', self.orgs
         )
 
+    @patch('edx_salesforce.management.mixins.fetch_watermarks')
+    @patch.object(Lead, 'save')
+    @patch('edx_salesforce.models.Lead.objects.get')
+    @patch('edx_salesforce.models.Pricebook2.objects.get')
+    @patch('edx_salesforce.management.commands.sync_salesforce.fetch_user_data')
+    def test_command_incremental_with_failed_user(self, mock_user_fetch_data, mock_pricebook_get,
+                                                  mock_lead_get, mock_lead_save, mock_fetch_watermarks):
+        """
+        Test the watermarks of an incremental run are only recorded when every user is synchronized.
+        """
+        watermarks = {'user_attribute_id': 12}
+        mock_fetch_watermarks.return_value = watermarks
+        mock_pricebook_get.return_value = Pricebook2(is_standard=True)
+        mock_lead_get.return_value = self._get_lead_object(is_converted=False)
+        user_data_without_courses = dict(self.user_data, courses={})
+        user_data_with_error = dict(self.user_data)
+        user_data_with_error.pop('courses')
+
+        for users in ([user_data_with_error], [user_data_without_courses], []):
+            mock_user_fetch_data.return_value = users
+            call_command(
+                'sync_salesforce',
+                '--site-domain', self.site_domain,
+                '--orgs', self.orgs,
+                '--incremental'
+            )
+
+        since = [kwargs['since'] for _, kwargs in mock_user_fetch_data.call_args_list]
+        self.assertEqual(since, [None, None, watermarks])
+
+    @patch.object(Contact, 'save')
+    @patch.object(Lead, 'save')
+    @patch('edx_salesforce.models.CampaignMember.objects.create')
+    @patch('edx_salesforce.models.Campaign.objects.get_or_create')
+    @patch('edx_salesforce.models.Contact.objects.filter')
+    @patch('edx_salesforce.models.Lead.objects.filter')
+    @patch('edx_salesforce.models.Lead.objects.get')
+    @patch('edx_salesforce.models.Pricebook2.objects.get')
+    @patch('edx_salesforce.management.commands.sync_salesforce.fetch_user_data')
+    def test_command_with_prefetched_leads(self, mock_user_fetch_data, mock_pricebook_get, mock_lead_get,
+                                           mock_lead_filter, mock_contact_filter, mock_campaign_get_or_create,
+                                           mock_campaign_member_create, mock_lead_save, mock_contact_save):
+        """
+        Test management command looks up prefetched Leads and converted Contacts instead of querying per user.
+        """
+        in_sync_user = dict(self.user_data, courses={})
+        deleted_contact_user = dict(self.user_data, username='fake-user2', courses={})
+        new_user = dict(self.user_data, username='fake-user3', courses={})
+        mock_user_fetch_data.return_value = [in_sync_user, deleted_contact_user, new_user]
+        mock_pricebook_get.return_value = Pricebook2(is_standard=True)
+        mock_campaign_get_or_create.return_value = Campaign(name='fake-campaign-utm'), True
+
+        contact = Contact(id='fake-contact1', **self._get_user_data())
+        converted_lead = self._get_lead_object(is_converted=True)
+        converted_lead.username = 'Fake-User1'
+        converted_lead.converted_contact_id = contact.id
+        deleted_contact_lead = Lead(username='fake-user2', is_converted=True, converted_contact_id='fake-contact2')
+        mock_lead_filter.return_value = [converted_lead, deleted_contact_lead]
+        mock_contact_filter.return_value = [contact]
+
+        call_command(
+            'sync_salesforce',
+            '--site-domain', self.site_domain,
+            '--orgs', self.orgs,
+            '--prefetch'
+        )
+
+        self.assertFalse(mock_lead_get.called)
+        mock_lead_filter.assert_called_once_with(username__in=['fake-user1', 'fake-user2', 'fake-user3'])
+        mock_contact_filter.assert_called_once_with(pk__in=['fake-contact1', 'fake-contact2'])
+        self.assertFalse(mock_contact_save.called)
+        self.assertTrue(mock_lead_save.called)
+        self.assertEqual(mock_lead_save.call_count, 2)
+
+    @override_settings(EDX_SALESFORCE_BULK_POLL_INTERVAL=0)
+    @patch.object(Contact, 'save')
+    @patch.object(Lead, 'save')
+    @patch('edx_salesforce.models.CampaignMember.objects.create')
+    @patch('edx_salesforce.models.Campaign.objects.get_or_create')
+    @patch('edx_salesforce.models.Contact.objects.filter')
+    @patch('edx_salesforce.models.Lead.objects.filter')
+    @patch('edx_salesforce.models.Pricebook2.objects.get')
+    @patch('edx_salesforce.management.commands.sync_salesforce.fetch_user_data')
+    def test_command_with_bulk(self, mock_user_fetch_data, mock_pricebook_get, mock_lead_filter, mock_contact_filter,
+                               mock_campaign_get_or_create, mock_campaign_member_create, mock_lead_save,
+                               mock_contact_save):
+        """
+        Test management command upserts Leads and Contacts with Bulk API jobs and reports failed rows.
+        """
+        server = FakeBulkApiServer(failing={'fake-user2': 'INVALID_EMAIL_ADDRESS:Email: invalid email address'})
+        server.start()
+        self.addCleanup(server.stop)
+
+        changed_user = dict(self.user_data, email='changed@example.com', courses={})
+        failing_user = dict(self.user_data, username='fake-user2', email='invalid', courses={})
+        new_user = dict(self.user_data, username='fake-user3', courses={})
+        in_sync_user = dict(self.user_data, username='fake-user4', courses={})
+        mock_user_fetch_data.return_value = [changed_user, failing_user, new_user, in_sync_user]
+        mock_pricebook_get.return_value = Pricebook2(is_standard=True)
+        campaign = Campaign(name=self.user_data['tracking']['utm_campaign'])
+        mock_campaign_get_or_create.return_value = campaign, True
+
+        contact = Contact(id='fake-contact1', **self._get_user_data())
+        converted_lead = self._get_lead_object(is_converted=True)
+        converted_lead.converted_contact_id = contact.id
+        unconverted_lead = self._get_lead_object()
+        unconverted_lead.username = 'fake-user2'
+        in_sync_lead = self._get_lead_object()
+        in_sync_lead.username = 'fake-user4'
+        mock_lead_filter.return_value = [converted_lead, unconverted_lead, in_sync_lead]
+        mock_contact_filter.return_value = [contact]
+
+        out = StringIO()
+        with patch.object(BulkApiClient, 'from_connection', return_value=BulkApiClient(requests.Session(), server.url)):
+            call_command(
+                'sync_salesforce',
+                '--site-domain', self.site_domain,
+                '--orgs', self.orgs,
+                '--bulk',
+                stdout=out
+            )
+
+        self.assertFalse(mock_lead_save.called)
+        self.assertFalse(mock_contact_save.called)
+        jobs = sorted(server.jobs.values(), key=lambda job: job['object'])
+        self.assertEqual([(job['object'], job['externalIdFieldName']) for job in jobs], [
+            ('Contact', 'Id'), ('Lead', 'Username__c')
+        ])
+        self.assertEqual(jobs[0]['data'].splitlines(), [b'Id,Email', b'fake-contact1,changed@example.com'])
+        self.assertEqual([line.split(b',')[0] for line in jobs[1]['data'].splitlines()], [
+            b'Username__c', b'fake-user2', b'fake-user3'
+        ])
+
+        mock_campaign_member_create.assert_called_once_with(campaign=campaign, lead=ANY)
+        self.assertEqual(mock_campaign_member_create.call_args[1]['lead'].pk, '00Q000000000000002')
+        output = out.getvalue()
+        self.assertIn('fake-user1: SYNCHRONIZED', output)
+        self.assertIn('fake-user2: Bulk API upsert failed: INVALID_EMAIL_ADDRESS', output)
+        self.assertIn('fake-user2: FAILED', output)
+        self.assertIn('fake-user3: SYNCHRONIZED', output)
+        self.assertIn('fake-user4: In Sync', output)
+
+    @patch.object(Contact, 'save')
+    @patch.object(Lead, 'save')
+    @patch('edx_salesforce.models.CampaignMember.objects.create')
+    @patch('edx_salesforce.models.Campaign.objects.get_or_create')
+    @patch('edx_salesforce.models.Lead.objects.get')
+    @patch('edx_salesforce.models.Pricebook2.objects.get')
+    @patch('edx_salesforce.management.commands.sync_salesforce.fetch_user_data')
+    def test_command_with_collections(self, mock_user_fetch_data, mock_pricebook_get, mock_lead_get,
+                                      mock_campaign_get_or_create, mock_campaign_member_create, mock_lead_save,
+                                      mock_contact_save):
+        """
+        Test management command buffers its writes in sObject Collections requests and reports failed writes.
+        """
+        new_user = dict(self.user_data, courses={})
+        failing_user = dict(self.user_data, username='fake-user2', courses={})
+        mock_user_fetch_data.return_value = [new_user, failing_user]
+        mock_pricebook_get.return_value = Pricebook2(is_standard=True)
+        mock_lead_get.side_effect = Lead.DoesNotExist
+        mock_campaign_get_or_create.return_value = Campaign(id='fake-campaign', name='fake-campaign-utm'), True
+
+        client = Mock(spec=SObjectCollectionsClient)
+        client.create.side_effect = lambda records: [
+            {'id': None, 'success': False, 'errors': [{'statusCode': 'DUPLICATE_VALUE', 'message': 'duplicate'}]}
+            if record.get('Username__c') == 'fake-user2' or 'LeadId' in record and record['LeadId'] is None
+            else {'id': 'fake-id', 'success': True, 'errors': []}
+            for record in records
+        ]
+
+        out = StringIO()
+        with patch.object(SObjectCollectionsClient, 'from_connection', return_value=client):
+            call_command(
+                'sync_salesforce',
+                '--site-domain', self.site_domain,
+                '--orgs', self.orgs,
+                '--collections',
+                stdout=out
+            )
+
+        self.assertFalse(mock_lead_save.called)
+        self.assertFalse(mock_campaign_member_create.called)
+        self.assertEqual([len(args[0]) for args, _ in client.create.call_args_list], [2, 2])
+        output = out.getvalue()
+        self.assertIn('fake-user1: SYNCHRONIZED', output)
+        self.assertIn('fake-user2: Lead: DUPLICATE_VALUE: duplicate', output)
+        self.assertIn('fake-user2: FAILED', output)
+        self.assertIn('1 FAILED', output)
+
+    @patch('edx_salesforce.models.OpportunityLineItem.objects.create')
+    @patch('edx_salesforce.models.OpportunityContactRole.objects.create')
+    @patch('edx_salesforce.models.PricebookEntry.objects.get')
+    @patch('edx_salesforce.models.Product2.objects.get_or_create')
+    @patch('edx_salesforce.models.DiscountCode.objects.get_or_create')
+    @patch('edx_salesforce.models.Opportunity.objects.create')
+    @patch('edx_salesforce.models.Opportunity.objects.get_or_create')
+    @patch('edx_salesforce.models.Opportunity.objects.filter')
+    @patch('edx_salesforce.models.Contact.objects.filter')
+    @patch('edx_salesforce.models.Lead.objects.filter')
+    @patch('edx_salesforce.models.Pricebook2.objects.get')
+    @patch('edx_salesforce.management.commands.sync_salesforce.fetch_user_data')
+    def test_command_with_prefetched_opportunities(self, mock_user_fetch_data, mock_pricebook_get, mock_lead_filter,
+                                                   mock_contact_filter, mock_opp_filter, mock_opp_get_or_create,
+                                                   mock_opp_create, mock_dc_get_or_create,
+                                                   mock_product2_get_or_create, mock_price_book_entry_get,
+                                                   mock_opp_contact_role_create, mock_opp_line_item_create):
+        """
+        Test management command only creates the Opportunities of new purchases when Opportunities are prefetched.
+        """
+        course = self.user_data['courses'][0]
+        new_course = dict(course, course_id='course-v1:testX:fake-course-id2')
+        mock_user_fetch_data.return_value = [dict(self.user_data, courses=[course, new_course])]
+        mock_pricebook_get.return_value = Pricebook2(is_standard=True)
+        contact = Contact(id='fake-contact1', **self._get_user_data())
+        lead = self._get_lead_object(is_converted=True)
+        lead.converted_contact_id = contact.id
+        lead.converted_account_id = 'fake-account1'
+        mock_lead_filter.return_value = [lead]
+        mock_contact_filter.return_value = [contact]
+        mock_opp_filter.return_value = [Opportunity(
+            id='fake-opportunity1',
+            account_id='fake-account1',
+            name=course['course_id'],
+            amount=decimal.Decimal('10.1100'),
+            close_date=course['purchase_date'].date(),
+            paid_date=course['purchase_date'].date(),
+            stage_name='Paid',
+        )]
+        mock_opp_create.return_value = Opportunity(id='fake-opportunity2')
+        mock_dc_get_or_create.return_value = DiscountCode(name=course['coupon_codes'][0]), True
+        mock_product2_get_or_create.return_value = Product2(name=new_course['course_id']), True
+        mock_price_book_entry_get.return_value = PricebookEntry(unit_price=decimal.Decimal('100.00'))
+
+        call_command(
+            'sync_salesforce',
+            '--site-domain', self.site_domain,
+            '--orgs', self.orgs,
+            '--prefetch'
+        )
+
+        mock_opp_filter.assert_called_once_with(account__in=['fake-account1'])
+        self.assertFalse(mock_opp_get_or_create.called)
+        mock_opp_create.assert_called_once_with(
+            account_id='fake-account1',
+            name=new_course['course_id'],
+            amount=course['unit_price'] * course['quantity'],
+            close_date=course['purchase_date'],
+            paid_date=course['purchase_date'],
+            stage_name='Paid'
+        )
+        self.assertEqual(mock_opp_line_item_create.call_count, 1)
+
+    @patch('edx_salesforce.models.OpportunityLineItem.objects.create')
+    @patch('edx_salesforce.models.OpportunityContactRole.objects.create')
+    @patch('edx_salesforce.models.PricebookEntry.objects.create')
+    @patch('edx_salesforce.models.PricebookEntry.objects.get', side_effect=PricebookEntry.DoesNotExist)
+    @patch('edx_salesforce.models.Product2.objects.get_or_create')
+    @patch('edx_salesforce.models.DiscountCode.objects.get_or_create')
+    @patch('edx_salesforce.models.Opportunity.objects.get_or_create')
+    @patch('edx_salesforce.models.Lead.objects.get')
+    @patch('edx_salesforce.models.Pricebook2.objects.get')
+    @patch('edx_salesforce.management.commands.sync_salesforce.fetch_user_data')
+    def test_command_with_reference_cache(self, mock_user_fetch_data, mock_pricebook_get, mock_lead_get,
+                                          mock_opp_get_or_create, mock_dc_get_or_create,
+                                          mock_product2_get_or_create, mock_price_book_entry_get,
+                                          mock_price_book_entry_create, mock_opp_contact_role_create,
+                                          mock_opp_line_item_create):
+        """
+        Test the reference objects looked up by a run aren't looked up again by the next runs, unless
+        a user using them fails to synchronize.
+        """
+        course = self.user_data['courses'][0]
+        mock_user_fetch_data.return_value = [self.user_data]
+        mock_pricebook_get.return_value = Pricebook2(id='fake-pricebook', is_standard=True)
+        mock_lead_get.return_value = self._get_lead_object(is_converted=True)
+        mock_opp_get_or_create.side_effect = lambda **kwargs: (Opportunity(id='fake-opportunity'), True)
+        mock_dc_get_or_create.return_value = DiscountCode(id='fake-discount', name=course['coupon_codes'][0]), True
+        mock_product2_get_or_create.return_value = Product2(id='fake-product', name=course['course_id']), True
+        mock_price_book_entry_create.side_effect = lambda **kwargs: PricebookEntry(id='fake-entry', **kwargs)
+        reference_mocks = (mock_dc_get_or_create, mock_product2_get_or_create, mock_price_book_entry_get)
+
+        def run_command():
+            """
+            Runs the command with the reference cache and returns its output.
+            """
+            out = StringIO()
+            call_command(
+                'sync_salesforce',
+                '--site-domain', self.site_domain,
+                '--orgs', self.orgs,
+                '--reference-cache',
+                stdout=out
+            )
+            return out.getvalue()
+
+        run_command()
+        self.assertEqual([mock.call_count for mock in reference_mocks], [1, 1, 1])
+
+        # The failing user invalidates the cached objects it used.
+        mock_opp_line_item_create.side_effect = Exception('fake error')
+        self.assertIn('1 FAILED', run_command())
+        self.assertEqual([mock.call_count for mock in reference_mocks], [1, 1, 1])
+        mock_opp_line_item_create.side_effect = None
+
+        self.assertIn('1 SYNCHRONIZED', run_command())
+        self.assertEqual([mock.call_count for mock in reference_mocks], [2, 2, 2])
+        line_item = mock_opp_line_item_create.call_args[1]
+        self.assertEqual(line_item['pricebook_entry'].pk, 'fake-entry')
+        self.assertEqual(line_item['discount_code'].pk, 'fake-discount')
+
+        run_command()
+        self.assertEqual([mock.call_count for mock in reference_mocks], [2, 2, 2])
+
+    @patch('edx_salesforce.models.OpportunityLineItem.objects.create')
+    @patch('edx_salesforce.models.OpportunityContactRole.objects.create')
+    @patch('edx_salesforce.models.PricebookEntry.objects.create')
+    @patch('edx_salesforce.models.PricebookEntry.objects.get', side_effect=PricebookEntry.DoesNotExist)
+    @patch('edx_salesforce.models.Product2.objects.get_or_create')
+    @patch('edx_salesforce.models.DiscountCode.objects.get_or_create')
+    @patch('edx_salesforce.models.Opportunity.objects.get_or_create')
+    @patch('edx_salesforce.models.Lead.objects.get')
+    @patch('edx_salesforce.models.Pricebook2.objects.get')
+    @patch('edx_salesforce.management.commands.sync_salesforce.fetch_user_data')
+    def test_command_with_stale_reference_cache(self, mock_user_fetch_data, mock_pricebook_get, mock_lead_get,
+                                                mock_opp_get_or_create, mock_dc_get_or_create,
+                                                mock_product2_get_or_create, mock_price_book_entry_get,
+                                                mock_price_book_entry_create, mock_opp_contact_role_create,
+                                                mock_opp_line_item_create):
+        """
+        Test a cached reference object rejected by Salesforce is looked up again, and the object
+        referring to it is created once more.
+        """
+        course = self.user_data['courses'][0]
+        mock_user_fetch_data.return_value = [self.user_data]
+        mock_pricebook_get.return_value = Pricebook2(id='fake-pricebook', is_standard=True)
+        mock_lead_get.return_value = self._get_lead_object(is_converted=True)
+        mock_opp_get_or_create.side_effect = lambda **kwargs: (Opportunity(id='fake-opportunity'), True)
+        mock_dc_get_or_create.return_value = DiscountCode(id='fake-discount', name=course['coupon_codes'][0]), True
+        mock_product2_get_or_create.return_value = Product2(id='fake-product', name=course['course_id']), True
+        mock_price_book_entry_create.side_effect = lambda **kwargs: PricebookEntry(id='fake-entry', **kwargs)
+        reference_mocks = (mock_dc_get_or_create, mock_product2_get_or_create, mock_price_book_entry_get)
+        command_args = ('--site-domain', self.site_domain, '--orgs', self.orgs, '--reference-cache')
+
+        call_command('sync_salesforce', *command_args, stdout=StringIO())
+        self.assertEqual([mock.call_count for mock in reference_mocks], [1, 1, 1])
+
+        mock_opp_line_item_create.reset_mock()
+        mock_opp_line_item_create.side_effect = [
+            SalesforceError(
+                'entity is deleted', {'errorCode': 'ENTITY_IS_DELETED'}, Mock(status_code=400)
+            ),
+            None,
+        ]
+        out = StringIO()
+        call_command('sync_salesforce', *command_args, stdout=out)
+        self.assertIn('Looking up the cached objects again after error', out.getvalue())
+        self.assertIn('1 SYNCHRONIZED', out.getvalue())
+        self.assertEqual([mock.call_count for mock in reference_mocks], [2, 2, 2])
+        self.assertEqual(mock_opp_line_item_create.call_count, 2)
+        self.assertEqual(mock_opp_contact_role_create.call_count, 2)
+
+    @patch.object(PricebookEntry, 'save')
+    @patch('edx_salesforce.models.OpportunityLineItem.objects.create')
+    @patch('edx_salesforce.models.OpportunityContactRole.objects.create')
+    @patch('edx_salesforce.models.PricebookEntry.objects.get')
+    @patch('edx_salesforce.models.PricebookEntry.objects.filter')
+    @patch('edx_salesforce.models.Product2.objects.create')
+    @patch('edx_salesforce.models.Product2.objects.filter')
+    @patch('edx_salesforce.models.Product2.objects.get_or_create')
+    @patch('edx_salesforce.models.DiscountCode.objects.get_or_create')
+    @patch('edx_salesforce.models.Opportunity.objects.get_or_create')
+    @patch('edx_salesforce.models.Lead.objects.get')
+    @patch('edx_salesforce.models.Pricebook2.objects.get')
+    @patch('edx_salesforce.management.commands.sync_salesforce.fetch_user_data')
+    def test_command_with_planned_pricebook(self, mock_user_fetch_data, mock_pricebook_get, mock_lead_get,
+                                            mock_opp_get_or_create, mock_dc_get_or_create,
+                                            mock_product2_get_or_create, mock_product2_filter, mock_product2_create,
+                                            mock_price_book_entry_filter, mock_price_book_entry_get,
+                                            mock_opp_contact_role_create, mock_opp_line_item_create,
+                                            mock_price_book_save):
+        """
+        Test the Product2 and PricebookEntry of a course are read and written once, with the maximum
+        list price of its purchases.
+        """
+        course = self.user_data['courses'][0]
+        cheaper_course = dict(course, list_price=course['list_price'] - 10)
+        self.user_data['courses'] = [cheaper_course, course]
+        other_user_data = dict(copy.deepcopy(self.user_data), username='fake-user2', courses=[cheaper_course])
+        price_book = Pricebook2(id='fake-pricebook', is_standard=True)
+        product = Product2(id='fake-product', name=course['course_id'])
+        pricebook_entry = PricebookEntry(
+            id='fake-entry', pricebook2=price_book, product2=product, unit_price=course['list_price'] - 20
+        )
+
+        mock_user_fetch_data.return_value = [self.user_data, other_user_data]
+        mock_pricebook_get.return_value = price_book
+        mock_lead_get.return_value = self._get_lead_object(is_converted=True)
+        mock_opp_get_or_create.side_effect = lambda **kwargs: (Opportunity(id='fake-opportunity'), True)
+        mock_dc_get_or_create.return_value = DiscountCode(name=course['coupon_codes'][0]), True
+        mock_product2_filter.return_value = []
+        mock_product2_create.return_value = product
+        mock_price_book_entry_filter.return_value = [pricebook_entry]
+
+        call_command(
+            'sync_salesforce',
+            '--site-domain', self.site_domain,
+            '--orgs', self.orgs,
+            '--plan-pricebook'
+        )
+
+        mock_product2_filter.assert_called_once_with(name__in=[course['course_id']])
+        mock_product2_create.assert_called_once_with(name=course['course_id'])
+        mock_price_book_entry_filter.assert_called_once_with(
+            pricebook2=price_book, product2__in=['fake-product'], is_active=True
+        )
+        mock_price_book_save.assert_called_once_with(update_fields=['unit_price'])
+        self.assertEqual(pricebook_entry.unit_price, course['list_price'])
+        self.assertFalse(mock_product2_get_or_create.called)
+        self.assertFalse(mock_price_book_entry_get.called)
+        self.assertEqual(mock_opp_line_item_create.call_count, 3)
+        self.assertTrue(all(
+            kwargs['pricebook_entry'] is pricebook_entry for _, kwargs in mock_opp_line_item_create.call_args_list
+        ))
+
+    @patch.object(SyncSalesforceCommand, '_plan_pricebook_entries')
+    @patch.object(Lead, 'save')
+    @patch('edx_salesforce.models.Lead.objects.get')
+    @patch('edx_salesforce.models.Pricebook2.objects.get')
+    @patch('edx_salesforce.management.commands.sync_salesforce.fetch_user_data')
+    def test_command_with_planned_pricebook_and_stream(self, mock_user_fetch_data, mock_pricebook_get, mock_lead_get,
+                                                       mock_lead_save, mock_plan_pricebook_entries):
+        """
+        Test the PricebookEntries of a stream of users are planned from the orders it fetched, without
+        extracting the users twice.
+        """
+        users = MagicMock(spec=UserDataStream)
+        users.__iter__.return_value = iter([dict(self.user_data, courses=[])])
+        users.__len__.return_value = 1
+        users.orders.return_value = iter(self.user_data['courses'])
+        mock_user_fetch_data.return_value = users
+        mock_pricebook_get.return_value = Pricebook2(is_standard=True)
+        mock_lead_get.return_value = self._get_lead_object(is_converted=False)
+        planned = []
+        mock_plan_pricebook_entries.side_effect = lambda purchases: planned.extend(purchases)
+
+        out = StringIO()
+        call_command(
+            'sync_salesforce',
+            '--site-domain', self.site_domain,
+            '--orgs', self.orgs,
+            '--plan-pricebook',
+            '--stream',
+            stdout=out
+        )
+
+        self.assertEqual(planned, self.user_data['courses'])
+        self.assertEqual(users.__iter__.call_count, 1)
+        self.assertIn('fake-user1: In Sync', out.getvalue())
+
+    @patch.object(Lead, 'save')
+    @patch('edx_salesforce.models.Lead.objects.get')
+    @patch('edx_salesforce.models.Pricebook2.objects.get')
+    @patch('edx_salesforce.management.commands.sync_salesforce.fetch_user_data')
+    def test_command_skip_unchanged(self, mock_user_fetch_data, mock_pricebook_get, mock_lead_get, mock_lead_save):
+        """
+        Test users whose data is unchanged since it was last synchronized are skipped, unless verified.
+        """
+        mock_pricebook_get.return_value = Pricebook2(is_standard=True)
+        mock_lead_get.side_effect = lambda username: self._get_lead_object(is_converted=False)
+        self.user_data['courses'] = []
+        other_user_data = dict(copy.deepcopy(self.user_data), username='fake-user2', full_name='Other User')
+        mock_user_fetch_data.return_value = [self.user_data, other_user_data]
+
+        def run_command(*args):
+            """
+            Runs the command with the given options and returns the number of looked up Leads and its output.
+            """
+            mock_lead_get.reset_mock()
+            out = StringIO()
+            call_command(
+                'sync_salesforce',
+                '--site-domain', self.site_domain,
+                '--orgs', self.orgs,
+                *args,
+                stdout=out
+            )
+            return mock_lead_get.call_count, out.getvalue()
+
+        # The Lead of the other user is out of sync, and fails to save.
+        mock_lead_save.side_effect = Exception('fake error')
+        lookups, output = run_command('--skip-unchanged')
+        self.assertEqual(lookups, 2)
+        self.assertIn('fake-user2: FAILED', output)
+        mock_lead_save.side_effect = None
+
+        lookups, output = run_command('--skip-unchanged')
+        self.assertEqual(lookups, 1)
+        self.assertIn('fake-user1: In Sync', output)
+        self.assertIn('fake-user2: SYNCHRONIZED', output)
+
+        lookups, output = run_command('--skip-unchanged')
+        self.assertEqual(lookups, 0)
+        self.assertIn('2 In Sync', output)
+
+        other_user_data['email'] = 'other@example.com'
+        lookups, _ = run_command('--skip-unchanged')
+        self.assertEqual(lookups, 1)
+
+        lookups, output = run_command('--verify')
+        self.assertEqual(lookups, 2)
+
+    @override_settings(EDX_SALESFORCE_CHECKPOINT_INTERVAL=1)
+    @patch('edx_salesforce.management.commands.sync_salesforce.PREFETCH_BATCH_SIZE', 1)
+    @patch('edx_salesforce.models.CampaignMember.objects.create')
+    @patch('edx_salesforce.models.Campaign.objects.get_or_create')
+    @patch.object(Lead, 'save')
+    @patch('edx_salesforce.models.Lead.objects.get')
+    @patch('edx_salesforce.models.Pricebook2.objects.get')
+    @patch('edx_salesforce.management.commands.sync_salesforce.fetch_user_data')
+    def test_command_resume(self, mock_user_fetch_data, mock_pricebook_get, mock_lead_get, mock_lead_save,
+                            mock_campaign_get_or_create, mock_campaign_member_create):
+        """
+        Test a run resumed from the checkpoints of an interrupted run has the statuses of an uninterrupted run.
+        """
+        utm_campaign = self.user_data['tracking']['utm_campaign']
+        mock_pricebook_get.return_value = Pricebook2(is_standard=True)
+        mock_campaign_get_or_create.return_value = Campaign(id='fake-campaign', name=utm_campaign), True
+        users = [dict(copy.deepcopy(self.user_data), username='fake-user{}'.format(number), courses=[])
+                 for number in range(1, 4)]
+        users[1].pop('courses')
+        mock_user_fetch_data.return_value = users
+        interrupt = {'enabled': False}
+
+        def get_lead(username):
+            """
+            Interrupts the run at the last user, if enabled.
+            """
+            if username == 'fake-user3' and interrupt['enabled']:
+                raise KeyboardInterrupt
+            raise Lead.DoesNotExist
+
+        mock_lead_get.side_effect = get_lead
+
+        def run_command(*args):
+            """
+            Runs the command with the given options and returns its summary output.
+            """
+            out = StringIO()
+            call_command('sync_salesforce', '--site-domain', self.site_domain, '--orgs', self.orgs, *args,
+                         stdout=out)
+            return [line for line in out.getvalue().splitlines() if re.match('[0-9]+ ', line)]
+
+        uninterrupted = run_command()
+        self.assertEqual(uninterrupted, ['1 FAILED', '0 In Sync', '2 SYNCHRONIZED'])
+
+        interrupt['enabled'] = True
+        with self.assertRaises(KeyboardInterrupt):
+            run_command('--checkpoint')
+        interrupt['enabled'] = False
+        mock_lead_get.reset_mock()
+        mock_campaign_get_or_create.reset_mock()
+
+        self.assertEqual(run_command('--resume'), uninterrupted)
+        mock_lead_get.assert_called_once_with(username='fake-user3')
+        self.assertFalse(mock_campaign_get_or_create.called)
+        self.assertEqual(mock_campaign_member_create.call_args[1]['campaign'].pk, 'fake-campaign')
+
+        # The checkpoints of a complete run are removed.
+        mock_lead_get.reset_mock()
+        run_command('--resume')
+        self.assertEqual(mock_lead_get.call_count, 3)
+
+    @patch('edx_salesforce.models.Pricebook2.objects.get')
+    def test_resume_from_checkpoint_reads_users_lazily(self, mock_pricebook_get):
+        """
+        Test the users synchronized by an interrupted run are skipped while the users are consumed.
+        """
+        command = SyncSalesforceCommand(stdout=StringIO())
+        command.checkpoint_path = os.path.join(self.state_dir, 'checkpoint')
+        append_journal(command.checkpoint_path, {
+            'users': {'fake-user1': STATUS_SYNCHRONIZED, 'fake-user2': None},
+            'references': {},
+        })
+        read = []
+
+        def iter_users():
+            """
+            Yields the users, recording the usernames read.
+            """
+            for number in range(1, 4):
+                read.append('fake-user{}'.format(number))
+                yield {'username': 'fake-user{}'.format(number)}
+
+        status_count = {STATUS_SYNCHRONIZED: 0}
+        remaining = command._resume_from_checkpoint(iter_users(), status_count)  # pylint: disable=protected-access
+        self.assertEqual(read, [])
+
+        self.assertEqual([user['username'] for user in remaining], ['fake-user3'])
+        self.assertEqual(status_count, {STATUS_SYNCHRONIZED: 1})
+
+    @patch('edx_salesforce.management.commands.sync_salesforce.PREFETCH_BATCH_SIZE', 1)
+    @patch('edx_salesforce.management.commands.sync_salesforce.RequestScheduler')
+    @patch.object(Lead, 'save')
+    @patch('edx_salesforce.models.Lead.objects.get')
+    @patch('edx_salesforce.models.Pricebook2.objects.get')
+    @patch('edx_salesforce.management.commands.sync_salesforce.fetch_user_data')
+    def test_command_with_max_api_share(self, mock_user_fetch_data, mock_pricebook_get, mock_lead_get,
+                                        mock_lead_save, mock_scheduler_class):
+        """
+        Test the command stops with a checkpoint once the configured share of the daily API limit is used.
+        """
+        mock_pricebook_get.return_value = Pricebook2(is_standard=True)
+        mock_lead_get.side_effect = lambda username: self._get_lead_object(is_converted=False)
+        mock_user_fetch_data.return_value = [
+            dict(copy.deepcopy(self.user_data), username='fake-user{}'.format(number), courses=[])
+            for number in range(1, 3)
+        ]
+        scheduler = mock_scheduler_class.return_value
+        scheduler.exhausted.side_effect = [False, True]
+        scheduler.api_usage, scheduler.api_limit = 8000, 10000
+
+        with self.assertRaisesRegexp(CommandError, 'Stopped after 8000 of the 10000 daily API requests'):
+            call_command(
+                'sync_salesforce', '--site-domain', self.site_domain, '--orgs', self.orgs, '--max-api-share', '0.8'
+            )
+
+        mock_scheduler_class.assert_called_once_with(0.8)
+        self.assertTrue(scheduler.install.called)
+        self.assertTrue(scheduler.update_limits.called)
+        mock_lead_get.assert_called_once_with(username='fake-user1')
+
+        scheduler.exhausted.side_effect = None
+        scheduler.exhausted.return_value = False
+        call_command(
+            'sync_salesforce', '--site-domain', self.site_domain, '--orgs', self.orgs, '--max-api-share', '0.8',
+            '--resume'
+        )
+        mock_lead_get.assert_called_with(username='fake-user2')
+        self.assertEqual(mock_lead_get.call_count, 2)
+
+    @patch('edx_salesforce.models.Pricebook2.objects.get')
+    @patch('edx_salesforce.management.commands.sync_salesforce.fetch_user_data')
+    def test_command_with_invalid_max_api_share(self, mock_user_fetch_data, mock_pricebook_get):
+        """
+        Test the share of the daily API limit must be between 0 and 1.
+        """
+        for share in ('0', '1.5'):
+            with self.assertRaises(CommandError):
+                call_command(
+                    'sync_salesforce', '--site-domain', self.site_domain, '--orgs', self.orgs, '--max-api-share', share
+                )
+        self.assertFalse(mock_user_fetch_data.called)
+
+    @patch('edx_salesforce.management.commands.sync_salesforce.time.sleep')
+    @patch.object(Lead, 'save')
+    @patch('edx_salesforce.models.Lead.objects.get')
+    @patch('edx_salesforce.models.Pricebook2.objects.get')
+    @patch('edx_salesforce.management.commands.sync_salesforce.fetch_user_data')
+    def test_command_retries_transient_errors(self, mock_user_fetch_data, mock_pricebook_get, mock_lead_get,
+                                              mock_lead_save, mock_sleep):
+        """
+        Test users are synchronized again after transient errors, up to the number of retries.
+        """
+        mock_pricebook_get.return_value = Pricebook2(is_standard=True)
+        mock_user_fetch_data.return_value = [dict(self.user_data, courses=[])]
+        lock_error = SalesforceError(
+            'unable to obtain exclusive access to this record',
+            {'errorCode': 'UNABLE_TO_LOCK_ROW'},
+            Mock(status_code=400)
+        )
+        mock_lead_get.side_effect = [lock_error, lock_error, self._get_lead_object(is_converted=False)]
+
+        out = StringIO()
+        call_command('sync_salesforce', '--site-domain', self.site_domain, '--orgs', self.orgs, stdout=out)
+
+        self.assertEqual(mock_lead_get.call_count, 3)
+        self.assertEqual(out.getvalue().count('Retrying after transient error'), 2)
+        self.assertIn('fake-user1: In Sync', out.getvalue())
+        self.assertEqual(mock_sleep.call_count, 2)
+        self.assertLessEqual(mock_sleep.call_args_list[1][0][0], 2)
+
+        mock_lead_get.side_effect = lock_error
+        out = StringIO()
+        with override_settings(EDX_SALESFORCE_SYNC_RETRIES=1):
+            call_command('sync_salesforce', '--site-domain', self.site_domain, '--orgs', self.orgs, stdout=out)
+
+        self.assertEqual(mock_lead_get.call_count, 5)
+        self.assertIn('fake-user1: FAILED', out.getvalue())
+
+    @patch('edx_salesforce.management.commands.sync_salesforce.time.sleep')
+    @patch.object(Lead, 'save', autospec=True)
+    @patch('edx_salesforce.models.CampaignMember.objects.create')
+    @patch('edx_salesforce.models.Campaign.objects.get_or_create')
+    @patch('edx_salesforce.models.Contact.objects.filter')
+    @patch('edx_salesforce.models.Lead.objects.filter')
+    @patch('edx_salesforce.models.Pricebook2.objects.get')
+    @patch('edx_salesforce.management.commands.sync_salesforce.fetch_user_data')
+    def test_command_retry_does_not_create_lead_again(self, mock_user_fetch_data, mock_pricebook_get,
+                                                      mock_lead_filter, mock_contact_filter,
+                                                      mock_campaign_get_or_create, mock_campaign_member_create,
+                                                      mock_lead_save, mock_sleep):
+        """
+        Test a user retried after a transient error following the creation of its Lead finds the created Lead.
+        """
+        mock_user_fetch_data.return_value = [dict(self.user_data, courses=[])]
+        mock_pricebook_get.return_value = Pricebook2(is_standard=True)
+        mock_lead_filter.return_value = []
+        mock_contact_filter.return_value = []
+        mock_campaign_get_or_create.return_value = Campaign(name='fake-campaign-utm'), True
+        mock_campaign_member_create.side_effect = [
+            SalesforceError('unable to lock row', {'errorCode': 'UNABLE_TO_LOCK_ROW'}, Mock(status_code=400)),
+            Mock(),
+        ]
+
+        def save_lead(lead, update_fields=None):
+            lead.pk = lead.pk or 'fake-lead1'
+
+        mock_lead_save.side_effect = save_lead
+
+        out = StringIO()
+        call_command(
+            'sync_salesforce',
+            '--site-domain', self.site_domain,
+            '--orgs', self.orgs,
+            '--prefetch',
+            stdout=out
+        )
+
+        self.assertEqual(out.getvalue().count('Retrying after transient error'), 1)
+        self.assertEqual(mock_sleep.call_count, 1)
+        inserts = [call for call in mock_lead_save.call_args_list if not call[1].get('update_fields')]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(mock_campaign_member_create.call_count, 2)
+        utm_updates = [call for call in mock_lead_save.call_args_list if call[1].get('update_fields') == UTM_FIELDS]
+        self.assertEqual(len(utm_updates), 1)
+
+    @patch('edx_salesforce.management.commands.sync_salesforce.time.sleep')
+    @patch.object(PricebookEntry, 'save')
+    @patch.object(Contact, 'save')
+    @patch.object(Lead, 'save')
+    @patch('edx_salesforce.models.OpportunityLineItem.objects.create')
+    @patch('edx_salesforce.models.OpportunityContactRole.objects.create')
+    @patch('edx_salesforce.models.PricebookEntry.objects.get')
+    @patch('edx_salesforce.models.Product2.objects.get_or_create')
+    @patch('edx_salesforce.models.DiscountCode.objects.get_or_create')
+    @patch('edx_salesforce.models.Opportunity.objects.create')
+    @patch('edx_salesforce.management.commands.sync_salesforce.convert_lead')
+    @patch('edx_salesforce.models.Lead.objects.get')
+    @patch('edx_salesforce.models.Opportunity.objects.filter')
+    @patch('edx_salesforce.models.Contact.objects.filter')
+    @patch('edx_salesforce.models.Lead.objects.filter')
+    @patch('edx_salesforce.models.Pricebook2.objects.get')
+    @patch('edx_salesforce.management.commands.sync_salesforce.fetch_user_data')
+    def test_command_retry_resumes_purchases(self, mock_user_fetch_data, mock_pricebook_get, mock_lead_filter,
+                                             mock_contact_filter, mock_opp_filter, mock_lead_get, mock_convert_lead,
+                                             mock_opp_create, mock_dc_get_or_create, mock_product2_get_or_create,
+                                             mock_price_book_entry_get, mock_opp_contact_role_create,
+                                             mock_opp_line_item_create, mock_lead_save, mock_contact_save,
+                                             mock_price_book_entry_save, mock_sleep):
+        """
+        Test a user retried after transient errors following the conversion of its Lead and the creation
+        of an Opportunity neither converts the Lead again nor skips the children of the Opportunity.
+        """
+        course = self.user_data['courses'][0]
+        mock_user_fetch_data.return_value = [self.user_data]
+        mock_pricebook_get.return_value = Pricebook2(is_standard=True)
+        mock_lead_filter.return_value = [self._get_lead_object(is_converted=False)]
+        mock_contact_filter.return_value = []
+        mock_opp_filter.return_value = []
+        converted_lead = self._get_lead_object(is_converted=True)
+        converted_lead.converted_contact = Contact(id='fake-contact1', **self._get_user_data())
+        converted_lead.converted_account_id = 'fake-account1'
+        mock_lead_get.return_value = converted_lead
+        lock_error = SalesforceError('unable to lock row', {'errorCode': 'UNABLE_TO_LOCK_ROW'}, Mock(status_code=400))
+        mock_opp_create.side_effect = [lock_error, Opportunity(id='fake-opportunity1')]
+        mock_dc_get_or_create.return_value = DiscountCode(name=course['coupon_codes'][0]), True
+        mock_product2_get_or_create.return_value = Product2(name=course['course_id']), True
+        mock_price_book_entry_get.return_value = PricebookEntry(unit_price=decimal.Decimal('100.00'))
+        mock_opp_line_item_create.side_effect = [lock_error, Mock()]
+
+        out = StringIO()
+        call_command(
+            'sync_salesforce',
+            '--site-domain', self.site_domain,
+            '--orgs', self.orgs,
+            '--prefetch',
+            stdout=out
+        )
+
+        self.assertEqual(out.getvalue().count('Retrying after transient error'), 2)
+        self.assertIn('1 SYNCHRONIZED', out.getvalue())
+        self.assertEqual(mock_convert_lead.call_count, 1)
+        self.assertEqual(mock_opp_create.call_count, 2)
+        self.assertEqual(mock_opp_contact_role_create.call_count, 1)
+        self.assertEqual(mock_opp_line_item_create.call_count, 2)
+
+    @patch.object(RequestScheduler, 'install')
+    @patch('edx_salesforce.management.commands.sync_salesforce.time.sleep')
+    @patch('edx_salesforce.models.Lead.objects.get')
+    @patch('edx_salesforce.models.Pricebook2.objects.get')
+    @patch('edx_salesforce.management.commands.sync_salesforce.fetch_user_data')
+    def test_command_does_not_retry_throttled_requests_again(self, mock_user_fetch_data, mock_pricebook_get,
+                                                             mock_lead_get, mock_sleep, mock_install):
+        """
+        Test users failing with a throttled request aren't synchronized again when the request scheduler
+        already retried the request.
+        """
+        mock_pricebook_get.return_value = Pricebook2(is_standard=True)
+        mock_user_fetch_data.return_value = [dict(self.user_data, courses=[])]
+        unavailable = requests.Response()
+        unavailable.status_code = 503
+        mock_lead_get.side_effect = SalesforceError('fake', {'errorCode': 'SERVER_UNAVAILABLE'}, unavailable)
+
+        out = StringIO()
+        call_command('sync_salesforce', '--site-domain', self.site_domain, '--orgs', self.orgs, stdout=out)
+        self.assertEqual(out.getvalue().count('Retrying after transient error'), DEFAULT_SYNC_RETRIES)
+
+        mock_lead_get.reset_mock()
+        out = StringIO()
+        call_command(
+            'sync_salesforce', '--site-domain', self.site_domain, '--orgs', self.orgs, '--throttle', stdout=out
+        )
+        self.assertEqual(mock_lead_get.call_count, 1)
+        self.assertNotIn('Retrying after transient error', out.getvalue())
+        self.assertIn('fake-user1: FAILED', out.getvalue())
+
     @patch('edx_salesforce.models.Pricebook2.objects.get')
     @patch('edx_salesforce.models.Campaign.objects.get_or_create')
     def test_get_or_create_cached(self, mock_campaign_get_or_create, mock_pricebook_get):
@@ -439,6 +1373,198 @@ class TestSyncSalesForce(TestCase):
         command._get_or_create('Campaign', name='bar')  # pylint: disable=protected-access
         mock_campaign_get_or_create.assert_called()
 
+    @patch('edx_salesforce.models.OpportunityLineItem.objects.create')
+    @patch('edx_salesforce.models.OpportunityContactRole.objects.create')
+    @patch('edx_salesforce.models.PricebookEntry.objects.get')
+    @patch('edx_salesforce.models.Product2.objects.get_or_create')
+    @patch('edx_salesforce.models.DiscountCode.objects.get_or_create')
+    @patch('edx_salesforce.models.Opportunity.objects.get_or_create')
+    @patch('edx_salesforce.management.commands.sync_salesforce.convert_lead')
+    @patch('edx_salesforce.management.commands.sync_salesforce.convert_leads')
+    @patch('edx_salesforce.models.Lead.objects.get')
+    @patch('edx_salesforce.models.Pricebook2.objects.get')
+    @patch('edx_salesforce.management.commands.sync_salesforce.fetch_user_data')
+    def test_command_with_batch_conversions(self, mock_user_fetch_data, mock_pricebook_get, mock_lead_get,
+                                            mock_convert_leads, mock_convert_lead, mock_opp_get_or_create,
+                                            mock_dc_get_or_create, mock_product2_get_or_create,
+                                            mock_price_book_entry_get, mock_opp_contact_role_create,
+                                            mock_opp_line_item_create):
+        """
+        Test management command converts the Leads of a batch together and uses the returned IDs.
+        """
+        course = self.user_data['courses'][0]
+        users = [dict(self.user_data, username='fake-user{}'.format(number)) for number in range(1, 4)]
+        mock_user_fetch_data.return_value = users
+        price_book = Pricebook2(is_standard=True)
+        mock_pricebook_get.return_value = price_book
+
+        def get_lead(username):
+            lead = self._get_lead_object()
+            lead.pk = username.replace('user', 'lead')
+            lead.username = username
+            return lead
+
+        mock_lead_get.side_effect = lambda **kwargs: get_lead(kwargs['username'])
+        mock_convert_leads.return_value = [
+            {'success': True, 'leadId': 'fake-lead1', 'accountId': 'fake-account1', 'contactId': 'fake-contact1'},
+            {'success': False, 'leadId': 'fake-lead2', 'errors': ['INVALID_STATUS: invalid status']},
+            {'success': True, 'leadId': 'fake-lead3', 'accountId': 'fake-account3', 'contactId': 'fake-contact3'},
+        ]
+        mock_opp_get_or_create.return_value = Opportunity(name=course['course_id']), True
+        mock_dc_get_or_create.return_value = DiscountCode(name=course['coupon_codes'][0]), True
+        mock_product2_get_or_create.return_value = Product2(name=course['course_id']), True
+        mock_price_book_entry_get.return_value = PricebookEntry(unit_price=decimal.Decimal('100.00'))
+        client = Mock(spec=SObjectCollectionsClient)
+        client.update.side_effect = lambda records: [
+            {'id': record['Id'], 'success': record['Id'] != 'fake-contact3', 'errors': [
+                {'statusCode': 'UNABLE_TO_LOCK_ROW', 'message': 'locked'}
+            ]}
+            for record in records
+        ]
+
+        out = StringIO()
+        with patch.object(SObjectCollectionsClient, 'from_connection', return_value=client):
+            call_command(
+                'sync_salesforce',
+                '--site-domain', self.site_domain,
+                '--orgs', self.orgs,
+                '--batch-conversions',
+                stdout=out
+            )
+
+        self.assertFalse(mock_convert_lead.called)
+        mock_convert_leads.assert_called_once_with(ANY, doNotCreateOpportunity=True)
+        self.assertEqual([lead.pk for lead in mock_convert_leads.call_args[0][0]], [
+            'fake-lead1', 'fake-lead2', 'fake-lead3'
+        ])
+        records = client.update.call_args[0][0]
+        self.assertEqual([record['Id'] for record in records], ['fake-contact1', 'fake-contact3'])
+        self.assertEqual(records[0]['pi__utm_campaign__c'], self.user_data['tracking']['utm_campaign'])
+        mock_opp_get_or_create.assert_called_once_with(
+            account=Account(pk='fake-account1'),
+            name=course['course_id'],
+            amount=course['unit_price'] * course['quantity'],
+            close_date=course['purchase_date'],
+            paid_date=course['purchase_date'],
+            stage_name='Paid'
+        )
+        self.assertEqual(mock_opp_contact_role_create.call_args[1]['contact'].pk, 'fake-contact1')
+        output = out.getvalue()
+        self.assertIn('fake-user1: SYNCHRONIZED', output)
+        self.assertIn('fake-user2: Lead conversion failed: INVALID_STATUS: invalid status', output)
+        self.assertIn('fake-user2: FAILED', output)
+        self.assertIn('fake-user3: Contact: UNABLE_TO_LOCK_ROW: locked', output)
+        self.assertIn('fake-user3: FAILED', output)
+
+    @patch('edx_salesforce.management.commands.sync_salesforce.convert_leads')
+    @patch('edx_salesforce.models.Lead.objects.get')
+    @patch('edx_salesforce.models.Pricebook2.objects.get')
+    @patch('edx_salesforce.management.commands.sync_salesforce.fetch_user_data')
+    def test_command_with_failed_batch_conversion(self, mock_user_fetch_data, mock_pricebook_get, mock_lead_get,
+                                                  mock_convert_leads):
+        """
+        Test management command fails every user of a batch whose conversion request fails.
+        """
+        users = [dict(self.user_data, username='fake-user{}'.format(number)) for number in range(1, 3)]
+        mock_user_fetch_data.return_value = users
+        mock_pricebook_get.return_value = Pricebook2(is_standard=True)
+
+        def get_lead(username):
+            lead = self._get_lead_object()
+            lead.pk = username.replace('user', 'lead')
+            lead.username = username
+            return lead
+
+        mock_lead_get.side_effect = lambda **kwargs: get_lead(kwargs['username'])
+        mock_convert_leads.side_effect = ValueError('conversion failed')
+
+        out = StringIO()
+        with patch.object(SyncSalesforceCommand, '_invalidate_used_references') as mock_invalidate:
+            with patch.object(SObjectCollectionsClient, 'from_connection'):
+                call_command(
+                    'sync_salesforce',
+                    '--site-domain', self.site_domain,
+                    '--orgs', self.orgs,
+                    '--batch-conversions',
+                    stdout=out
+                )
+
+        self.assertEqual(mock_invalidate.call_count, 2)
+        output = out.getvalue()
+        self.assertEqual(output.count('ValueError: conversion failed'), 2)
+        self.assertIn('fake-user1: FAILED', output)
+        self.assertIn('fake-user2: FAILED', output)
+
+    @patch('edx_salesforce.models.Pricebook2.objects.get')
+    @patch('edx_salesforce.models.Campaign.objects.get_or_create')
+    def test_get_or_create_with_concurrent_workers(self, mock_campaign_get_or_create, mock_pricebook_get):
+        """
+        Test concurrent calls to _get_or_create only get or create the Salesforce object once.
+        """
+        def slow_get_or_create(**kwargs):
+            time.sleep(0.05)
+            return Campaign(**kwargs), True
+
+        mock_campaign_get_or_create.side_effect = slow_get_or_create
+        command = SyncSalesforceCommand()
+        pool = ThreadPool(4)
+        self.addCleanup(pool.terminate)
+
+        results = pool.map(
+            lambda _: command._get_or_create('Campaign', name='foo')[0],  # pylint: disable=protected-access
+            range(8)
+        )
+
+        self.assertEqual(mock_campaign_get_or_create.call_count, 1)
+        self.assertTrue(all(campaign is results[0] for campaign in results))
+
+    @patch.object(Lead, 'save')
+    @patch('edx_salesforce.models.Lead.objects.get')
+    @patch('edx_salesforce.models.Pricebook2.objects.get')
+    @patch('edx_salesforce.management.commands.sync_salesforce.fetch_user_data')
+    def test_command_with_workers(self, mock_user_fetch_data, mock_pricebook_get, mock_lead_get, mock_lead_save):
+        """
+        Test management command reports the same statuses, in the same order, with and without workers.
+        """
+        users = []
+        for number in range(12):
+            user = dict(self.user_data, username='fake-user{}'.format(number), courses={})
+            if number % 3 == 0:
+                user['email'] = 'changed{}@example.com'.format(number)
+            if number % 4 == 0:
+                user.pop('courses')
+            users.append(user)
+        mock_user_fetch_data.return_value = users
+        mock_pricebook_get.return_value = Pricebook2(is_standard=True)
+        mock_lead_get.side_effect = lambda **kwargs: self._get_lead_object()
+
+        outputs = []
+        for workers in ('1', '4'):
+            out = StringIO()
+            call_command(
+                'sync_salesforce',
+                '--site-domain', self.site_domain,
+                '--orgs', self.orgs,
+                '--workers', workers,
+                stdout=out
+            )
+            outputs.append([line for line in out.getvalue().splitlines() if re.match(r'fake-user|[0-9]+ ', line)])
+
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertIn('3 FAILED', outputs[1])
+        self.assertIn('fake-user3: SYNCHRONIZED', outputs[1])
+
+    @patch('edx_salesforce.models.Pricebook2.objects.get')
+    @patch('edx_salesforce.management.commands.sync_salesforce.fetch_user_data')
+    def test_command_with_invalid_workers(self, mock_user_fetch_data, mock_pricebook_get):
+        """
+        Test management command rejects invalid numbers of workers and unsupported combinations.
+        """
+        for arguments in (['--workers', '0'], ['--workers', '2', '--collections']):
+            with self.assertRaises(CommandError):
+                call_command('sync_salesforce', '--site-domain', self.site_domain, '--orgs', self.orgs, *arguments)
+        self.assertFalse(mock_user_fetch_data.called)
+
     @patch.object(Contact, 'save')
     @patch('edx_salesforce.models.Lead.objects.get')
     @patch('edx_salesforce.models.Pricebook2.objects.get')
@@ -460,3 +1586,19 @@ class TestSyncSalesForce(TestCase):
         )
 
         self.assertFalse(mock_contact_save.called)
+
+
+class TestUserFingerprint(DatabaseMixin, TestCase):
+    """
+    Test the fingerprints of the user data extracted from the sample databases.
+    """
+    multi_db = True
+
+    def test_fingerprint_extracted_users(self):
+        """
+        Test the fingerprints of the extracted users are those of the same data as dicts.
+        """
+        users = fetch_user_data('fake-site-domain.com', ['testX'])
+        self.assertTrue(any(user['courses'] for user in users))
+        for user, user_data in zip(users, USER_DATA):
+            self.assertEqual(_user_fingerprint(user), _user_fingerprint(user_data))
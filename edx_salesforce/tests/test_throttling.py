@@ -0,0 +1,142 @@
+"""
+Unit tests for edx_salesforce throttling module.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import requests
+from mock import Mock, patch
+from requests.adapters import HTTPAdapter
+from salesforce.backend.driver import SalesforceError
+
+from django.test import TestCase, override_settings
+
+from edx_salesforce.rest import RestApiError
+from edx_salesforce.throttling import RequestScheduler, ThrottlingAdapter, is_throttled_error
+
+
+def _response(status_code, content=b'', limit_info=None):
+    """
+    Return a response with the given status, content and Sforce-Limit-Info header.
+    """
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = content  # pylint: disable=protected-access
+    response.raw = Mock()
+    if limit_info:
+        response.headers['Sforce-Limit-Info'] = limit_info
+    return response
+
+
+class FakeClock(object):
+    """
+    Clock whose time only passes while sleeping.
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def time(self):
+        """
+        Return the current time.
+        """
+        return self.now
+
+    def sleep(self, seconds):
+        """
+        Let the given number of seconds pass.
+        """
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@override_settings(EDX_SALESFORCE_REQUEST_RATE=2)
+class TestRequestScheduler(TestCase):
+    """
+    Test the throttling of Salesforce requests.
+    """
+
+    def setUp(self):
+        super(TestRequestScheduler, self).setUp()
+
+        self.clock = FakeClock()
+        for name in ('time', 'sleep'):
+            patcher = patch('edx_salesforce.throttling.time.{name}'.format(name=name), getattr(self.clock, name))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_acquire(self):
+        scheduler = RequestScheduler()
+        for _ in range(4):
+            scheduler.acquire()
+
+        self.assertEqual(self.clock.sleeps, [0.5, 0.5])
+
+    def test_record_api_usage(self):
+        scheduler = RequestScheduler(max_share=0.5)
+        self.assertFalse(scheduler.exhausted())
+
+        self.assertFalse(scheduler.record(_response(200, limit_info='api-usage=49/100')))
+        self.assertFalse(scheduler.exhausted())
+        self.assertFalse(scheduler.record(_response(200, limit_info='api-usage=50/100')))
+        self.assertTrue(scheduler.exhausted())
+        self.assertEqual((scheduler.api_usage, scheduler.api_limit), (50, 100))
+
+    @patch('edx_salesforce.throttling.ApiLimitsClient.from_connection')
+    def test_update_limits(self, mock_from_connection):
+        mock_from_connection.return_value.limits.return_value = {
+            'DailyApiRequests': {'Max': 15000, 'Remaining': 5000},
+        }
+        scheduler = RequestScheduler(max_share=0.6)
+
+        scheduler.update_limits()
+
+        self.assertEqual((scheduler.api_usage, scheduler.api_limit), (10000, 15000))
+        self.assertTrue(scheduler.exhausted())
+
+    @patch.object(HTTPAdapter, 'send')
+    def test_send_retries_throttled_requests(self, mock_send):
+        mock_send.side_effect = [
+            _response(503),
+            _response(403, b'[{"errorCode": "REQUEST_LIMIT_EXCEEDED", "message": "ConcurrentRequests"}]'),
+            _response(200, limit_info='api-usage=12/100'),
+        ]
+        scheduler = RequestScheduler()
+        adapter = ThrottlingAdapter(scheduler)
+
+        response = adapter.send(Mock(body=None), timeout=10)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(mock_send.call_count, 3)
+        self.assertEqual(mock_send.call_args[1], {'timeout': 10})
+        self.assertEqual(self.clock.sleeps, [1, 2])
+        self.assertEqual(scheduler.rate, 0.5 + 0.2)
+        self.assertEqual(scheduler.api_usage, 12)
+
+    @patch.object(HTTPAdapter, 'send')
+    def test_send_gives_up(self, mock_send):
+        mock_send.side_effect = lambda request, **kwargs: _response(503)
+        body = Mock()
+        body.tell.return_value = 3
+        adapter = ThrottlingAdapter(RequestScheduler())
+
+        response = adapter.send(Mock(body=body))
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(mock_send.call_count, 6)
+        body.seek.assert_called_with(3)
+
+    def test_forbidden_request_is_not_retried(self):
+        scheduler = RequestScheduler()
+        self.assertFalse(scheduler.record(_response(403, b'[{"errorCode": "INSUFFICIENT_ACCESS"}]')))
+        self.assertEqual(scheduler.rate, 2)
+
+    def test_is_throttled_error(self):
+        unavailable = SalesforceError('fake', {'errorCode': 'SERVER_UNAVAILABLE'}, _response(503))
+        self.assertTrue(is_throttled_error(unavailable))
+        self.assertTrue(is_throttled_error(RestApiError('fake', unavailable)))
+        self.assertTrue(is_throttled_error(SalesforceError('fake', {}, _response(403, b'REQUEST_LIMIT_EXCEEDED'))))
+        self.assertFalse(is_throttled_error(SalesforceError('fake', {}, _response(500))))
+        self.assertFalse(is_throttled_error(SalesforceError('Timeout, fake')))
+        self.assertFalse(is_throttled_error(requests.exceptions.ConnectionError()))
@@ -4,10 +4,24 @@ Unit tests for edx_salesforce utility module.
 
 from __future__ import absolute_import, unicode_literals
 
+import requests
+from beatbox import xmltramp
 from ddt import ddt, data, unpack
 from django.test import TestCase
+from mock import Mock, patch
+from salesforce.backend.driver import SalesforceError
 
-from edx_salesforce.utils import parse_user_full_name
+from edx_salesforce.models import Lead
+from edx_salesforce.rest import RestApiError
+from edx_salesforce.utils import convert_leads, is_transient_error, parse_user_full_name
+
+LEAD_CONVERT_RESULTS = (
+    '<result xmlns="urn:partner.soap.sforce.com"><accountId>fake-account1</accountId>'
+    '<contactId>fake-contact1</contactId><leadId>fake-lead1</leadId><opportunityId xsi:nil="true" '
+    'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"/><success>true</success></result>',
+    '<result xmlns="urn:partner.soap.sforce.com"><errors><fields>Status</fields><message>invalid status</message>'
+    '<statusCode>INVALID_STATUS</statusCode></errors><leadId>fake-lead2</leadId><success>false</success></result>',
+)
 
 
 @ddt
@@ -25,3 +39,46 @@ class TestUtils(TestCase):
     def test_parse_user_full_name(self, full_name, expected):
         result = parse_user_full_name(full_name)
         self.assertEqual(expected, result)
+
+    @data(
+        (requests.exceptions.ReadTimeout(), True),
+        (requests.exceptions.ConnectionError(), True),
+        (SalesforceError('Timeout, URL=https://fake.salesforce.com'), True),
+        (SalesforceError('fake', {'errorCode': 'UNABLE_TO_LOCK_ROW'}, Mock(status_code=400)), True),
+        (SalesforceError('fake', {'errorCode': 'SERVER_UNAVAILABLE'}, Mock(status_code=503)), True),
+        (SalesforceError('fake', {'errorCode': 'INVALID_FIELD'}, Mock(status_code=400)), False),
+        (RestApiError('fake', SalesforceError('fake', {'errorCode': 'UNABLE_TO_LOCK_ROW'}, Mock(status_code=400))),
+         True),
+        (RestApiError('fake'), False),
+        (KeyError('courses'), False),
+    )
+    @unpack
+    def test_is_transient_error(self, error, expected):
+        self.assertEqual(is_transient_error(error), expected)
+
+    @patch('edx_salesforce.utils.get_soap_client')
+    def test_convert_leads(self, mock_get_soap_client):
+        soap_client = mock_get_soap_client.return_value
+        soap_client.convertLead.return_value = [xmltramp.parse(result) for result in LEAD_CONVERT_RESULTS]
+        leads = [Lead(id='fake-lead1'), Lead(id='fake-lead2')]
+
+        results = convert_leads(leads, converted_status='Qualified', doNotCreateOpportunity=True)
+
+        soap_client.convertLead.assert_called_once_with([
+            {'leadId': 'fake-lead1', 'convertedStatus': 'Qualified', 'doNotCreateOpportunity': True},
+            {'leadId': 'fake-lead2', 'convertedStatus': 'Qualified', 'doNotCreateOpportunity': True},
+        ])
+        self.assertEqual(results[0]['success'], True)
+        self.assertEqual(results[0]['contactId'], 'fake-contact1')
+        self.assertEqual(results[0]['accountId'], 'fake-account1')
+        self.assertEqual(results[0]['errors'], [])
+        self.assertEqual(results[1]['success'], False)
+        self.assertEqual(results[1]['errors'], ['INVALID_STATUS: invalid status'])
+
+    @patch('edx_salesforce.utils.get_soap_client')
+    def test_convert_single_lead(self, mock_get_soap_client):
+        mock_get_soap_client.return_value.convertLead.return_value = xmltramp.parse(LEAD_CONVERT_RESULTS[0])
+
+        results = convert_leads([Lead(id='fake-lead1')], converted_status='Qualified')
+
+        self.assertEqual([result['leadId'] for result in results], ['fake-lead1'])
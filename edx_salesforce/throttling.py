@@ -0,0 +1,183 @@
+"""
+Provides a scheduler which throttles the Salesforce API requests of a process.
+
+The scheduler keeps a token bucket of EDX_SALESFORCE_REQUEST_RATE requests per second, shared
+by the Salesforce sessions it is installed on, and tracks the daily API request usage of the org
+from the Sforce-Limit-Info header of each response and the limits resource. Requests rejected
+with REQUEST_LIMIT_EXCEEDED or a 503 are retried after an exponential backoff, and halve the
+request rate, which then grows back with each successful request.
+
+See "API Request Limits and Allocations" in the Salesforce Developer Limits Quick Reference.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import re
+import threading
+import time
+
+from requests.adapters import HTTPAdapter
+from salesforce.backend import get_max_retries
+
+from django.conf import settings
+from django.db import connections
+
+from edx_salesforce.rest import RestApiClient, RestApiError
+
+# Number of requests per second, unless set by the EDX_SALESFORCE_REQUEST_RATE setting.
+DEFAULT_REQUEST_RATE = 10
+
+# Lowest number of requests per second the rate is reduced to by throttled requests.
+MIN_REQUEST_RATE = 0.1
+
+# Number of times a throttled request is retried, and the number of seconds before the first retry.
+MAX_THROTTLED_RETRIES = 5
+THROTTLED_RETRY_DELAY = 1
+
+# Matches the daily API request usage of the org in the Sforce-Limit-Info header.
+API_USAGE_PATTERN = re.compile(r'api-usage=(\d+)/(\d+)')
+
+
+class ApiLimitsClient(RestApiClient):
+    """
+    Client for the limits resource.
+    """
+
+    def limits(self):
+        """
+        Return the maximum and remaining allocations of the org, by limit name.
+        """
+        return self._request('get', 'limits/')
+
+
+class RequestScheduler(object):
+    """
+    Throttles the requests of the Salesforce sessions it is installed on.
+
+    Arguments:
+        max_share (float): The share of the daily API request limit of the org after which
+                           the budget of the process is exhausted, or None for no budget.
+    """
+
+    def __init__(self, max_share=None):
+        self.max_rate = float(getattr(settings, 'EDX_SALESFORCE_REQUEST_RATE', DEFAULT_REQUEST_RATE))
+        self.max_share = max_share
+        self.rate = self.max_rate
+        self.lock = threading.Lock()
+
+        # The bucket holds the tokens of up to a second of requests, and at least one.
+        self.capacity = max(self.max_rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.time()
+
+        # Number of API requests used by the org today, and its daily limit, once known.
+        self.api_usage = None
+        self.api_limit = None
+
+    def install(self, alias='salesforce'):
+        """
+        Throttle the requests of the Salesforce session of the current thread's connection to the given database.
+        """
+        session = connections[alias].sf_session
+        session.mount(session.auth.instance_url, ThrottlingAdapter(self, max_retries=get_max_retries()))
+
+    def update_limits(self, alias='salesforce'):
+        """
+        Read the daily API request usage of the org from the limits resource.
+        """
+        daily_requests = ApiLimitsClient.from_connection(alias).limits()['DailyApiRequests']
+        with self.lock:
+            self.api_usage = daily_requests['Max'] - daily_requests['Remaining']
+            self.api_limit = daily_requests['Max']
+
+    def exhausted(self):
+        """
+        Return whether the configured share of the daily API request limit of the org is used.
+        """
+        with self.lock:
+            if self.max_share is None or self.api_limit is None:
+                return False
+            return self.api_usage >= self.api_limit * self.max_share
+
+    def acquire(self):
+        """
+        Wait until a request can be sent.
+        """
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+    def record(self, response):
+        """
+        Record the API request usage reported by the given response, and adapt the request rate.
+
+        Returns:
+            boolean, True if the request was throttled by Salesforce and should be retried.
+        """
+        match = API_USAGE_PATTERN.search(response.headers.get('Sforce-Limit-Info', ''))
+        throttled = _throttled(response)
+        with self.lock:
+            if match:
+                self.api_usage, self.api_limit = int(match.group(1)), int(match.group(2))
+            if throttled:
+                self.rate = max(MIN_REQUEST_RATE, self.rate / 2)
+                self.tokens = min(self.tokens, 0)
+            else:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+        return throttled
+
+
+class ThrottlingAdapter(HTTPAdapter):
+    """
+    Transport adapter which sends the requests of a Salesforce session through a RequestScheduler.
+
+    Arguments:
+        scheduler (RequestScheduler): The scheduler the requests are sent through.
+    """
+
+    def __init__(self, scheduler, **kwargs):
+        super(ThrottlingAdapter, self).__init__(**kwargs)
+        self.scheduler = scheduler
+
+    def send(self, request, **kwargs):  # pylint: disable=arguments-differ
+        """
+        Send the given request once the scheduler allows it, retrying it while it is throttled.
+        """
+        position = request.body.tell() if hasattr(request.body, 'seek') else None
+        for attempt in range(MAX_THROTTLED_RETRIES + 1):
+            if attempt:
+                time.sleep(THROTTLED_RETRY_DELAY * 2 ** (attempt - 1))
+                if position is not None:
+                    request.body.seek(position)
+
+            self.scheduler.acquire()
+            response = super(ThrottlingAdapter, self).send(request, **kwargs)
+            if not self.scheduler.record(response) or attempt == MAX_THROTTLED_RETRIES:
+                return response
+            response.close()
+
+
+def is_throttled_error(error):
+    """
+    Return whether the given error is raised for a request the ThrottlingAdapter retries while it is throttled.
+    """
+    if isinstance(error, RestApiError) and error.cause is not None:
+        error = error.cause
+    response = getattr(error, 'response', None)
+    return response is not None and _throttled(response)
+
+
+def _throttled(response):
+    """
+    Return whether the given response rejects its request because of the request rate of the org.
+    """
+    if response.status_code == 503:
+        return True
+    return response.status_code == 403 and b'REQUEST_LIMIT_EXCEEDED' in response.content
@@ -2,6 +2,82 @@
 
 from __future__ import absolute_import, unicode_literals
 
+import requests
+from salesforce.backend.driver import SalesforceError
+from salesforce.utils import get_soap_client
+
+from django.db import connections, router
+
+from edx_salesforce.rest import RestApiError
+
+# Salesforce error codes of failures which may not happen again if the request is retried.
+TRANSIENT_ERROR_CODES = ('QUERY_TIMEOUT', 'SERVER_UNAVAILABLE', 'UNABLE_TO_LOCK_ROW')
+
+# Salesforce error codes of requests rejected because they refer to an object which no longer exists.
+STALE_REFERENCE_ERROR_CODES = ('ENTITY_IS_DELETED', 'INVALID_CROSS_REFERENCE_KEY', 'INVALID_ID_FIELD')
+
+
+def convert_leads(leads, converted_status=None, **kwargs):
+    """
+    Converts the given Leads with a single call to the convertLead() endpoint of the SOAP API,
+    which accepts up to 200 Leads. Unlike salesforce.utils.convert_lead, the failure of a Lead
+    is returned with its result instead of raising an error.
+
+    Arguments:
+        leads (list of Leads): Leads which have not been converted yet.
+        converted_status (string): Valid LeadStatus value for a converted lead. Not necessary if
+                                   only one converted status is configured for Leads.
+        kwargs: Additional convertLead() parameters applied to every Lead, e.g. doNotCreateOpportunity.
+
+    Returns:
+        list of dicts, the leadId, accountId, contactId, success and errors of each Lead, in the
+        order of the given Leads.
+    """
+    db_alias = router.db_for_write(type(leads[0]), instance=leads[0])
+    if converted_status is None:
+        converted_status = connections[db_alias].introspection.converted_lead_status
+    soap_client = get_soap_client(db_alias)
+
+    response = soap_client.convertLead([
+        dict(kwargs, leadId=lead.pk, convertedStatus=converted_status) for lead in leads
+    ])
+    # A single result is returned as is, rather than in a list.
+    if len(leads) == 1:
+        response = [response]
+    return [_lead_convert_result(result) for result in response]
+
+
+def is_transient_error(error):
+    """
+    Returns whether the given error is a transient failure of a Salesforce request, i.e. a timeout,
+    a connection error, a server error or a Salesforce error with one of TRANSIENT_ERROR_CODES.
+    """
+    if isinstance(error, RestApiError) and error.cause is not None:
+        error = error.cause
+    if isinstance(error, (requests.exceptions.Timeout, requests.exceptions.ConnectionError)):
+        return True
+    if not isinstance(error, SalesforceError):
+        return False
+
+    # django-salesforce raises timeouts as errors without a response.
+    if error.response is None:
+        return '{}'.format(error).startswith('Timeout')
+    if error.response.status_code >= 500:
+        return True
+    return (error.data or {}).get('errorCode') in TRANSIENT_ERROR_CODES
+
+
+def is_stale_reference_error(error):
+    """
+    Returns whether the given error is a Salesforce error rejecting a request which refers to an object
+    which no longer exists, e.g. a Salesforce ID cached by an earlier run for an object deleted since.
+    """
+    if isinstance(error, RestApiError) and error.cause is not None:
+        error = error.cause
+    if not isinstance(error, SalesforceError):
+        return False
+    return (error.data or {}).get('errorCode') in STALE_REFERENCE_ERROR_CODES
+
 
 def parse_user_full_name(full_name):
     """
@@ -17,3 +93,21 @@ def parse_user_full_name(full_name):
         first_name = None
         last_name = full_name
     return first_name, last_name
+
+
+def _lead_convert_result(result):
+    """
+    Returns the LeadConvertResult element of a convertLead() response as a dict.
+    """
+    values = {'errors': []}
+    for element in result:
+        name = element._name[1]  # pylint: disable=protected-access
+        if name == 'errors':
+            error = {part._name[1]: str(part) for part in element}  # pylint: disable=protected-access
+            values['errors'].append('{statusCode}: {message}'.format(
+                statusCode=error.get('statusCode'), message=error.get('message')
+            ))
+        else:
+            values[name] = str(element)
+    values['success'] = values.get('success') == 'true'
+    return values